@@ -0,0 +1,142 @@
+"""Compare bytes written and wall time of file callbacks by compression.
+
+Writes market orders with the JSON (indented), YAML and CSV callbacks, without
+compression, with gzip and, if installed, with zstd.
+
+Usage:
+    python scripts/benchmarks/callback_compression.py [--jobs 20] [--rows 20000]
+        [--processes 0]
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional
+
+from eve_esi_jobs.aiohttp_queue import ResponseMeta
+from eve_esi_jobs.callback_manifest import new_manifest
+from eve_esi_jobs.callbacks import CallbackRunner
+from eve_esi_jobs.compression import zstandard
+from eve_esi_jobs.models import EsiJob, EsiJobResult, JobCallback
+
+CALLBACKS: Dict[str, Dict] = {
+    "save_result_to_json_file": {"indent": 2},
+    "save_result_to_yaml_file": {},
+    "save_list_of_dict_result_to_csv_file": {},
+}
+
+
+def make_raw_json(rows: int) -> str:
+    return json.dumps(
+        [
+            {
+                "duration": 90,
+                "is_buy_order": bool(index % 2),
+                "issued": "2021-06-01T12:00:00Z",
+                "location_id": 60003760,
+                "min_volume": 1,
+                "order_id": 5_000_000_000 + index,
+                "price": round(index * 1.37, 2),
+                "range": "region",
+                "system_id": 30000142,
+                "type_id": index % 500,
+                "volume_remain": index % 1000,
+                "volume_total": 1000,
+            }
+            for index in range(rows)
+        ]
+    )
+
+
+def make_job(page: int, raw_json: str) -> EsiJob:
+    job = EsiJob(op_id="get_markets_region_id_orders", parameters={"page": page})
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    response = ResponseMeta(
+        version="1.1",
+        status=200,
+        reason="OK",
+        cookies="",
+        response_headers=[{"Expires": expires.strftime("%a, %d %b %Y %H:%M:%S GMT")}],
+        method="GET",
+        url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        real_url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        request_headers=[],
+    )
+    job.result = EsiJobResult.from_raw(
+        op_id=job.op_id, param_sig=job.param_sig(), response=response, raw=raw_json
+    )
+    return job
+
+
+async def run(
+    jobs: List[EsiJob],
+    callback_id: str,
+    kwargs: Dict,
+    output: Path,
+    max_processes: Optional[int],
+):
+    manifest = new_manifest()
+    runner = CallbackRunner(max_processes=max_processes)
+    job_callback = JobCallback(
+        callback_id=callback_id,
+        kwargs={"file_path_template": str(output / "${page}"), **kwargs},
+    )
+
+    async def do_callback(job: EsiJob):
+        callback = manifest.init_callback(job_callback, job)
+        callback.runner = runner
+        await callback.do_callback()
+
+    try:
+        await asyncio.gather(*(do_callback(job) for job in jobs))
+    finally:
+        await runner.aclose()
+
+
+def main(job_count: int, rows: int, max_processes: Optional[int]):
+    raw_json = make_raw_json(rows)
+    jobs = [make_job(page, raw_json) for page in range(job_count)]
+    compressions: List[Optional[str]] = [None, "gzip"]
+    if zstandard is not None:
+        compressions.append("zstd")
+    for callback_id, kwargs in CALLBACKS.items():
+        for compression in compressions:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                output = Path(temp_dir)
+                start = perf_counter()
+                asyncio.run(
+                    run(
+                        jobs,
+                        callback_id,
+                        {**kwargs, "compression": compression},
+                        output,
+                        max_processes,
+                    )
+                )
+                took = perf_counter() - start
+                size = sum(
+                    path.stat().st_size
+                    for path in output.glob("*")
+                    if not path.name.startswith(".")
+                )
+            print(
+                f"{callback_id:>37} {str(compression):>5}: "
+                f"{size / 1024 / 1024:8.2f} MiB, {took:6.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Process pool size, 0 for threads, default one per CPU.",
+    )
+    args = parser.parse_args()
+    main(args.jobs, args.rows, args.processes)
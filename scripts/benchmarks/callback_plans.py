@@ -0,0 +1,85 @@
+"""Measure the per-job cost of making callbacks and resolving their file paths.
+
+Compares callbacks made from compiled plans, with a shared parsed path template,
+with the previous behaviour of looking up the manifest entry, calling the factory
+and building a `string.Template` from all the job attributes for every job.
+
+Usage:
+    python scripts/benchmarks/callback_plans.py [--jobs 100000]
+"""
+import argparse
+from pathlib import Path
+from string import Template
+from time import perf_counter
+from typing import List
+
+from eve_esi_jobs.callback_manifest import CallbackManifest, new_manifest
+from eve_esi_jobs.models import EsiJob, JobCallback
+
+TEMPLATES = [
+    "data/market-history-${region_id}-${type_id}.json",
+    "data/${esi_job_op_id}/${region_id}/${type_id}",
+]
+
+
+def make_jobs(template: str, job_count: int) -> List[EsiJob]:
+    # A callback per job, as when reading a workorder.
+    return [
+        EsiJob(
+            op_id="get_markets_region_id_history",
+            parameters={"region_id": 10000002, "type_id": type_id},
+            callbacks=[
+                JobCallback(
+                    callback_id="save_result_to_json_file",
+                    kwargs={"file_path_template": template},
+                )
+            ],
+        )
+        for type_id in range(job_count)
+    ]
+
+
+def previous(manifest: CallbackManifest, jobs: List[EsiJob]) -> Path:
+    file_path = Path()
+    for job in jobs:
+        for job_callback in job.callbacks:
+            entry = manifest.manifest_entries[job_callback.callback_id]
+            callback = entry.factory_function(job=job, **job_callback.kwargs)
+            template = Template(str(callback.file_path_template))
+            file_path = Path(template.safe_substitute(job.attributes()))
+            file_path = file_path.with_suffix(callback.file_ending)
+    return file_path
+
+
+def planned(manifest: CallbackManifest, jobs: List[EsiJob]) -> Path:
+    file_path = Path()
+    for job in jobs:
+        for job_callback in job.callbacks:
+            callback = manifest.plan(job_callback).new_callback(job)
+            callback.refine_path()
+            file_path = callback.file_path
+    return file_path
+
+
+def main(job_count: int):
+    manifest = new_manifest()
+    for template in TEMPLATES:
+        jobs = make_jobs(template, job_count)
+        results = []
+        for name, func in (("previous", previous), ("planned", planned)):
+            start = perf_counter()
+            file_path = func(manifest, jobs)
+            took = perf_counter() - start
+            results.append(file_path)
+            print(
+                f"{template}: {name:>8} {took:6.2f}s, "
+                f"{took / job_count * 1_000_000:5.1f}us/job"
+            )
+        assert results[0] == results[1], results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=100_000)
+    args = parser.parse_args()
+    main(args.jobs)
@@ -0,0 +1,108 @@
+"""Compare EsiLocalSource cache size, read latency and cpu time by compression.
+
+Uses a real dataset if given, e.g. a saved `get_markets_region_id_orders` or
+`get_markets_region_id_history` result, otherwise generates market orders.
+
+Usage:
+    python scripts/benchmarks/local_source_compression.py [--data orders.json]
+        [--jobs 100] [--rows 20000]
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+from pathlib import Path
+from time import perf_counter, process_time
+from typing import Any, List, Optional
+
+from eve_esi_jobs.aiohttp_queue import ResponseMeta
+from eve_esi_jobs.compression import zstandard
+from eve_esi_jobs.models import EsiJob, EsiJobResult
+from eve_esi_jobs.sources import EsiLocalSource
+
+
+def make_data(rows: int) -> List[dict]:
+    return [
+        {
+            "duration": 90,
+            "is_buy_order": bool(index % 2),
+            "issued": "2021-06-01T12:00:00Z",
+            "location_id": 60003760,
+            "min_volume": 1,
+            "order_id": 5000000000 + index,
+            "price": round(index * 1.37, 2),
+            "range": "region",
+            "system_id": 30000142,
+            "type_id": index % 500,
+            "volume_remain": index % 1000,
+            "volume_total": 1000,
+        }
+        for index in range(rows)
+    ]
+
+
+def make_result(job: EsiJob, data: Any) -> EsiJobResult:
+    response = ResponseMeta(
+        version="1.1",
+        status=200,
+        reason="OK",
+        cookies="",
+        response_headers=[{"ETag": '"benchmark"'}],
+        method="GET",
+        url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        real_url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        request_headers=[],
+    )
+    return EsiJobResult(
+        op_id=job.op_id, param_sig=job.param_sig(), response=response, data=data
+    )
+
+
+async def run(source: EsiLocalSource, jobs: List[EsiJob], data: Any):
+    cpu_start = process_time()
+    write_start = perf_counter()
+    for job in jobs:
+        await source.store_result(make_result(job, data))
+    write_time = perf_counter() - write_start
+    read_start = perf_counter()
+    for job in jobs:
+        await source.do_job(job)
+    read_time = perf_counter() - read_start
+    return write_time, read_time, process_time() - cpu_start
+
+
+def main(data_path: Optional[Path], job_count: int, rows: int):
+    if data_path is not None:
+        data = json.loads(data_path.read_text())
+        if isinstance(data, dict) and "data" in data:
+            data = data["data"]
+    else:
+        data = make_data(rows)
+    jobs = [
+        EsiJob(op_id="get_markets_region_id_orders", parameters={"page": page})
+        for page in range(job_count)
+    ]
+    compressions: List[Optional[str]] = [None, "gzip"]
+    if zstandard is not None:
+        compressions.append("zstd")
+    for compression in compressions:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = EsiLocalSource(Path(temp_dir), compression=compression)
+            write_time, read_time, cpu_time = asyncio.run(run(source, jobs, data))
+            source.close()
+            size = sum(path.stat().st_size for path in Path(temp_dir).glob("*"))
+        print(
+            f"{str(compression):>5}: {size / 1024 / 1024:8.2f} MiB, "
+            f"write {write_time / job_count * 1000:6.1f}ms/job, "
+            f"read {read_time / job_count * 1000:6.1f}ms/job, "
+            f"cpu {cpu_time:6.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", type=Path, default=None)
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+    main(args.data, args.jobs, args.rows)
@@ -0,0 +1,110 @@
+"""Measure event loop lag while EsiLocalSource reads and writes results.
+
+Compares the thread pool file access of EsiLocalSource with the previous
+behaviour of doing file access directly on the event loop.
+
+Usage:
+    python scripts/benchmarks/local_source_loop_lag.py [--jobs 200] [--rows 20000]
+"""
+import argparse
+import asyncio
+import tempfile
+from pathlib import Path
+from statistics import mean
+from time import perf_counter
+from typing import List, Optional
+
+from eve_esi_jobs.aiohttp_queue import ResponseMeta
+from eve_esi_jobs.models import EsiJob, EsiJobResult
+from eve_esi_jobs.sources import EsiLocalSource
+
+
+class BlockingLocalSource(EsiLocalSource):
+    """File access on the event loop, as EsiLocalSource did before."""
+
+    async def _get_job_from_source(self, job: EsiJob) -> Optional[EsiJobResult]:
+        return self._read_result(self.result_path(job.op_id, job.param_sig()))
+
+    async def store_result(self, result: EsiJobResult):
+        self._write_result(self.result_path(result.op_id, result.param_sig), result)
+
+
+def make_result(job: EsiJob, rows: int) -> EsiJobResult:
+    response = ResponseMeta(
+        version="1.1",
+        status=200,
+        reason="OK",
+        cookies="",
+        response_headers=[{"ETag": '"benchmark"'}],
+        method="GET",
+        url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        real_url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        request_headers=[],
+    )
+    data = [
+        {
+            "order_id": index,
+            "type_id": index % 500,
+            "price": index * 1.5,
+            "volume_remain": index % 1000,
+            "is_buy_order": bool(index % 2),
+            "issued": "2021-06-01T12:00:00Z",
+        }
+        for index in range(rows)
+    ]
+    return EsiJobResult(
+        op_id=job.op_id, param_sig=job.param_sig(), response=response, data=data
+    )
+
+
+async def monitor(lags: List[float], stop: asyncio.Event, interval: float = 0.001):
+    while not stop.is_set():
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - start - interval)
+
+
+async def run(source: EsiLocalSource, jobs: List[EsiJob], result: EsiJobResult):
+    lags: List[float] = []
+    stop = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(lags, stop))
+    start = perf_counter()
+
+    async def round_trip(job: EsiJob):
+        await source.store_result(result.copy(update={"param_sig": job.param_sig()}))
+        await source.do_job(job)
+
+    await asyncio.gather(*(round_trip(job) for job in jobs))
+    took = perf_counter() - start
+    stop.set()
+    await monitor_task
+    return took, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+    jobs = [
+        EsiJob(op_id="get_markets_region_id_orders", parameters={"page": page})
+        for page in range(args.jobs)
+    ]
+    result = make_result(jobs[0], args.rows)
+    for name, source_class in (
+        ("blocking", BlockingLocalSource),
+        ("thread pool", EsiLocalSource),
+    ):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = source_class(Path(temp_dir))
+            took, lags = asyncio.run(run(source, jobs, result))
+            source.close()
+        print(
+            f"{name:>12}: {took:.2f}s total, loop lag "
+            f"mean {mean(lags) * 1000:.1f}ms, max {max(lags) * 1000:.1f}ms, "
+            f"{len(lags)} ticks"
+        )
+
+
+if __name__ == "__main__":
+    main()
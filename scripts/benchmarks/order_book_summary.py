@@ -0,0 +1,95 @@
+"""Compare the NumPy order book summary with a per-record Python loop.
+
+Summarizes generated market orders, and checks both give the same best prices
+and volumes. The NumPy time includes loading the orders into arrays, which is a
+walk over the records, and is also reported on its own.
+
+Usage:
+    python scripts/benchmarks/order_book_summary.py [--orders 300000] [--types 15000]
+"""
+import argparse
+import random
+from time import perf_counter
+from typing import Any, Dict, List
+
+from eve_esi_jobs.order_book import order_book_arrays, summarize_order_book
+
+
+def make_orders(order_count: int, type_count: int) -> List[Dict[str, Any]]:
+    rng = random.Random(42)
+    return [
+        {
+            "type_id": rng.randrange(type_count),
+            "is_buy_order": rng.random() < 0.4,
+            "price": round(rng.uniform(1.0, 1000.0), 2),
+            "volume_remain": rng.randrange(1, 10000),
+        }
+        for _ in range(order_count)
+    ]
+
+
+def python_summary(
+    orders: List[Dict[str, Any]], depth_percent: float
+) -> Dict[int, Dict[str, Any]]:
+    """Best prices, volumes, weighted prices and depth, one record at a time."""
+    sides: Dict[int, Dict[bool, List[Dict[str, Any]]]] = {}
+    for order in orders:
+        type_sides = sides.setdefault(order["type_id"], {True: [], False: []})
+        type_sides[order["is_buy_order"]].append(order)
+    summary: Dict[int, Dict[str, Any]] = {}
+    for type_id, type_sides in sides.items():
+        row: Dict[str, Any] = {}
+        for is_buy, side in type_sides.items():
+            name = "buy" if is_buy else "sell"
+            volume = sum(order["volume_remain"] for order in side)
+            row[f"{name}_volume"] = volume
+            if not side:
+                continue
+            prices = [order["price"] for order in side]
+            best = max(prices) if is_buy else min(prices)
+            row["best_bid" if is_buy else "best_ask"] = best
+            row[f"{name}_weighted_price"] = (
+                sum(order["price"] * order["volume_remain"] for order in side) / volume
+            )
+            limit = best * (
+                1 - depth_percent / 100 if is_buy else 1 + depth_percent / 100
+            )
+            row[f"{name}_depth"] = sum(
+                order["volume_remain"]
+                for order in side
+                if (order["price"] >= limit if is_buy else order["price"] <= limit)
+            )
+        summary[type_id] = row
+    return summary
+
+
+def main(order_count: int, type_count: int):
+    orders = make_orders(order_count, type_count)
+    start = perf_counter()
+    expected = python_summary(orders, 5.0)
+    python_took = perf_counter() - start
+    start = perf_counter()
+    order_book_arrays(orders)
+    arrays_took = perf_counter() - start
+    start = perf_counter()
+    rows = summarize_order_book(orders, [5.0])
+    numpy_took = perf_counter() - start
+    assert len(rows) == len(expected)
+    for row in rows:
+        reference = expected[row["type_id"]]
+        assert row["best_bid"] == reference.get("best_bid")
+        assert row["best_ask"] == reference.get("best_ask")
+        assert row["buy_volume"] == reference["buy_volume"]
+        assert row["sell_depth_5pct"] == reference.get("sell_depth", 0)
+    print(f"{order_count} orders, {len(rows)} types")
+    print(f"python loop: {python_took:6.3f}s")
+    print(f"      numpy: {numpy_took:6.3f}s, {python_took / numpy_took:5.1f}x")
+    print(f"     arrays: {arrays_took:6.3f}s of that")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=300_000)
+    parser.add_argument("--types", type=int, default=15_000)
+    args = parser.parse_args()
+    main(args.orders, args.types)
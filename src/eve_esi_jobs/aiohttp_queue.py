@@ -4,7 +4,8 @@ import re
 from asyncio.queues import Queue
 from copy import deepcopy
 from dataclasses import dataclass, field
-from datetime import datetime, time, timedelta
+from datetime import datetime, time, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from enum import Enum
 from time import perf_counter_ns
 from typing import Any, Dict, List, Optional, Sequence, Tuple, Type, Union
@@ -233,6 +234,69 @@ class ResponseMeta:
                     return value
         return None
 
+    def refresh_headers(
+        self,
+        response_headers: List[Dict],
+        keys: Sequence[str] = ("date", "expires", "cache-control", "etag"),
+    ):
+        """Replace the named headers with those found in `response_headers`.
+
+        Used to carry the cache headers of a 304 response over to a stored response.
+        """
+        lower_keys = [key.lower() for key in keys]
+        replacements = [
+            item
+            for item in response_headers
+            for dict_key in item
+            if dict_key.lower() in lower_keys
+        ]
+        if not replacements:
+            return
+        replaced_keys = {
+            dict_key.lower() for item in replacements for dict_key in item.keys()
+        }
+        self.response_headers = [
+            item
+            for item in self.response_headers
+            if not any(dict_key.lower() in replaced_keys for dict_key in item)
+        ]
+        self.response_headers.extend(replacements)
+
+    def expires_at(self) -> Optional[datetime]:
+        """The time the response stops being fresh, as a timezone aware UTC datetime.
+
+        `Cache-Control` takes precedence over `Expires`. A `max-age` directive is
+        counted from the `Date` header. Responses marked `no-cache` or `no-store`,
+        or without usable headers, return None.
+        """
+        cache_control = self.get_response_header("cache-control")
+        if cache_control is not None:
+            directives = [
+                item.strip().lower() for item in str(cache_control).split(",")
+            ]
+            if "no-cache" in directives or "no-store" in directives:
+                return None
+            for directive in directives:
+                if directive.startswith("max-age="):
+                    date = parse_http_date(self.get_response_header("date"))
+                    try:
+                        max_age = int(directive.split("=", 1)[1])
+                    except ValueError:
+                        break
+                    if date is None:
+                        return None
+                    return date + timedelta(seconds=max_age)
+        return parse_http_date(self.get_response_header("expires"))
+
+    def is_fresh(self, now: Optional[datetime] = None) -> bool:
+        """True if the response can still be used without revalidation."""
+        expires = self.expires_at()
+        if expires is None:
+            return False
+        if now is None:
+            now = datetime.now(timezone.utc)
+        return now < expires
+
     @classmethod
     def from_response(cls, response: ClientResponse) -> "ResponseMeta":
         request_headers = [
@@ -283,6 +347,8 @@ class ResponseType(Enum):
     BYTES = "bytes"
     NONE = "none"
     AUTO = "auto"
+    RAW_JSON = "raw_json"
+    """As AUTO, but JSON is read as bytes and left for the consumer to parse."""
 
 
 @dataclass
@@ -375,6 +441,8 @@ class AiohttpRequest:
         if response.status == 200:
             if self.response_type == ResponseType.AUTO:
                 self.data = await self.auto_decode(response)
+            elif self.response_type == ResponseType.RAW_JSON:
+                self.data = await self.auto_decode(response, raw_json=True)
             elif self.response_type == ResponseType.JSON:
                 self.data = await response.json()
             elif self.response_type == ResponseType.TEXT:
@@ -390,7 +458,7 @@ class AiohttpRequest:
             # NOTE this is not done if raise_for_status=True
             self.data = await response.text()
 
-    async def auto_decode(self, response: ClientResponse):
+    async def auto_decode(self, response: ClientResponse, raw_json: bool = False):
         content_type = response.headers.get("content-type", None)
         if content_type is None:
             if response.status == 200:
@@ -406,6 +474,8 @@ class AiohttpRequest:
             data = await response.text()
             return data
         elif "application/json" in content_type.lower():
+            if raw_json:
+                return await response.read()
             data = await response.json()
             return data
         elif "text/html" in content_type.lower():
@@ -668,6 +738,35 @@ class AiohttpRequestQueue:
 #     )
 
 
+def parse_http_date(value: Optional[str]) -> Optional[datetime]:
+    """Parse an HTTP date header into a timezone aware UTC datetime.
+
+    Returns None if the value is missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(str(value))
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def join_json_arrays(parts: List[bytes]) -> bytes:
+    """Join JSON arrays into one array, without parsing their items."""
+    items = []
+    for part in parts:
+        part = part.strip()
+        if not (part.startswith(b"[") and part.endswith(b"]")):
+            raise ValueError(f"Expected a JSON array, got {part[:20]!r}")
+        part = part[1:-1].strip()
+        if part:
+            items.append(part)
+    return b"[" + b",".join(items) + b"]"
+
+
 def get_pages_requests(request: AiohttpRequest) -> Optional[List[AiohttpRequest]]:
     """an example of getting paged requests, will be specific to each api."""
     assert request.response_meta is not None
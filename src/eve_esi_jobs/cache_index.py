@@ -0,0 +1,458 @@
+"""An index of the entries in a local source, and the hit rates of past runs.
+
+Walking a cache directory of a million results takes minutes, the index answers
+the same questions with a few SQL queries. A local source given a
+:class:`CacheIndex` records the results it stores, reads and removes. Changes
+are buffered in memory and written when the source is flushed or closed.
+
+An index that is missing, or out of date because another program changed the
+cache, can be rebuilt by scanning the source with :meth:`CacheIndex.rebuild`.
+"""
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from eve_esi_jobs.sources import CacheEntry, EsiLocalSource
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+AGE_BUCKETS: List[Tuple[str, float]] = [
+    ("< 1 hour", 3600),
+    ("< 1 day", 86400),
+    ("< 1 week", 7 * 86400),
+    ("< 30 days", 30 * 86400),
+]
+"""Age buckets by upper bound in seconds. Anything older is "older"."""
+
+SUMMARY_KEY = (
+    "CAST({row}.stored / 60 AS INTEGER), "
+    "coalesce(CAST({row}.expires / 60 AS INTEGER), -1)"
+)
+"""The stored and expiry minutes of an entry, see :meth:`CacheIndex.stats`."""
+
+
+@dataclass
+class RunStats:
+    """How the jobs of a run were served.
+
+    Args:
+        fresh: Served from a fresh local result, no request made.
+        stale: Served from a stale local result, revalidated in the background.
+        unchanged: The server answered 304, the local result was used.
+        fetched: New data was fetched from the server.
+        errors: No result.
+    """
+
+    started: float = field(default_factory=time)
+    finished: Optional[float] = None
+    jobs: int = 0
+    fresh: int = 0
+    stale: int = 0
+    unchanged: int = 0
+    fetched: int = 0
+    errors: int = 0
+    run_id: Optional[int] = None
+
+    @property
+    def hits(self) -> int:
+        return self.fresh + self.stale + self.unchanged
+
+    @property
+    def misses(self) -> int:
+        return self.fetched
+
+    @property
+    def hit_ratio(self) -> Optional[float]:
+        served = self.hits + self.misses
+        return self.hits / served if served else None
+
+
+@dataclass
+class OpIdStats:
+    op_id: str
+    entries: int = 0
+    size: int = 0
+    oldest: Optional[float] = None
+    newest: Optional[float] = None
+    expired: int = 0
+    fresh: int = 0
+    no_expiry: int = 0
+
+
+@dataclass
+class CacheStats:
+    entries: int = 0
+    size: int = 0
+    expired: int = 0
+    fresh: int = 0
+    no_expiry: int = 0
+    ages: Dict[str, int] = field(default_factory=dict)
+    """Entry counts by age bucket, see :data:`AGE_BUCKETS`."""
+    op_ids: List[OpIdStats] = field(default_factory=list)
+
+
+class CacheIndex:
+    """A SQLite index of the entries of one local source.
+
+    Args:
+        db_path: The index database, usually `cache-index.sqlite` in the cache
+            directory.
+    """
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._stored: Dict[Tuple[str, str], CacheEntry] = {}
+        self._accessed: Dict[Tuple[str, str], float] = {}
+        self._removed: Dict[Tuple[str, str], None] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # Changes are recorded from the event loop, never wait on the database.
+        self._buffer_lock = threading.Lock()
+
+    @classmethod
+    def in_dir(cls, root_path: Path) -> "CacheIndex":
+        return cls(root_path / Path("cache-index.sqlite"))
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            # INSERT OR REPLACE fires the delete trigger for the replaced row.
+            connection.execute("PRAGMA recursive_triggers=ON")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "op_id TEXT NOT NULL, "
+                    "param_sig TEXT NOT NULL, "
+                    "size INTEGER NOT NULL, "
+                    "stored REAL NOT NULL, "
+                    "accessed REAL NOT NULL, "
+                    "expires REAL, "
+                    "PRIMARY KEY (op_id, param_sig))"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored)"
+                )
+                self._create_summary(connection)
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS runs ("
+                    "run_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "started REAL NOT NULL, "
+                    "finished REAL, "
+                    "jobs INTEGER NOT NULL, "
+                    "fresh INTEGER NOT NULL, "
+                    "stale INTEGER NOT NULL, "
+                    "unchanged INTEGER NOT NULL, "
+                    "fetched INTEGER NOT NULL, "
+                    "errors INTEGER NOT NULL)"
+                )
+            self._connection = connection
+        return self._connection
+
+    @staticmethod
+    def _create_summary(connection: sqlite3.Connection):
+        """Entry counts and sizes by op_id, minute stored and minute of expiry.
+
+        Kept up to date by triggers, so stats read a few thousand summary rows
+        rather than every entry. An expiry minute of -1 means no expiry.
+        """
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS entry_summary ("
+            "op_id TEXT NOT NULL, "
+            "stored_minute INTEGER NOT NULL, "
+            "expires_minute INTEGER NOT NULL, "
+            "entries INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "PRIMARY KEY (op_id, stored_minute, expires_minute))"
+        )
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS entries_summary_insert "
+            "AFTER INSERT ON entries BEGIN "
+            "INSERT INTO entry_summary "
+            "(op_id, stored_minute, expires_minute, entries, size) "
+            f"VALUES (new.op_id, {SUMMARY_KEY.format(row='new')}, 1, new.size) "
+            "ON CONFLICT (op_id, stored_minute, expires_minute) DO UPDATE "
+            "SET entries = entries + 1, size = size + excluded.size; "
+            "END"
+        )
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS entries_summary_delete "
+            "AFTER DELETE ON entries BEGIN "
+            "UPDATE entry_summary SET entries = entries - 1, size = size - old.size "
+            "WHERE op_id = old.op_id "
+            f"AND (stored_minute, expires_minute) = ({SUMMARY_KEY.format(row='old')}); "
+            "DELETE FROM entry_summary WHERE entries <= 0; "
+            "END"
+        )
+
+    def exists(self) -> bool:
+        return self.db_path.exists()
+
+    def record_stored(self, entry: CacheEntry):
+        key = (entry.op_id, entry.param_sig)
+        with self._buffer_lock:
+            self._removed.pop(key, None)
+            self._stored[key] = entry
+
+    def record_accessed(self, op_id: str, param_sig: str, accessed: float):
+        with self._buffer_lock:
+            self._accessed[(op_id, param_sig)] = accessed
+
+    def record_expired_removed(self, before: float):
+        """Remove the entries that expired before `before`."""
+        self.flush()
+        with self._lock:
+            with self.connection:
+                self.connection.execute(
+                    "DELETE FROM entries WHERE expires < ?", (before,)
+                )
+
+    def record_removed(self, op_id: str, param_sig: str):
+        key = (op_id, param_sig)
+        with self._buffer_lock:
+            self._stored.pop(key, None)
+            self._accessed.pop(key, None)
+            self._removed[key] = None
+
+    def flush(self):
+        """Write the buffered changes."""
+        with self._buffer_lock:
+            stored, self._stored = self._stored, {}
+            accessed, self._accessed = self._accessed, {}
+            removed, self._removed = self._removed, {}
+        if not (stored or accessed or removed):
+            return
+        with self._lock:
+            with self.connection:
+                self._insert(stored.values())
+                self.connection.executemany(
+                    "UPDATE entries SET accessed = ? WHERE op_id = ? AND param_sig = ?",
+                    [(value, *key) for key, value in accessed.items()],
+                )
+                self.connection.executemany(
+                    "DELETE FROM entries WHERE op_id = ? AND param_sig = ?",
+                    list(removed),
+                )
+
+    def _insert(self, entries: Iterable[CacheEntry]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO entries "
+            "(op_id, param_sig, size, stored, accessed, expires) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    entry.op_id,
+                    entry.param_sig,
+                    entry.size,
+                    entry.stored,
+                    entry.last_access,
+                    entry.expires,
+                )
+                for entry in entries
+            ),
+        )
+
+    def rebuild(self, source: EsiLocalSource) -> int:
+        """Replace the indexed entries by scanning `source`.
+
+        Expiry times the scan does not provide are read from the stored results.
+        Run history is kept. Returns the number of entries indexed.
+        """
+        entries = self._scan_with_expiry(source)
+        count = 0
+        with self._buffer_lock:
+            self._stored, self._accessed, self._removed = {}, {}, {}
+        with self._lock:
+            with self.connection:
+                # Summarize once at the end, rather than row by row in triggers.
+                self.connection.execute("DROP TRIGGER entries_summary_insert")
+                self.connection.execute("DROP TRIGGER entries_summary_delete")
+                self.connection.execute("DELETE FROM entries")
+                self.connection.execute("DELETE FROM entry_summary")
+                batch: List[CacheEntry] = []
+                for entry in entries:
+                    batch.append(entry)
+                    if len(batch) >= 1000:
+                        self._insert(batch)
+                        count += len(batch)
+                        batch = []
+                self._insert(batch)
+                count += len(batch)
+                self.connection.execute(
+                    "INSERT INTO entry_summary "
+                    "(op_id, stored_minute, expires_minute, entries, size) "
+                    f"SELECT op_id, {SUMMARY_KEY.format(row='entries')}, "
+                    "count(*), sum(size) FROM entries GROUP BY 1, 2, 3"
+                )
+                self._create_summary(self.connection)
+        logger.info("Rebuilt cache index %s with %s entries.", self.db_path, count)
+        return count
+
+    @staticmethod
+    def _scan_with_expiry(source: EsiLocalSource) -> Iterator[CacheEntry]:
+        for entry in source.scan_entries():
+            if entry.expires is None:
+                try:
+                    entry.expires = source.entry_expires(entry)
+                except Exception as ex:  # pylint: disable=broad-except
+                    logger.warning(
+                        "Unreadable entry %s-%s, %s", entry.op_id, entry.param_sig, ex
+                    )
+            yield entry
+
+    def stats(self, now: Optional[float] = None) -> CacheStats:
+        """Counts, sizes, ages and expiry of the indexed entries.
+
+        Ages, and the oldest and newest times stored, are to the minute.
+        """
+        now = now if now is not None else time()
+        self.flush()
+        now_minute = int(now // 60)
+        age_columns = "".join(
+            ", total(CASE WHEN stored_minute >= ? THEN entries END)"
+            for _ in AGE_BUCKETS
+        )
+        age_cutoffs = [int((now - bound) // 60) for _, bound in AGE_BUCKETS]
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT op_id, sum(entries), sum(size), "
+                "min(stored_minute) * 60, max(stored_minute) * 60, "
+                "total(CASE WHEN expires_minute BETWEEN 0 AND ? THEN entries END), "
+                "total(CASE WHEN expires_minute > ? THEN entries END), "
+                "total(CASE WHEN expires_minute = -1 THEN entries END)"
+                f"{age_columns} FROM entry_summary GROUP BY op_id ORDER BY op_id",
+                (now_minute - 1, now_minute, *age_cutoffs),
+            ).fetchall()
+            # Entries expiring this minute need their exact expiry time.
+            boundary = dict(
+                (row[0], row[1:])
+                for row in self.connection.execute(
+                    "SELECT op_id, total(expires < ?), total(expires >= ?) "
+                    "FROM entries WHERE expires >= ? AND expires < ? GROUP BY op_id",
+                    (now, now, now_minute * 60, (now_minute + 1) * 60),
+                )
+            )
+        names = [name for name, _ in AGE_BUCKETS] + ["older"]
+        stats = CacheStats(ages={name: 0 for name in names})
+        for row in rows:
+            expired, fresh = boundary.get(row[0], (0, 0))
+            op_id_stats = OpIdStats(
+                op_id=row[0],
+                entries=row[1],
+                size=row[2],
+                oldest=row[3],
+                newest=row[4],
+                expired=int(row[5] + expired),
+                fresh=int(row[6] + fresh),
+                no_expiry=int(row[7]),
+            )
+            stats.op_ids.append(op_id_stats)
+            stats.entries += op_id_stats.entries
+            stats.size += op_id_stats.size
+            stats.expired += op_id_stats.expired
+            stats.fresh += op_id_stats.fresh
+            stats.no_expiry += op_id_stats.no_expiry
+            # The age columns count entries newer than each bound.
+            newer = 0
+            for name, count in zip(names, row[8:]):
+                stats.ages[name] += int(count) - newer
+                newer = int(count)
+            stats.ages["older"] += op_id_stats.entries - newer
+        return stats
+
+    def list_entries(
+        self,
+        op_id: Optional[str] = None,
+        expired: Optional[bool] = None,
+        limit: Optional[int] = None,
+        now: Optional[float] = None,
+    ) -> List[CacheEntry]:
+        """Indexed entries, most recently stored first.
+
+        Args:
+            op_id: Only entries for this op_id.
+            expired: Only expired entries if True, only fresh entries if False.
+            limit: The maximum number of entries.
+        """
+        now = now if now is not None else time()
+        self.flush()
+        query = "SELECT op_id, param_sig, size, stored, accessed, expires FROM entries"
+        conditions: List[str] = []
+        params: List[Any] = []
+        if op_id is not None:
+            conditions.append("op_id = ?")
+            params.append(op_id)
+        if expired is True:
+            conditions.append("expires < ?")
+            params.append(now)
+        elif expired is False:
+            conditions.append("expires >= ?")
+            params.append(now)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY stored DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [CacheEntry(*row) for row in rows]
+
+    def get_entry(self, op_id: str, param_sig: str) -> Optional[CacheEntry]:
+        self.flush()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT op_id, param_sig, size, stored, accessed, expires FROM entries "
+                "WHERE op_id = ? AND param_sig = ?",
+                (op_id, param_sig),
+            ).fetchone()
+        return CacheEntry(*row) if row is not None else None
+
+    def record_run(self, run_stats: RunStats) -> int:
+        """Save the stats of a finished run, returns its run_id."""
+        with self._lock:
+            with self.connection:
+                cursor = self.connection.execute(
+                    "INSERT INTO runs (started, finished, jobs, fresh, stale, "
+                    "unchanged, fetched, errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        run_stats.started,
+                        run_stats.finished,
+                        run_stats.jobs,
+                        run_stats.fresh,
+                        run_stats.stale,
+                        run_stats.unchanged,
+                        run_stats.fetched,
+                        run_stats.errors,
+                    ),
+                )
+        run_stats.run_id = cursor.lastrowid
+        return run_stats.run_id
+
+    def runs(self, limit: int = 10) -> List[RunStats]:
+        """The most recent runs, newest first."""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT started, finished, jobs, fresh, stale, unchanged, fetched, "
+                "errors, run_id FROM runs ORDER BY run_id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [RunStats(*row) for row in rows]
+
+    def close(self):
+        """Write the buffered changes and close the database connection."""
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,313 @@
+"""Maintenance of local sources, garbage collection and warming.
+
+Entries are removed by expiry (TTL), then by size quota, least recently used
+first. Quotas can be set for the whole cache and per op_id. Bodies shared
+between entries are removed once no entry refers to them. The scan runs in
+batches on the source thread pool, so collection can run alongside jobs.
+
+A :class:`CacheWarmer` revalidates the entries for a set of jobs ahead of a run,
+so the run itself is mostly fresh local results and 304s.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import timedelta
+from time import time
+from typing import Dict, List, Optional, Sequence
+
+from aiohttp import ClientSession
+
+from eve_esi_jobs.aiohttp_queue import AiohttpRequestQueueException, ResponseMeta
+from eve_esi_jobs.exceptions import (
+    DataUnchangedException,
+    EsiLocalSourceException,
+    EsiRemoteSourceException,
+)
+from eve_esi_jobs.models import EsiJob
+from eve_esi_jobs.sources import CacheEntry, EsiLocalSource, EsiRemoteSource
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+@dataclass
+class CachePolicy:
+    """When to remove entries from a local source.
+
+    Args:
+        expired_grace: Remove entries that expired longer ago than this. None
+            keeps expired entries, e.g. for use with a stale window.
+        max_bytes: The size quota for the whole cache. None for no quota.
+        max_bytes_per_op_id: The size quota for each op_id. None for no quota.
+        op_id_max_bytes: Size quotas for specific op_ids, overriding
+            `max_bytes_per_op_id`.
+    """
+
+    expired_grace: Optional[timedelta] = timedelta(0)
+    max_bytes: Optional[int] = None
+    max_bytes_per_op_id: Optional[int] = None
+    op_id_max_bytes: Dict[str, int] = field(default_factory=dict)
+
+    def op_id_quota(self, op_id: str) -> Optional[int]:
+        return self.op_id_max_bytes.get(op_id, self.max_bytes_per_op_id)
+
+
+@dataclass
+class GcReport:
+    scanned: int = 0
+    scanned_bytes: int = 0
+    expired: int = 0
+    evicted: int = 0
+    removed_bytes: int = 0
+    temp_files: int = 0
+    blobs: int = 0
+
+    @property
+    def removed(self) -> int:
+        return self.expired + self.evicted
+
+    def __str__(self) -> str:
+        return (
+            f"Scanned {self.scanned} entries ({self.scanned_bytes} bytes), "
+            f"removed {self.expired} expired and {self.evicted} evicted entries "
+            f"({self.removed_bytes} bytes), {self.blobs} unreferenced bodies, "
+            f"{self.temp_files} temp files."
+        )
+
+
+class CacheCollector:
+    """Apply a :class:`CachePolicy` to a local source.
+
+    Args:
+        source: The local source to collect.
+        policy: What to remove.
+        batch_size: The number of entries handled per trip to the thread pool.
+            Control returns to the event loop between batches.
+    """
+
+    def __init__(
+        self,
+        source: EsiLocalSource,
+        policy: Optional[CachePolicy] = None,
+        batch_size: int = 1000,
+    ) -> None:
+        self.source = source
+        self.policy = policy if policy is not None else CachePolicy()
+        self.batch_size = batch_size
+
+    def do_collect(self) -> GcReport:
+        """Collect from synchronous code."""
+        return asyncio.run(self.collect())
+
+    async def collect(self, now: Optional[float] = None) -> GcReport:
+        now = now if now is not None else time()
+        report = GcReport()
+        # Write buffered results from the event loop, before the scan does it from
+        # the thread pool.
+        await self.source.flush()
+        entries = await self._scan(report)
+        if self.policy.expired_grace is not None:
+            entries = await self._remove_expired(entries, now, report)
+        quotas_by_op_id: Dict[str, List[CacheEntry]] = {}
+        for entry in entries:
+            quotas_by_op_id.setdefault(entry.op_id, []).append(entry)
+        kept: List[CacheEntry] = []
+        for op_id, op_id_entries in quotas_by_op_id.items():
+            kept.extend(
+                await self._enforce_quota(
+                    op_id_entries, self.policy.op_id_quota(op_id), report
+                )
+            )
+        await self._enforce_quota(kept, self.policy.max_bytes, report)
+        report.blobs = await self.source.run_io(self.source.remove_unreferenced_blobs)
+        report.temp_files = await self.source.run_io(
+            self.source.remove_stale_temp_files
+        )
+        logger.info("Cache gc of %s: %s", self.source.root_path, report)
+        return report
+
+    async def _scan(self, report: GcReport) -> List[CacheEntry]:
+        entries: List[CacheEntry] = []
+        scanner = self.source.scan_entries()
+        while True:
+            batch = await self.source.run_io(self._next_batch, scanner)
+            if not batch:
+                break
+            entries.extend(batch)
+            report.scanned += len(batch)
+            report.scanned_bytes += sum(entry.size for entry in batch)
+        return entries
+
+    def _next_batch(self, scanner) -> List[CacheEntry]:
+        batch: List[CacheEntry] = []
+        for entry in scanner:
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                break
+        return batch
+
+    async def _remove_expired(
+        self, entries: List[CacheEntry], now: float, report: GcReport
+    ) -> List[CacheEntry]:
+        assert self.policy.expired_grace is not None
+        cutoff = now - self.policy.expired_grace.total_seconds()
+        kept: List[CacheEntry] = []
+        for start in range(0, len(entries), self.batch_size):
+            batch = entries[start : start + self.batch_size]
+            removed = await self.source.run_io(
+                self._remove_expired_batch, batch, cutoff
+            )
+            for entry in batch:
+                if id(entry) in removed:
+                    report.expired += 1
+                    report.removed_bytes += entry.size
+                else:
+                    kept.append(entry)
+        return kept
+
+    def _remove_expired_batch(self, batch: List[CacheEntry], cutoff: float):
+        removed = set()
+        for entry in batch:
+            try:
+                expires = self.source.entry_expires(entry)
+            except Exception as ex:  # pylint: disable=broad-except
+                # Unreadable entries are of no use to anyone.
+                logger.warning(
+                    "Removing unreadable entry %s-%s, %s",
+                    entry.op_id,
+                    entry.param_sig,
+                    ex,
+                )
+                expires = 0
+            if expires is not None and expires < cutoff:
+                if self.source.remove_entry(entry):
+                    removed.add(id(entry))
+        return removed
+
+    async def _enforce_quota(
+        self, entries: List[CacheEntry], quota: Optional[int], report: GcReport
+    ) -> List[CacheEntry]:
+        """Remove least recently used entries until under quota, returns the rest."""
+        total = sum(entry.size for entry in entries)
+        if quota is None or total <= quota:
+            return entries
+        entries = sorted(entries, key=lambda entry: entry.last_access)
+        evict: List[CacheEntry] = []
+        for entry in entries:
+            if total <= quota:
+                break
+            evict.append(entry)
+            total -= entry.size
+        not_removed: List[CacheEntry] = []
+        for start in range(0, len(evict), self.batch_size):
+            batch = evict[start : start + self.batch_size]
+            removed = await self.source.run_io(self._remove_batch, batch)
+            for entry in batch:
+                if id(entry) in removed:
+                    report.evicted += 1
+                    report.removed_bytes += entry.size
+                else:
+                    not_removed.append(entry)
+        return not_removed + entries[len(evict) :]
+
+    def _remove_batch(self, batch: List[CacheEntry]):
+        return {id(entry) for entry in batch if self.source.remove_entry(entry)}
+
+
+@dataclass
+class WarmReport:
+    jobs: int = 0
+    fresh: int = 0
+    """Already fresh, nothing was fetched."""
+    revalidated: int = 0
+    """Unchanged on the server, the stored result was made fresh again."""
+    updated: int = 0
+    """Fetched and stored, new or changed on the server."""
+    errors: int = 0
+
+    @property
+    def refreshed(self) -> int:
+        return self.revalidated + self.updated
+
+    def __str__(self) -> str:
+        return (
+            f"Warmed {self.jobs} jobs: {self.refreshed} refreshed "
+            f"({self.revalidated} unchanged, {self.updated} updated), "
+            f"{self.fresh} already fresh, {self.errors} errors."
+        )
+
+
+class CacheWarmer:
+    """Revalidate the stored results of jobs, without running their callbacks.
+
+    Stored results are fetched with their etag, so unchanged results cost a 304.
+    Give the remote source a low rate limit, and keep `max_workers` small, to leave
+    the request budget to other runs.
+
+    Args:
+        local_source: The local source to warm.
+        remote_source: The remote source used for fetching.
+        max_workers: The number of jobs fetched at once.
+    """
+
+    def __init__(
+        self,
+        local_source: EsiLocalSource,
+        remote_source: EsiRemoteSource,
+        max_workers: int = 2,
+    ) -> None:
+        self.local_source = local_source
+        self.remote_source = remote_source
+        self.max_workers = max_workers
+
+    async def warm(self, jobs: Sequence[EsiJob], session: ClientSession) -> WarmReport:
+        report = WarmReport(jobs=len(jobs))
+        queue: asyncio.Queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        async def consumer():
+            while not queue.empty():
+                job = queue.get_nowait()
+                await self.warm_job(job, session, report)
+
+        await asyncio.gather(*(consumer() for _ in range(self.max_workers)))
+        await self.local_source.flush()
+        logger.info("Cache warm of %s: %s", self.local_source.root_path, report)
+        return report
+
+    async def warm_job(self, job: EsiJob, session: ClientSession, report: WarmReport):
+        try:
+            async with self.local_source.fetch_lease(job):
+                local_result = await self.local_source.do_job(job)
+                if local_result is not None and self.local_source.is_fresh(
+                    local_result
+                ):
+                    report.fresh += 1
+                    return
+                etag = (
+                    local_result.response.get_response_header("etag")
+                    if local_result is not None
+                    else None
+                )
+                try:
+                    remote_result = await self.remote_source.do_job(job, session, etag)
+                except DataUnchangedException as ex:
+                    assert local_result is not None
+                    response_meta = ResponseMeta.from_exception(
+                        ex.status_exception.status_exception
+                    )
+                    await self.local_source.refresh_result(
+                        local_result, response_meta.response_headers
+                    )
+                    report.revalidated += 1
+                    return
+                await self.local_source.store_result(remote_result)
+                report.updated += 1
+        except (
+            AiohttpRequestQueueException,
+            EsiLocalSourceException,
+            EsiRemoteSourceException,
+        ) as ex:
+            logger.warning("Error warming %s %s, %s", job.op_id, job.parameters, ex)
+            report.errors += 1
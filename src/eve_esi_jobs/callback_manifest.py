@@ -1,15 +1,24 @@
 """A lookup table of valid callbacks for Esi Jobs."""
+import inspect
 import logging
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Callable, Dict, Optional, Type
+from typing import Any, Callable, Dict, Optional, Tuple, Type
 
 from eve_esi_jobs.callbacks import (
     EsiJobCallback,
+    PathTemplate,
     SaveEsiJobToJsonFile,
     SaveEsiJobToYamlFile,
     SaveJobResultToJsonFile,
+    SaveJobResultToTxtFile,
     SaveJobResultToYamlFile,
+    SaveListOfDictResultToArrowFile,
     SaveListOfDictResultToCSVFile,
+    SaveListOfDictResultToSnapshotStore,
+    SaveListOfDictResultToSqlite,
+    SaveOrderBookSummaryToCSVFile,
+    SaveResultToJsonLines,
 )
 from eve_esi_jobs.helpers import optional_object
 from eve_esi_jobs.models import EsiJob, JobCallback
@@ -17,6 +26,9 @@ from eve_esi_jobs.models import EsiJob, JobCallback
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+MAX_PLANS = 256
+"""The most callback plans a manifest keeps, the least recently used go first."""
+
 
 @dataclass
 class CallbackManifestEntry:
@@ -24,6 +36,48 @@ class CallbackManifestEntry:
     factory_function: Callable
 
 
+class CallbackPlan:
+    """A :class:`JobCallback` compiled once, to make the callbacks of many jobs.
+
+    The kwargs are checked against the factory function when the plan is made, and
+    the callbacks of a plan share one parsed :class:`PathTemplate`, so making a
+    callback for a job is a plain call, and resolving its file path only
+    substitutes the attributes the template names.
+
+    Raises:
+        TypeError: If the kwargs don't fit the factory function.
+    """
+
+    def __init__(
+        self, callback_id: str, entry: CallbackManifestEntry, kwargs: Dict[str, Any]
+    ) -> None:
+        self.callback_id = callback_id
+        self.entry = entry
+        self.kwargs = kwargs
+        try:
+            inspect.signature(entry.factory_function).bind(job=None, **kwargs)
+        except ValueError:
+            # Builtins may not have a signature, leave it to the call.
+            pass
+        self.path_template: Optional[PathTemplate] = None
+
+    def new_callback(self, job: EsiJob) -> EsiJobCallback:
+        callback = self.entry.factory_function(job=job, **self.kwargs)
+        if isinstance(callback, SaveJobResultToTxtFile):
+            path_template = self.path_template
+            if (
+                path_template is None
+                or path_template.template != str(callback.file_path_template)
+                or path_template.file_ending != callback.file_ending
+            ):
+                path_template = PathTemplate(
+                    str(callback.file_path_template), callback.file_ending
+                )
+                self.path_template = path_template
+            callback.path_template = path_template
+        return callback
+
+
 class CallbackManifest:
     def __init__(
         self, manifest_entries: Optional[Dict[str, CallbackManifestEntry]] = None
@@ -31,6 +85,8 @@ class CallbackManifest:
         self.manifest_entries: Dict[str, CallbackManifestEntry] = optional_object(
             manifest_entries, dict
         )
+        self.max_plans = MAX_PLANS
+        self._plans: "OrderedDict[Tuple[str, str], CallbackPlan]" = OrderedDict()
 
     @staticmethod
     def manifest_factory():
@@ -46,16 +102,44 @@ class CallbackManifest:
             callback=callback,
             factory_function=factory_function,
         )
+        self._plans.clear()
 
-    def init_callback(self, job_callback: JobCallback, job: EsiJob) -> EsiJobCallback:
-        entry = self.manifest_entries.get(job_callback.callback_id, None)
-        if entry is None:
-            raise ValueError(
-                f"{job_callback.callback_id} is not a registered callback."
-            )
+    def plan(self, job_callback: JobCallback) -> CallbackPlan:
+        """The compiled plan for a callback definition, made on first use.
 
+        Plans are shared by equal definitions, like the callbacks of jobs read
+        from the same workorder. At most `max_plans` are kept, so definitions
+        that differ per job don't pile up.
+        """
+        key = (job_callback.callback_id, repr(job_callback.kwargs))
+        plan = self._plans.get(key, None)
+        if plan is not None:
+            self._plans.move_to_end(key)
+        else:
+            entry = self.manifest_entries.get(job_callback.callback_id, None)
+            if entry is None:
+                raise ValueError(
+                    f"{job_callback.callback_id} is not a registered callback."
+                )
+            try:
+                plan = CallbackPlan(
+                    job_callback.callback_id, entry, dict(job_callback.kwargs)
+                )
+            except Exception as ex:
+                logger.exception(
+                    "Failed to initialize callback with %s. Did you supply the correct arguments?",
+                    job_callback.callback_id,
+                )
+                raise ex
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def init_callback(self, job_callback: JobCallback, job: EsiJob) -> EsiJobCallback:
+        plan = self.plan(job_callback)
         try:
-            callback = entry.factory_function(job=job, **job_callback.kwargs)
+            callback = plan.new_callback(job)
         except Exception as ex:
             logger.exception(
                 "Failed to initialize callback with %s. Did you supply the correct arguments?",
@@ -80,6 +164,26 @@ def new_manifest():
             callback=SaveListOfDictResultToCSVFile,
             factory_function=SaveListOfDictResultToCSVFile,
         ),
+        "save_list_of_dict_result_to_snapshot_store": CallbackManifestEntry(
+            callback=SaveListOfDictResultToSnapshotStore,
+            factory_function=SaveListOfDictResultToSnapshotStore,
+        ),
+        "save_result_to_sqlite": CallbackManifestEntry(
+            callback=SaveListOfDictResultToSqlite,
+            factory_function=SaveListOfDictResultToSqlite,
+        ),
+        "save_result_to_parquet": CallbackManifestEntry(
+            callback=SaveListOfDictResultToArrowFile,
+            factory_function=SaveListOfDictResultToArrowFile,
+        ),
+        "save_order_book_summary_to_csv_file": CallbackManifestEntry(
+            callback=SaveOrderBookSummaryToCSVFile,
+            factory_function=SaveOrderBookSummaryToCSVFile,
+        ),
+        "save_result_to_jsonl": CallbackManifestEntry(
+            callback=SaveResultToJsonLines,
+            factory_function=SaveResultToJsonLines,
+        ),
         "save_esi_job_to_json_file": CallbackManifestEntry(
             callback=SaveEsiJobToJsonFile,
             factory_function=SaveEsiJobToJsonFile,
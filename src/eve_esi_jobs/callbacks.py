@@ -1,35 +1,337 @@
+import asyncio
 import csv
+import hashlib
 import json
 import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from enum import Enum
+from functools import partial
 from pathlib import Path
 from string import Template
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, TypeVar
 
 import aiofiles
 import yaml
-from more_itertools import spy
 
+from eve_esi_jobs.aiohttp_queue import parse_http_date
+from eve_esi_jobs.columnar import (
+    FILE_FORMATS,
+    ArrowFileSink,
+    arrow_schema_from_responses,
+    check_file_format,
+)
+from eve_esi_jobs.compression import COMPRESSION_SUFFIXES, check_compression, open_text
 from eve_esi_jobs.exceptions import CallbackError
-from eve_esi_jobs.helpers import combine_dictionaries
+from eve_esi_jobs.helpers import DirectoryCache, combine_dictionaries, optional_object
 from eve_esi_jobs.models import EsiJob
+from eve_esi_jobs.order_book import (
+    DEFAULT_DEPTH_PERCENTS,
+    check_numpy,
+    summarize_order_book,
+    summary_field_names,
+)
+from eve_esi_jobs.sinks import (
+    ContentHashIndex,
+    JsonLinesSink,
+    SinkRegistry,
+    SqliteSink,
+    SqliteTable,
+    sqlite_columns_from_record,
+    sqlite_columns_from_schema,
+)
+from eve_esi_jobs.snapshots import SnapshotStore
+
+if TYPE_CHECKING:
+    from eve_esi_jobs.operation_manifest import OperationManifest
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+T = TypeVar("T")  # pylint: disable=invalid-name
+
 # pylint: disable=[useless-super-delegation,no-self-use]
 
 
+class ExecutionMode(Enum):
+    """Where a callback does its blocking work, see :class:`CallbackRunner`."""
+
+    INLINE = "inline"
+    """On the event loop, for work that is quick or already asynchronous."""
+    THREAD = "thread"
+    """In a thread pool, for blocking file access."""
+    PROCESS = "process"
+    """In a process pool, for CPU-bound serialization."""
+
+
+class CallbackRunner:
+    """Thread and process pools for the blocking work of callbacks, and the sinks
+    they share.
+
+    Arguments to process work are pickled, so callbacks pass the raw JSON of a
+    result rather than its parsed data, and parse it in the worker process. Pools
+    are started when first used. Processes are spawned, not forked, as the event
+    loop process runs threads.
+
+    A runner lasts for one run. Close it with :meth:`CallbackRunner.aclose`, which
+    also closes the sinks in :attr:`CallbackRunner.sinks`. It counts the files
+    written by file callbacks, and those skipped as unchanged. Its
+    :attr:`CallbackRunner.directories` lets file callbacks make each output
+    directory once per run.
+
+    Args:
+        max_threads: The size of the thread pool, None for the default size.
+        max_processes: The size of the process pool, None for one per CPU. 0 runs
+            process work in the thread pool instead.
+        operation_manifest: The operations of the schema, for callbacks that use
+            the response schema of their job.
+        directories: The directories known to exist, shared with other writers of
+            the run.
+    """
+
+    def __init__(
+        self,
+        max_threads: Optional[int] = None,
+        max_processes: Optional[int] = None,
+        operation_manifest: Optional["OperationManifest"] = None,
+        directories: Optional[DirectoryCache] = None,
+    ) -> None:
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self.operation_manifest = operation_manifest
+        self.directories: DirectoryCache = optional_object(directories, DirectoryCache)
+        self.sinks = SinkRegistry()
+        self.files_written = 0
+        self.files_skipped = 0
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+
+    def executor(self, mode: ExecutionMode) -> Executor:
+        if mode is ExecutionMode.PROCESS and self.max_processes != 0:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.max_processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._process_pool
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.max_threads, thread_name_prefix="esi-callback"
+            )
+        return self._thread_pool
+
+    async def run(self, mode: ExecutionMode, func: Callable[..., T], *args) -> T:
+        if mode is ExecutionMode.INLINE:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor(mode), partial(func, *args))
+
+    async def aclose(self):
+        """Close the sinks, then shut down the pools."""
+        await self.sinks.close()
+        self.close()
+
+    def close(self):
+        """Shut down the pools, waiting for running work."""
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True)
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
+
+
+def write_text(
+    file_path: Path,
+    mode: str,
+    text: str,
+    compression: Optional[str] = None,
+    compression_level: Optional[int] = None,
+):
+    with open_text(file_path, mode, compression, compression_level) as file:
+        file.write(text)
+
+
+def write_json(
+    file_path: Path,
+    mode: str,
+    raw_json: str,
+    indent: Optional[int],
+    compression: Optional[str] = None,
+    compression_level: Optional[int] = None,
+):
+    with open_text(file_path, mode, compression, compression_level) as file:
+        json.dump(json.loads(raw_json), file, indent=indent)
+
+
+def write_yaml(
+    file_path: Path,
+    mode: str,
+    raw_json: str,
+    compression: Optional[str] = None,
+    compression_level: Optional[int] = None,
+):
+    with open_text(file_path, mode, compression, compression_level) as file:
+        yaml.dump(json.loads(raw_json), file, sort_keys=False)
+
+
+def write_csv(
+    file_path: Path,
+    mode: str,
+    raw_json: str,
+    field_names: Optional[List[str]],
+    additional_fields: Optional[Dict],
+    compression: Optional[str] = None,
+    compression_level: Optional[int] = None,
+) -> List[str]:
+    """Write a list of dicts as CSV, returns the field names used.
+
+    Without `field_names`, the fields are those of the first item.
+    """
+    data: List[Dict] = json.loads(raw_json)
+    if additional_fields is not None:
+        data = [combine_dictionaries(item, [additional_fields]) for item in data]
+    if field_names is None:
+        field_names = list(data[0].keys())
+    with open_text(file_path, mode, compression, compression_level, newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=field_names)
+        writer.writeheader()
+        writer.writerows(data)
+    return field_names
+
+
+def write_order_book_summary(
+    file_path: Path,
+    mode: str,
+    raw_json: str,
+    depth_percents: List[float],
+    additional_fields: Optional[Dict],
+    compression: Optional[str] = None,
+    compression_level: Optional[int] = None,
+):
+    """Write the per-type summary of an order book as CSV."""
+    rows = summarize_order_book(json.loads(raw_json), depth_percents)
+    field_names = summary_field_names(depth_percents)
+    if additional_fields is not None:
+        rows = [combine_dictionaries(row, [additional_fields]) for row in rows]
+        field_names += [name for name in additional_fields if name not in field_names]
+    with open_text(file_path, mode, compression, compression_level, newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=field_names)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def add_snapshot(store: SnapshotStore, raw_json: str, timestamp: Optional[datetime]):
+    store.add(json.loads(raw_json), timestamp)
+
+
+class PathTemplate:
+    """A file path template, parsed once and resolved for many jobs.
+
+    Resolves like `string.Template.safe_substitute` with :func:`EsiJob.attributes`,
+    then sets the file ending like `Path.with_suffix`, but only looks up the
+    attributes the template names.
+
+    Args:
+        template: The file path template.
+        file_ending: Replaces the suffix of the resolved path, if not None.
+    """
+
+    def __init__(self, template: str, file_ending: Optional[str] = None) -> None:
+        self.template = template
+        self.file_ending = file_ending
+        self.names: List[str] = []
+        self._placeholders: List[str] = []
+        parts: List[str] = []
+        position = 0
+        for match in Template.pattern.finditer(template):
+            parts.append(self._format_literal(template[position : match.start()]))
+            name = match.group("named") or match.group("braced")
+            if match.group("escaped") is not None:
+                parts.append("$")
+            elif name is not None:
+                parts.append(f"{{{len(self.names)}}}")
+                self.names.append(name)
+                self._placeholders.append(match.group(0))
+            else:
+                parts.append(self._format_literal(match.group(0)))
+            position = match.end()
+        parts.append(self._format_literal(template[position:]))
+        self._format = "".join(parts)
+        self._constant: Optional[Path] = None
+        if not self.names:
+            self._constant = self._path(self._format.format())
+
+    @staticmethod
+    def _format_literal(text: str) -> str:
+        return text.replace("{", "{{").replace("}", "}}")
+
+    def resolve(self, job: EsiJob) -> Path:
+        if self._constant is not None:
+            return self._constant
+        values = job.template_values(self.names)
+        path_string = self._format.format(
+            *(
+                values.get(name, placeholder)
+                for name, placeholder in zip(self.names, self._placeholders)
+            )
+        )
+        return self._path(path_string)
+
+    def _path(self, path_string: str) -> Path:
+        if self.file_ending is None:
+            return Path(path_string)
+        name = path_string.rpartition("/")[2]
+        if not name or name in (".", "..") or "\\" in name:
+            # Leave the unusual cases to pathlib.
+            return Path(path_string).with_suffix(self.file_ending)
+        index = name.rfind(".")
+        if 0 < index < len(name) - 1:
+            path_string = path_string[: len(path_string) - len(name) + index]
+        return Path(path_string + self.file_ending)
+
+
 class EsiJobCallback:
+    execution_mode: ExecutionMode = ExecutionMode.INLINE
+    """Where :meth:`EsiJobCallback.run_work` runs blocking work."""
+
     def __init__(self, job: EsiJob) -> None:
         self.job = job
+        self.runner: Optional[CallbackRunner] = None
+        """Set by the job worker running the callback."""
 
     async def do_callback(self):
         raise NotImplementedError()
 
+    async def run_work(self, func: Callable[..., T], *args) -> T:
+        """Run blocking work as set by `execution_mode`.
+
+        Without a runner, work that is not inline runs in the default thread pool.
+        """
+        if self.runner is not None:
+            return await self.runner.run(self.execution_mode, func, *args)
+        if self.execution_mode is ExecutionMode.INLINE:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(func, *args))
+
 
 class SaveJobResultToTxtFile(EsiJobCallback):
-    """ """
+    """Save the result data to a file.
+
+    With `skip_unchanged`, a file that already holds the same content is not
+    written again, e.g. when a rerun gets a 304 for the result. The content is
+    recognized by a hash of the data and the options it is rendered with, kept in
+    a :class:`~eve_esi_jobs.sinks.ContentHashIndex` for the directory, shared by
+    the callbacks of a run. Without a runner there is no shared index, and the
+    file is always written. Appending always writes.
+
+    With `compression`, "gzip" or "zstd", the file is compressed as it is written,
+    off the event loop, and the compression suffix is added to its name, e.g.
+    `.json.gz`.
+    """
 
     def __init__(
         self,
@@ -37,12 +339,23 @@ class SaveJobResultToTxtFile(EsiJobCallback):
         file_path_template: str,
         mode: str = "w",
         file_ending: Optional[str] = ".txt",
+        skip_unchanged: bool = True,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
     ) -> None:
         super().__init__(job)
+        check_compression(compression)
         self.file_path: Optional[Path] = None
         self.mode = mode
         self.file_path_template = file_path_template
         self.file_ending = file_ending
+        self.skip_unchanged = skip_unchanged
+        self.compression = compression
+        self.compression_level = compression_level
+        if compression is not None and self.execution_mode is ExecutionMode.INLINE:
+            self.execution_mode = ExecutionMode.THREAD
+        self.path_template: Optional[PathTemplate] = None
+        """A parsed `file_path_template`, shared by the callbacks of a plan."""
 
     def __repr__(self) -> str:
         return (
@@ -55,38 +368,112 @@ class SaveJobResultToTxtFile(EsiJobCallback):
 
     def refine_path(self):
         """Refine the file path."""
+        if self.path_template is None:
+            self.path_template = PathTemplate(
+                str(self.file_path_template), self.file_ending
+            )
+        self.file_path = self.path_template.resolve(self.job)
+        if self.compression is not None:
+            self.file_path = self.file_path.with_name(
+                self.file_path.name + COMPRESSION_SUFFIXES[self.compression]
+            )
 
-        template = Template(str(self.file_path_template))
-        resolved_string = template.safe_substitute(self.job.attributes())
-        self.file_path = Path(resolved_string)
-        if self.file_ending is not None:
-            assert self.file_path is not None
-            self.file_path = self.file_path.with_suffix(self.file_ending)
+    def make_parent_dir(self):
+        """Make the directory of `file_path`, once per run with a runner."""
+        assert self.file_path is not None
+        if self.runner is not None:
+            self.runner.directories.make_parent(self.file_path)
+        else:
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
 
     def get_data(self) -> str:
-        """expects job.result.data to be a string."""
+        """The result data as JSON, unparsed if the result holds the raw JSON."""
         assert self.job.result is not None
-        data = json.dumps(self.job.result.data)
-        return data
+        return self.job.result.raw_json()
+
+    def source_data(self) -> str:
+        """What the file is rendered from."""
+        return self.get_data()
+
+    def render_options(self) -> Dict[str, Any]:
+        """The options that change the file rendered from the same data."""
+        return {}
+
+    def content_hash(self) -> str:
+        options = self.render_options()
+        if self.compression is not None:
+            options["compression"] = self.compression
+            options["compression_level"] = self.compression_level
+        digest = hashlib.sha256(self.__class__.__name__.encode())
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+        digest.update(self.source_data().encode())
+        return digest.hexdigest()
+
+    def content_hash_index(self) -> Optional[ContentHashIndex]:
+        if not self.skip_unchanged or self.mode != "w" or self.runner is None:
+            return None
+        assert self.file_path is not None
+        directory = self.file_path.parent
+        return self.runner.sinks.get(
+            ("content_hashes", directory.absolute()),
+            partial(ContentHashIndex, directory, self.runner.directories),
+        )
+
+    async def save_if_changed(self) -> bool:
+        """Save, unless the file already holds the same content. True if saved."""
+        assert self.file_path is not None
+        index = self.content_hash_index()
+        content_hash = self.content_hash() if index is not None else ""
+        if index is not None and await index.is_unchanged(self.file_path, content_hash):
+            if self.runner is not None:
+                self.runner.files_skipped += 1
+            logger.info("Data unchanged in %s", self.file_path)
+            return False
+        await self.save()
+        if index is not None:
+            await index.record(self.file_path, content_hash)
+        if self.runner is not None:
+            self.runner.files_written += 1
+        logger.info("Data saved to %s", self.file_path)
+        return True
 
     async def do_callback(self):
         self.refine_path()
         try:
-            assert self.file_path is not None
-            self.file_path.parent.mkdir(parents=True, exist_ok=True)
-            async with aiofiles.open(
-                str(self.file_path), mode=self.mode
-            ) as file:  # type:ignore
-                data = self.get_data()
-                await file.write(data)
-                logger.info("Data saved to %s", self.file_path)
+            self.make_parent_dir()
+            await self.save_if_changed()
         except Exception as ex:
             logger.exception("Exception saving file with %r.", self)
             raise ex
 
+    async def save(self):
+        """Write the data to `file_path`."""
+        if self.compression is not None:
+            await self.run_work(
+                write_text,
+                self.file_path,
+                self.mode,
+                self.get_data(),
+                self.compression,
+                self.compression_level,
+            )
+            return
+        async with aiofiles.open(
+            str(self.file_path), mode=self.mode
+        ) as file:  # type: ignore
+            data = self.get_data()
+            await file.write(data)
+
 
 class SaveJobResultToJsonFile(SaveJobResultToTxtFile):
-    """ """
+    """Save the result data as JSON.
+
+    By default the JSON is saved as received, without parsing it. Setting `indent`
+    formats the JSON, at the cost of parsing and dumping the data, which is done in
+    a worker process.
+    """
+
+    execution_mode = ExecutionMode.PROCESS
 
     def __init__(
         self,
@@ -94,23 +481,57 @@ class SaveJobResultToJsonFile(SaveJobResultToTxtFile):
         file_path_template: str,
         mode: str = "w",
         file_ending: str = ".json",
+        indent: Optional[int] = None,
+        skip_unchanged: bool = True,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
     ) -> None:
         super().__init__(
             job=job,
             mode=mode,
             file_path_template=file_path_template,
             file_ending=file_ending,
+            skip_unchanged=skip_unchanged,
+            compression=compression,
+            compression_level=compression_level,
         )
+        self.indent = indent
+
+    def source_data(self) -> str:
+        assert self.job.result is not None
+        return self.job.result.raw_json()
+
+    def render_options(self) -> Dict[str, Any]:
+        return {"indent": self.indent}
 
     def get_data(self) -> str:
         """expects job.result.data to be json."""
         assert self.job.result is not None
-        json_data = json.dumps(self.job.result.data, indent=2)
+        if self.indent is None:
+            return self.job.result.raw_json()
+        json_data = json.dumps(self.job.result.data, indent=self.indent)
         return json_data
 
+    async def save(self):
+        if self.indent is None:
+            await super().save()
+            return
+        assert self.job.result is not None
+        await self.run_work(
+            write_json,
+            self.file_path,
+            self.mode,
+            self.job.result.raw_json(),
+            self.indent,
+            self.compression,
+            self.compression_level,
+        )
+
 
 class SaveJobResultToYamlFile(SaveJobResultToTxtFile):
-    """ """
+    """Save the result data as YAML, converted in a worker process."""
+
+    execution_mode = ExecutionMode.PROCESS
 
     def __init__(
         self,
@@ -118,27 +539,51 @@ class SaveJobResultToYamlFile(SaveJobResultToTxtFile):
         file_path_template: str,
         mode: str = "w",
         file_ending: str = ".yaml",
+        skip_unchanged: bool = True,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
     ) -> None:
         super().__init__(
             job=job,
             mode=mode,
             file_path_template=file_path_template,
             file_ending=file_ending,
+            skip_unchanged=skip_unchanged,
+            compression=compression,
+            compression_level=compression_level,
         )
 
+    def source_data(self) -> str:
+        assert self.job.result is not None
+        return self.job.result.raw_json()
+
     def get_data(self) -> str:
         """expects job.result.data to be json."""
         assert self.job.result is not None
         yaml_data = yaml.dump(self.job.result.data, sort_keys=False)
         return yaml_data
 
+    async def save(self):
+        assert self.job.result is not None
+        await self.run_work(
+            write_yaml,
+            self.file_path,
+            self.mode,
+            self.job.result.raw_json(),
+            self.compression,
+            self.compression_level,
+        )
+
 
 class SaveListOfDictResultToCSVFile(SaveJobResultToTxtFile):
     """Save the result to a CSV file.
 
-    Expects the job.result.data to be a List[Dict].
+    Expects the job.result.data to be a List[Dict]. The CSV is written in a worker
+    process.
     """
 
+    execution_mode = ExecutionMode.PROCESS
+
     def __init__(
         self,
         job: EsiJob,
@@ -147,12 +592,18 @@ class SaveListOfDictResultToCSVFile(SaveJobResultToTxtFile):
         file_ending: str = ".csv",
         field_names: Optional[List[str]] = None,
         additional_fields: Dict = None,
+        skip_unchanged: bool = True,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
     ) -> None:
         super().__init__(
             job=job,
             mode=mode,
             file_path_template=file_path_template,
             file_ending=file_ending,
+            skip_unchanged=skip_unchanged,
+            compression=compression,
+            compression_level=compression_level,
         )
         self.field_names = field_names
         self.additional_fields = additional_fields
@@ -181,28 +632,396 @@ class SaveListOfDictResultToCSVFile(SaveJobResultToTxtFile):
             return combined_data
         return data
 
+    def source_data(self) -> str:
+        assert self.job.result is not None
+        return self.job.result.raw_json()
+
+    def render_options(self) -> Dict[str, Any]:
+        return {
+            "field_names": self.field_names,
+            "additional_fields": self.additional_fields,
+        }
+
+    async def save(self):
+        assert self.job.result is not None
+        self.field_names = await self.run_work(
+            write_csv,
+            self.file_path,
+            self.mode,
+            self.job.result.raw_json(),
+            self.field_names,
+            self.additional_fields,
+            self.compression,
+            self.compression_level,
+        )
+
     async def do_callback(self):
         self.refine_path()
         try:
-            assert self.file_path is not None
-            self.file_path.parent.mkdir(parents=True, exist_ok=True)
-            data = self.get_data()
-            if self.field_names is None:
-                first, data_iter = spy(data)
-                self.field_names = list(first[0].keys())
-                data = data_iter
-            with open(str(self.file_path), mode=self.mode) as file:
-                writer = csv.DictWriter(file, fieldnames=self.field_names)
-                writer.writeheader()
-                for item in data:
-                    writer.writerow(item)
-            logger.info("Data saved to %s", self.file_path)
+            self.make_parent_dir()
+            await self.save_if_changed()
         except Exception as ex:
             error = CallbackError(None, exception=ex, callback=self)
             logger.exception("Exception saving file with %r. Error: %s", self, error)
             raise ex
 
 
+class SaveListOfDictResultToSnapshotStore(SaveJobResultToTxtFile):
+    """Add the result to the delta-encoded history in a :class:`SnapshotStore`.
+
+    Expects the job.result.data to be a List[Dict], with `key_field` identifying a
+    record between polls. The snapshot time is the response `Date` header, so a
+    cached result handed out again, with the `Date` of the latest snapshot, is not
+    saved twice. Jobs
+    whose `file_path_template` resolves to the same directory share a store
+    through the run's :class:`CallbackRunner`.
+    """
+
+    execution_mode = ExecutionMode.THREAD
+
+    def __init__(
+        self,
+        job: EsiJob,
+        file_path_template: str,
+        key_field: str,
+        checkpoint_every: int = 100,
+        compression: Optional[str] = None,
+    ) -> None:
+        super().__init__(
+            job=job,
+            file_path_template=file_path_template,
+            file_ending=None,
+        )
+        self.key_field = key_field
+        self.checkpoint_every = checkpoint_every
+        # The store compresses its own files, its directory keeps its name.
+        self.store_compression = compression
+
+    def new_store(self) -> SnapshotStore:
+        assert self.file_path is not None
+        return SnapshotStore(
+            self.file_path,
+            key_field=self.key_field,
+            checkpoint_every=self.checkpoint_every,
+            compression=self.store_compression,
+        )
+
+    async def do_callback(self):
+        self.refine_path()
+        try:
+            assert self.file_path is not None
+            assert self.job.result is not None
+            if self.runner is None:
+                store = self.new_store()
+            else:
+                store = self.runner.sinks.get(
+                    ("snapshots", self.file_path.absolute()), self.new_store
+                )
+            timestamp = parse_http_date(
+                self.job.result.response.get_response_header("date")
+            )
+            await self.run_work(
+                add_snapshot, store, self.job.result.raw_json(), timestamp
+            )
+            logger.info("Snapshot saved to %s", self.file_path)
+        except Exception as ex:
+            error = CallbackError(None, exception=ex, callback=self)
+            logger.exception(
+                "Exception saving snapshot with %r. Error: %s", self, error
+            )
+            raise ex
+
+
+class SaveResultToJsonLines(SaveJobResultToTxtFile):
+    """Append the result data as one line of a JSON Lines file shared by many jobs.
+
+    Jobs whose `file_path_template` resolves to the same path, like all the jobs of
+    a workorder, share a buffered :class:`~eve_esi_jobs.sinks.JsonLinesSink`. The
+    sink belongs to the run's :class:`CallbackRunner`, and is closed when the run
+    ends. Each line holds the op_id, parameters and data of a job, and its
+    attributes if `include_attributes` is set. The data is written as received,
+    without parsing it.
+    """
+
+    execution_mode = ExecutionMode.THREAD
+
+    def __init__(
+        self,
+        job: EsiJob,
+        file_path_template: str,
+        file_ending: str = ".jsonl",
+        include_attributes: bool = False,
+        flush_lines: int = 1000,
+        flush_seconds: float = 5.0,
+    ) -> None:
+        super().__init__(
+            job=job,
+            mode="a",
+            file_path_template=file_path_template,
+            file_ending=file_ending,
+        )
+        self.include_attributes = include_attributes
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+
+    def get_data(self) -> str:
+        """The JSON line for the job."""
+        assert self.job.result is not None
+        line: Dict = {"op_id": self.job.op_id, "parameters": self.job.parameters}
+        if self.include_attributes:
+            line["attributes"] = self.job.attributes()
+        head = json.dumps(line, default=str)
+        raw_json = self.job.result.raw_json()
+        if "\n" in raw_json or "\r" in raw_json:
+            # Line breaks in JSON are whitespace, strings can't hold them unescaped.
+            raw_json = raw_json.replace("\n", "").replace("\r", "")
+        return f'{head[:-1]}, "data": {raw_json}}}'
+
+    async def do_callback(self):
+        self.refine_path()
+        try:
+            assert self.file_path is not None
+            line = self.get_data()
+            if self.runner is None:
+                # No run to share a sink with.
+                sink = JsonLinesSink(self.file_path)
+                sink.write(line)
+                await sink.aclose()
+                return
+            sink = self.runner.sinks.get(
+                ("jsonl", self.file_path.absolute()),
+                partial(
+                    JsonLinesSink,
+                    self.file_path,
+                    flush_lines=self.flush_lines,
+                    flush_seconds=self.flush_seconds,
+                ),
+            )
+            if sink.write(line):
+                await self.run_work(sink.write_lines, sink.take())
+        except Exception as ex:
+            error = CallbackError(None, exception=ex, callback=self)
+            logger.exception("Exception saving line with %r. Error: %s", self, error)
+            raise ex
+
+
+class SaveListOfDictResultToSqlite(SaveJobResultToTxtFile):
+    """Write the result to a table of a SQLite database shared by many jobs.
+
+    Expects the job.result.data to be a List[Dict], one row per dict. Jobs whose
+    `file_path_template` resolves to the same database share a
+    :class:`~eve_esi_jobs.sinks.SqliteSink`, which writes their rows in batched
+    transactions from a single writer. The sink belongs to the run's
+    :class:`CallbackRunner`, and is closed when the run ends. The `table` name is a
+    template of the job attributes, the op_id by default.
+
+    Columns are taken from `columns`, else from the response schema of the job's
+    operation, else from the first record written. Set `key_columns` to upsert
+    rather than append, e.g. `["order_id"]` for market orders. The table is
+    created with those columns as its primary key.
+    """
+
+    def __init__(
+        self,
+        job: EsiJob,
+        file_path_template: str,
+        table: str = "${esi_job_op_id}",
+        file_ending: str = ".sqlite",
+        columns: Optional[Dict[str, str]] = None,
+        key_columns: Optional[List[str]] = None,
+        additional_fields: Optional[Dict] = None,
+        batch_size: int = 100,
+    ) -> None:
+        super().__init__(
+            job=job,
+            mode="a",
+            file_path_template=file_path_template,
+            file_ending=file_ending,
+        )
+        self.table = table
+        self.columns = columns
+        self.key_columns = key_columns
+        self.additional_fields = additional_fields
+        self.batch_size = batch_size
+
+    def sqlite_table(self) -> SqliteTable:
+        template = Template(self.table)
+        name = template.safe_substitute(self.job.attributes())
+        columns = self.columns
+        if columns is None and self.runner is not None:
+            manifest = self.runner.operation_manifest
+            if manifest is not None:
+                columns = sqlite_columns_from_schema(
+                    manifest.op_info(self.job.op_id).responses
+                )
+                if columns is not None and self.additional_fields:
+                    columns.update(sqlite_columns_from_record(self.additional_fields))
+        return SqliteTable(name=name, columns=columns, key_columns=self.key_columns)
+
+    async def do_callback(self):
+        self.refine_path()
+        try:
+            assert self.file_path is not None
+            assert self.job.result is not None
+            table = self.sqlite_table()
+            raw_json = self.job.result.raw_json()
+            if self.runner is None:
+                # No run to share a sink with.
+                sink = SqliteSink(self.file_path, batch_size=self.batch_size)
+                await sink.put(table, raw_json, self.additional_fields)
+                await sink.aclose()
+                return
+            sink = self.runner.sinks.get(
+                ("sqlite", self.file_path.absolute()),
+                partial(SqliteSink, self.file_path, batch_size=self.batch_size),
+            )
+            await sink.put(table, raw_json, self.additional_fields)
+        except Exception as ex:
+            error = CallbackError(None, exception=ex, callback=self)
+            logger.exception("Exception saving rows with %r. Error: %s", self, error)
+            raise ex
+
+
+class SaveListOfDictResultToArrowFile(SaveJobResultToTxtFile):
+    """Collect the result into a Parquet or Feather file shared by many jobs.
+
+    Expects the job.result.data to be a List[Dict], one row per dict. Needs the
+    optional `pyarrow` package. Jobs whose `file_path_template` resolves to the same
+    path share an :class:`~eve_esi_jobs.columnar.ArrowFileSink`, which writes their
+    rows in row groups of `row_group_size` rows. The sink belongs to the run's
+    :class:`CallbackRunner`, and the file is complete when the run ends. Column
+    types come from the response schema of the job's operation, else from the
+    first record written.
+    """
+
+    execution_mode = ExecutionMode.THREAD
+
+    def __init__(
+        self,
+        job: EsiJob,
+        file_path_template: str,
+        file_format: str = "parquet",
+        file_ending: Optional[str] = None,
+        additional_fields: Optional[Dict] = None,
+        row_group_size: int = 100_000,
+        flush_results: int = 100,
+    ) -> None:
+        check_file_format(file_format)
+        super().__init__(
+            job=job,
+            mode="w",
+            file_path_template=file_path_template,
+            file_ending=file_ending or FILE_FORMATS[file_format],
+        )
+        self.file_format = file_format
+        self.additional_fields = additional_fields
+        self.row_group_size = row_group_size
+        self.flush_results = flush_results
+
+    def arrow_schema(self):
+        """The Arrow schema from the response schema, None if not known."""
+        if self.runner is None or self.runner.operation_manifest is None:
+            return None
+        responses = self.runner.operation_manifest.op_info(self.job.op_id).responses
+        return arrow_schema_from_responses(responses, self.additional_fields)
+
+    def new_sink(self) -> ArrowFileSink:
+        assert self.file_path is not None
+        return ArrowFileSink(
+            self.file_path,
+            file_format=self.file_format,
+            schema=self.arrow_schema(),
+            row_group_size=self.row_group_size,
+            flush_results=self.flush_results,
+        )
+
+    async def do_callback(self):
+        self.refine_path()
+        try:
+            assert self.file_path is not None
+            assert self.job.result is not None
+            raw_json = self.job.result.raw_json()
+            if self.runner is None:
+                # No run to share a sink with.
+                sink = self.new_sink()
+                sink.write(raw_json, self.additional_fields)
+                await sink.aclose()
+                return
+            sink = self.runner.sinks.get(
+                ("arrow", self.file_path.absolute()), self.new_sink
+            )
+            if sink.write(raw_json, self.additional_fields):
+                await self.run_work(sink.write_results, sink.take())
+        except Exception as ex:
+            error = CallbackError(None, exception=ex, callback=self)
+            logger.exception("Exception saving rows with %r. Error: %s", self, error)
+            raise ex
+
+
+class SaveOrderBookSummaryToCSVFile(SaveJobResultToTxtFile):
+    """Save a per-type summary of market orders to a CSV file.
+
+    Expects the job.result.data to be market orders, as from
+    `get_markets_region_id_orders`. Each row has the best bid and ask, the
+    spread, order counts, volumes and volume weighted prices per side, and the
+    volume within each of `depth_percents` of the best price. Needs the optional
+    `numpy` package, the summary is computed in a worker process, see
+    :mod:`eve_esi_jobs.order_book`.
+    """
+
+    execution_mode = ExecutionMode.PROCESS
+
+    def __init__(
+        self,
+        job: EsiJob,
+        file_path_template: str,
+        mode: str = "w",
+        file_ending: str = ".csv",
+        depth_percents: Optional[List[float]] = None,
+        additional_fields: Optional[Dict] = None,
+        skip_unchanged: bool = True,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+    ) -> None:
+        check_numpy()
+        super().__init__(
+            job=job,
+            mode=mode,
+            file_path_template=file_path_template,
+            file_ending=file_ending,
+            skip_unchanged=skip_unchanged,
+            compression=compression,
+            compression_level=compression_level,
+        )
+        self.depth_percents = list(
+            depth_percents if depth_percents is not None else DEFAULT_DEPTH_PERCENTS
+        )
+        self.additional_fields = additional_fields
+
+    def source_data(self) -> str:
+        assert self.job.result is not None
+        return self.job.result.raw_json()
+
+    def render_options(self) -> Dict[str, Any]:
+        return {
+            "depth_percents": self.depth_percents,
+            "additional_fields": self.additional_fields,
+        }
+
+    async def save(self):
+        assert self.job.result is not None
+        await self.run_work(
+            write_order_book_summary,
+            self.file_path,
+            self.mode,
+            self.job.result.raw_json(),
+            self.depth_percents,
+            self.additional_fields,
+            self.compression,
+            self.compression_level,
+        )
+
+
 class SaveEsiJobToJsonFile(SaveJobResultToTxtFile):
     """Save an `EsiJob` to file."""
 
@@ -212,12 +1031,18 @@ class SaveEsiJobToJsonFile(SaveJobResultToTxtFile):
         file_path_template: str,
         mode: str = "w",
         file_ending: str = ".json",
+        skip_unchanged: bool = True,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
     ) -> None:
         super().__init__(
             job=job,
             mode=mode,
             file_path_template=file_path_template,
             file_ending=file_ending,
+            skip_unchanged=skip_unchanged,
+            compression=compression,
+            compression_level=compression_level,
         )
 
     def get_data(self) -> str:
@@ -234,12 +1059,18 @@ class SaveEsiJobToYamlFile(SaveJobResultToTxtFile):
         file_path_template: str,
         mode: str = "w",
         file_ending: str = ".yaml",
+        skip_unchanged: bool = True,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
     ) -> None:
         super().__init__(
             job=job,
             mode=mode,
             file_path_template=file_path_template,
             file_ending=file_ending,
+            skip_unchanged=skip_unchanged,
+            compression=compression,
+            compression_level=compression_level,
         )
 
     def get_data(self) -> str:
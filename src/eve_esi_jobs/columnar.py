@@ -0,0 +1,269 @@
+"""Columnar output of list of dict results, as Parquet or Feather files.
+
+Needs the optional `pyarrow` package. Column types come from the swagger response
+schema of an operation where known, so integers, floats, dates and times keep
+their types instead of becoming text. Nested values are stored as JSON text.
+"""
+import asyncio
+import json
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from eve_esi_jobs.helpers import combine_dictionaries
+from eve_esi_jobs.sinks import Sink
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+FILE_FORMATS: Dict[str, str] = {"parquet": ".parquet", "feather": ".feather"}
+ESI_DATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+ESI_DATE_FORMAT = "%Y-%m-%d"
+
+
+def check_file_format(file_format: str):
+    """Raise a ValueError if the file format is unknown or unavailable."""
+    if file_format not in FILE_FORMATS:
+        raise ValueError(
+            f"Unknown file format {file_format!r}, must be one of {list(FILE_FORMATS)}"
+        )
+    if pyarrow is None:
+        raise ValueError(f"{file_format} files need the pyarrow package installed.")
+
+
+def arrow_type(property_schema: Dict[str, Any]):
+    """The Arrow type of a swagger property."""
+    schema_type = property_schema.get("type", "")
+    schema_format = property_schema.get("format", "")
+    if schema_type == "integer":
+        return pyarrow.int32() if schema_format == "int32" else pyarrow.int64()
+    if schema_type == "number":
+        return pyarrow.float32() if schema_format == "float" else pyarrow.float64()
+    if schema_type == "boolean":
+        return pyarrow.bool_()
+    if schema_type == "string" and schema_format == "date-time":
+        return pyarrow.timestamp("s", tz="UTC")
+    if schema_type == "string" and schema_format == "date":
+        return pyarrow.date32()
+    return pyarrow.string()
+
+
+def arrow_schema_from_responses(
+    responses: Dict[str, Any], additional_fields: Optional[Dict[str, Any]] = None
+):
+    """The Arrow schema for the items of a list of objects response, from an
+    operation's swagger responses, followed by any additional fields. None if the
+    200 response is not a list of objects.
+    """
+    schema = responses.get("200", {}).get("schema", {})
+    if schema.get("type") != "array":
+        return None
+    properties = schema.get("items", {}).get("properties", None)
+    if not properties:
+        return None
+    fields = [
+        (name, arrow_type(property_schema))
+        for name, property_schema in properties.items()
+    ]
+    if additional_fields:
+        fields.extend(arrow_fields_from_record(additional_fields))
+    return pyarrow.schema(fields)
+
+
+def arrow_fields_from_record(record: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    fields = []
+    for name, value in record.items():
+        if isinstance(value, bool):
+            fields.append((name, pyarrow.bool_()))
+        elif isinstance(value, int):
+            fields.append((name, pyarrow.int64()))
+        elif isinstance(value, float):
+            fields.append((name, pyarrow.float64()))
+        elif isinstance(value, datetime):
+            fields.append((name, pyarrow.timestamp("s", tz="UTC")))
+        else:
+            fields.append((name, pyarrow.string()))
+    return fields
+
+
+def arrow_array(values: List[Any], value_type):
+    """An Arrow array of JSON values. Dates and times are parsed from ESI strings,
+    unparsable ones become null."""
+    if pyarrow.types.is_timestamp(value_type) or pyarrow.types.is_date(value_type):
+        if all(value is None or isinstance(value, str) for value in values):
+            text_format = (
+                ESI_DATE_FORMAT
+                if pyarrow.types.is_date(value_type)
+                else ESI_DATE_TIME_FORMAT
+            )
+            parsed = pyarrow.compute.strptime(
+                pyarrow.array(values, pyarrow.string()),
+                format=text_format,
+                unit="s",
+                error_is_null=True,
+            )
+            return parsed.cast(value_type)
+    if pyarrow.types.is_string(value_type):
+        values = [text_value(value) for value in values]
+    return pyarrow.array(values, value_type)
+
+
+def text_value(value: Any) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def arrow_batch(records: List[Dict[str, Any]], schema):
+    """A record batch of the records. Fields without a column are left out."""
+    arrays = [
+        arrow_array([record.get(field.name) for record in records], field.type)
+        for field in schema
+    ]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ArrowFileSink(Sink):
+    """Collect list of dict results from many jobs into one Parquet or Feather file.
+
+    Results are buffered as raw JSON on the event loop with
+    :meth:`ArrowFileSink.write`, which says when the buffer is due to be written.
+    Take the buffered results with :meth:`ArrowFileSink.take`, and convert them
+    with :meth:`ArrowFileSink.write_results` in a thread. Converted rows are
+    written in row groups (record batches for Feather) of `row_group_size` rows,
+    the rest when the sink is closed. A result that can't be converted is logged
+    and counted in `errors`, the other results are still written.
+
+    Args:
+        file_path: The file written. An existing file is replaced.
+        file_format: "parquet" or "feather".
+        schema: The Arrow schema of the rows. None infers it from the first
+            record.
+        row_group_size: The number of rows per row group.
+        flush_results: Convert the buffer once it holds this many results.
+    """
+
+    def __init__(
+        self,
+        file_path: Path,
+        file_format: str = "parquet",
+        schema=None,
+        row_group_size: int = 100_000,
+        flush_results: int = 100,
+    ) -> None:
+        check_file_format(file_format)
+        self.file_path = file_path
+        self.file_format = file_format
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.flush_results = flush_results
+        self.rows_written = 0
+        self.errors = 0
+        self._buffer: List[Tuple[str, Optional[Dict[str, Any]]]] = []
+        self._pending: List[Any] = []
+        self._pending_rows = 0
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(file_path={self.file_path!r})"
+
+    def write(
+        self, raw_json: str, additional_fields: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """Buffer the JSON of a result. True if the buffer should be written."""
+        self._buffer.append((raw_json, additional_fields))
+        return len(self._buffer) >= self.flush_results
+
+    def take(self) -> List[Tuple[str, Optional[Dict[str, Any]]]]:
+        """Empty the buffer, returning its results."""
+        results, self._buffer = self._buffer, []
+        return results
+
+    def write_results(self, results: List[Tuple[str, Optional[Dict[str, Any]]]]):
+        """Convert results to rows, writing full row groups."""
+        with self._lock:
+            for raw_json, additional_fields in results:
+                try:
+                    self._convert(raw_json, additional_fields)
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.errors += 1
+                    logger.error(
+                        "Error converting a result for %s, %s. Result: %s",
+                        self.file_path,
+                        ex,
+                        raw_json[:500],
+                    )
+            while self._pending_rows >= self.row_group_size:
+                table = pyarrow.Table.from_batches(self._pending, schema=self.schema)
+                self._write_table(table.slice(0, self.row_group_size))
+                rest = table.slice(self.row_group_size)
+                self._pending = rest.to_batches()
+                self._pending_rows = rest.num_rows
+
+    def _convert(self, raw_json: str, additional_fields: Optional[Dict[str, Any]]):
+        records: List[Dict[str, Any]] = json.loads(raw_json)
+        if not records:
+            return
+        if additional_fields:
+            records = [
+                combine_dictionaries(record, [additional_fields]) for record in records
+            ]
+        schema = self.schema
+        if schema is None:
+            schema = pyarrow.schema(arrow_fields_from_record(records[0]))
+        self._pending.append(arrow_batch(records, schema))
+        self._pending_rows += len(records)
+        self.schema = schema
+
+    def _write_table(self, table):
+        if self._writer is None:
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+            if self.file_format == "parquet":
+                self._writer = pyarrow.parquet.ParquetWriter(
+                    str(self.file_path), self.schema
+                )
+            else:
+                self._writer = pyarrow.ipc.new_file(str(self.file_path), self.schema)
+        if self.file_format == "parquet":
+            self._writer.write_table(table, row_group_size=self.row_group_size)
+        else:
+            self._writer.write_table(table, max_chunksize=self.row_group_size)
+        self.rows_written += table.num_rows
+
+    def close(self):
+        """Write everything buffered and close the file, from the event loop thread."""
+        self._close(self.take())
+
+    async def aclose(self):
+        results = self.take()
+        await asyncio.get_running_loop().run_in_executor(None, self._close, results)
+
+    def _close(self, results: List[Tuple[str, Optional[Dict[str, Any]]]]):
+        try:
+            self.write_results(results)
+            with self._lock:
+                if self._pending_rows:
+                    self._write_table(
+                        pyarrow.Table.from_batches(self._pending, schema=self.schema)
+                    )
+                    self._pending = []
+                    self._pending_rows = 0
+        finally:
+            with self._lock:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+        logger.info("Wrote %s rows to %s", self.rows_written, self.file_path)
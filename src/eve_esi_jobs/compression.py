@@ -0,0 +1,97 @@
+"""Compression used for stored results and output files.
+
+gzip is always available. zstd needs the optional `zstandard` package.
+Compressed data is recognized by its magic number, so compressed and
+uncompressed data can be mixed freely.
+"""
+import gzip
+import io
+import logging
+from pathlib import Path
+from typing import Dict, Optional, TextIO
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSION_SUFFIXES: Dict[str, str] = {"gzip": ".gz", "zstd": ".zst"}
+DEFAULT_LEVELS: Dict[str, int] = {"gzip": 6, "zstd": 3}
+
+
+def check_compression(compression: Optional[str]):
+    """Raise a ValueError if the compression is unknown or unavailable."""
+    if compression is None:
+        return
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(
+            f"Unknown compression {compression!r}, "
+            f"must be one of {list(COMPRESSION_SUFFIXES)}"
+        )
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package installed.")
+
+
+def compress(
+    data: bytes, compression: Optional[str], level: Optional[int] = None
+) -> bytes:
+    """Compress data, `compression=None` returns the data unchanged."""
+    if compression is None:
+        return data
+    check_compression(compression)
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def open_text(
+    file_path: Path,
+    mode: str,
+    compression: Optional[str] = None,
+    level: Optional[int] = None,
+    newline: Optional[str] = None,
+) -> TextIO:
+    """Open a text file for writing or appending, compressed as it is written.
+
+    Appending adds a compressed frame, readers of both formats read the frames
+    as one stream. Compressed text is UTF-8. gzip output has no timestamp, so
+    the same text compresses to the same bytes.
+    """
+    if compression is None:
+        return open(  # pylint: disable=consider-using-with
+            file_path, mode=mode, newline=newline
+        )
+    check_compression(compression)
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    binary_mode = mode.replace("t", "") + "b"
+    if compression == "gzip":
+        binary = gzip.GzipFile(
+            filename=str(file_path), mode=binary_mode, compresslevel=level, mtime=0
+        )
+    else:
+        binary = zstandard.open(
+            file_path, binary_mode, cctx=zstandard.ZstdCompressor(level=level)
+        )
+    return io.TextIOWrapper(binary, encoding="utf-8", newline=newline)
+
+
+def decompress(data: bytes) -> bytes:
+    """Decompress data compressed by :func:`compress`, detected by magic number.
+
+    Data that is not compressed is returned unchanged.
+    """
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("Found zstd data, but zstandard is not installed.")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
@@ -2,18 +2,35 @@ import asyncio
 import csv
 import json
 import logging
+import sqlite3
 from asyncio import Task, create_task, gather
 from asyncio.queues import Queue
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from time import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 from uuid import uuid4
 
 import yaml
 from aiohttp import ClientSession
 from more_itertools import spy
 
+from eve_esi_jobs.aiohttp_queue import RateLimiter, ResponseMeta
+from eve_esi_jobs.cache_maintenance import CacheWarmer, WarmReport
 from eve_esi_jobs.callback_manifest import CallbackManifest, new_manifest
+from eve_esi_jobs.callbacks import CallbackRunner, ExecutionMode
 from eve_esi_jobs.exceptions import (
     CallbackError,
     DataUnchangedException,
@@ -22,9 +39,16 @@ from eve_esi_jobs.exceptions import (
     EsiRemoteSourceException,
     ValidationError,
 )
-from eve_esi_jobs.helpers import combine_dictionaries, optional_object
-from eve_esi_jobs.models import EsiJob, EsiJobResult, EsiWorkOrder, JobCallback
-from eve_esi_jobs.observers import QueueObserver
+from eve_esi_jobs.helpers import DirectoryCache, combine_dictionaries, optional_object
+from eve_esi_jobs.models import (
+    EsiJob,
+    EsiJobResult,
+    EsiWorkOrder,
+    JobCallback,
+    JobTransform,
+    transform_raw_json,
+)
+from eve_esi_jobs.observers import QueueObserver, RunStatsObserver
 from eve_esi_jobs.operation_manifest import OperationManifest
 from eve_esi_jobs.sources import EsiLocalSource, EsiRemoteSource
 
@@ -43,7 +67,26 @@ class EveEsiJobs:
         callback_manifest: Optional[CallbackManifest] = None,
         session_kwargs: Optional[Dict] = None,
         session: Optional[ClientSession] = None,
+        stale_window: Optional[timedelta] = None,
+        callback_workers: int = 4,
+        callback_queue_size: int = 100,
+        callback_threads: Optional[int] = None,
+        callback_processes: Optional[int] = None,
     ) -> None:
+        """
+        Args:
+            stale_window: See :class:`JobQueueWorker`.
+            callback_workers: The number of workers running callbacks for
+                :meth:`EveEsiJobs.job_queue_runner`. Jobs are fetched and their
+                callbacks run in separate worker pools, so slow callbacks don't
+                hold up fetching. 0 runs callbacks in the fetching worker.
+            callback_queue_size: The number of fetched jobs that can wait for their
+                callbacks. When full, fetching waits for the callbacks to catch up.
+            callback_threads: The thread pool size for callback work, see
+                :class:`~eve_esi_jobs.callbacks.CallbackRunner`.
+            callback_processes: The process pool size for callback work, 0 to run
+                it in threads.
+        """
         if local_source is None and remote_source is None and offline:
             raise ValueError("Need at least one valid source")
         if local_source is None and offline:
@@ -65,6 +108,13 @@ class EveEsiJobs:
         self.callback_manifest = optional_object(callback_manifest, new_manifest)
         self.session_kwargs = optional_object(session_kwargs, dict)
         self.session = session
+        self.stale_window = stale_window
+        self.callback_workers = callback_workers
+        self.callback_queue_size = callback_queue_size
+        self.callback_threads = callback_threads
+        self.callback_processes = callback_processes
+        self.files_written = 0
+        self.files_skipped = 0
         self.data_formats = ["json", "yaml"]
 
     def do_job(
@@ -142,6 +192,52 @@ class EveEsiJobs:
             )
         )
 
+    def warm_cache(
+        self,
+        workorder: EsiWorkOrder,
+        local_source: Optional[EsiLocalSource] = None,
+        rate: float = 2.0,
+        max_workers: int = 2,
+        override_values: Dict[str, Any] = None,
+    ) -> WarmReport:
+        """Revalidate the local source for the jobs of a workorder.
+
+        Only conditional fetches into the local source are made, callbacks are not
+        run. Uses its own rate limit of `rate` requests per second.
+
+        Args:
+            workorder: The workorder to warm the cache for.
+            local_source: The local source to warm, defaults to the runner's.
+            rate: Requests per second.
+            max_workers: The number of jobs fetched at once.
+            override_values: As for :meth:`EveEsiJobs.do_workorder`.
+        """
+        if local_source is None:
+            local_source = self.local_source
+        if local_source is None:
+            raise ValueError("Warming the cache needs a local source.")
+        if self.offline:
+            raise ValueError("Warming the cache needs a remote source.")
+        workorder.update_attributes(override=optional_object(override_values, dict))
+        for job in workorder.jobs:
+            job.update_attributes(workorder.attributes())
+        warmer = CacheWarmer(
+            local_source=local_source,
+            remote_source=EsiRemoteSource(
+                operation_manifest=self.operation_manifest,
+                limiter=RateLimiter(rate),
+            ),
+            max_workers=max_workers,
+        )
+
+        async def warm() -> WarmReport:
+            if self.session is not None:
+                return await warmer.warm(workorder.jobs, self.session)
+            async with ClientSession(**self.session_kwargs) as session:
+                return await warmer.warm(workorder.jobs, session)
+
+        return asyncio.run(warm())
+
     def create_job(
         self,
         op_id: str,
@@ -319,20 +415,34 @@ class EveEsiJobs:
     ):
         observers = optional_object(observers, list)
         override_values = optional_object(override_values, dict)
+        stats_observer = self._run_stats_observer()
+        if stats_observer is not None:
+            observers = [*observers, stats_observer]
+        callback_runner = self.new_callback_runner()
         worker = JobQueueWorker(
             local_source=self.local_source,
             remote_source=self.remote_source,
             observers=observers,
             callback_manifest=self.callback_manifest,
+            stale_window=self.stale_window,
+            callback_runner=callback_runner,
         )
         job.update_attributes(override=override_values)
         self._preprocess_job(job)
         start = datetime.now()
-        if self.session is not None:
-            await worker.do_job(job=job, queue=None, session=self.session)
-        else:
-            async with ClientSession(**self.session_kwargs) as session:
-                await worker.do_job(job=job, queue=None, session=session)
+        try:
+            if self.session is not None:
+                await worker.do_job(job=job, queue=None, session=self.session)
+                await worker.wait_for_revalidations()
+            else:
+                async with ClientSession(**self.session_kwargs) as session:
+                    await worker.do_job(job=job, queue=None, session=session)
+                    await worker.wait_for_revalidations()
+        finally:
+            await self._close_callback_runner(callback_runner)
+        if self.local_source is not None:
+            await self.local_source.flush()
+        await self._record_run(stats_observer, 1)
         end = datetime.now()
         logger.info(
             "EsiJob(uid=%s, op_id=%s) took %s",
@@ -350,7 +460,14 @@ class EveEsiJobs:
     ):
         observers = optional_object(observers, list)
         override_values = optional_object(override_values, dict)
+        stats_observer = self._run_stats_observer()
+        if stats_observer is not None:
+            observers = [*observers, stats_observer]
         worker_count = get_worker_count(len(jobs), max_workers=max_workers)
+        callback_queue: Optional[Queue] = None
+        if self.callback_workers > 0:
+            callback_queue = Queue(maxsize=self.callback_queue_size)
+        callback_runner = self.new_callback_runner()
         workers: List[JobQueueWorker] = []
         for _ in range(worker_count):
             workers.append(
@@ -359,8 +476,23 @@ class EveEsiJobs:
                     remote_source=self.remote_source,
                     observers=observers,
                     callback_manifest=self.callback_manifest,
+                    stale_window=self.stale_window,
+                    callback_queue=callback_queue,
+                    callback_runner=callback_runner,
                 )
             )
+        callback_workers: List[JobQueueWorker] = []
+        if callback_queue is not None:
+            for _ in range(self.callback_workers):
+                callback_workers.append(
+                    JobQueueWorker(
+                        local_source=self.local_source,
+                        remote_source=self.remote_source,
+                        observers=observers,
+                        callback_manifest=self.callback_manifest,
+                        callback_runner=callback_runner,
+                    )
+                )
         queue: Queue = Queue()
         worker_tasks: List[Task] = []
         for job in jobs:
@@ -368,33 +500,100 @@ class EveEsiJobs:
             self._preprocess_job(job)
             queue.put_nowait(job)
         start = datetime.now()
-        if self.session is not None:
+
+        async def run(session: ClientSession):
+            if callback_queue is not None:
+                for callback_worker in callback_workers:
+                    worker_tasks.append(
+                        create_task(callback_worker.callback_consumer(callback_queue))
+                    )
             for worker in workers:
                 worker_tasks.append(
-                    create_task(worker.consumer(queue=queue, session=self.session))
+                    create_task(worker.consumer(queue=queue, session=session))
                 )
-                await queue.join()
-        else:
-            async with ClientSession(**self.session_kwargs) as session:
-                for worker in workers:
-                    worker_tasks.append(
-                        create_task(worker.consumer(queue=queue, session=session))
-                    )
-                    await queue.join()
-        for worker_task in worker_tasks:
-            worker_task.cancel()
-        await gather(*worker_tasks, return_exceptions=True)  # TODO read about return ex
+            await queue.join()
+            for worker in workers:
+                await worker.wait_for_revalidations()
+            if callback_queue is not None:
+                await callback_queue.join()
+
+        try:
+            if self.session is not None:
+                await run(self.session)
+            else:
+                async with ClientSession(**self.session_kwargs) as session:
+                    await run(session)
+        finally:
+            for worker_task in worker_tasks:
+                worker_task.cancel()
+            # TODO read about return ex
+            await gather(*worker_tasks, return_exceptions=True)
+            await self._close_callback_runner(callback_runner)
+        if self.local_source is not None:
+            await self.local_source.flush()
+        await self._record_run(stats_observer, len(jobs))
         end = datetime.now()
         took = end - start
         logger.info(
             "%s Jobs concurrently completed - took %s, "
-            "%s Jobs per second using %s workers.",
+            "%s Jobs per second using %s workers and %s callback workers.",
             len(jobs),
             took,
             f"{(len(jobs)/took.total_seconds()):.2f}",
-            len(worker_tasks),
+            len(workers),
+            len(callback_workers),
+        )
+        if self.local_source is not None:
+            logger.info(
+                "%s requests avoided with fresh local results.",
+                self.local_source.requests_avoided,
+            )
+
+    def new_callback_runner(self) -> CallbackRunner:
+        """The executors for the callback work of one run.
+
+        The run's cache of directories known to exist is shared with the local
+        source, so each output directory is made once per run.
+        """
+        directories = DirectoryCache()
+        if self.local_source is not None:
+            self.local_source.use_directories(directories)
+        return CallbackRunner(
+            max_threads=self.callback_threads,
+            max_processes=self.callback_processes,
+            operation_manifest=self.operation_manifest,
+            directories=directories,
+        )
+
+    async def _close_callback_runner(self, callback_runner: CallbackRunner):
+        await callback_runner.aclose()
+        self.files_written += callback_runner.files_written
+        self.files_skipped += callback_runner.files_skipped
+        logger.info(
+            "%s files written, %s unchanged files skipped.",
+            callback_runner.files_written,
+            callback_runner.files_skipped,
         )
 
+    def _run_stats_observer(self) -> Optional[RunStatsObserver]:
+        """Watch the run for the cache index, if the local source keeps one."""
+        if self.local_source is None or self.local_source.index is None:
+            return None
+        return RunStatsObserver()
+
+    async def _record_run(self, stats_observer: Optional[RunStatsObserver], jobs: int):
+        if stats_observer is None:
+            return
+        assert self.local_source is not None and self.local_source.index is not None
+        stats_observer.stats.jobs = jobs
+        stats_observer.stats.finished = time()
+        try:
+            await self.local_source.run_io(
+                self.local_source.index.record_run, stats_observer.stats
+            )
+        except sqlite3.Error as ex:
+            logger.exception("Error recording run stats. %r", ex)
+
 
 class JobQueueWorker:
     def __init__(
@@ -404,7 +603,23 @@ class JobQueueWorker:
         # session: ClientSession,
         observers: Optional[List[QueueObserver]] = None,
         callback_manifest: Optional[CallbackManifest] = None,
+        stale_window: Optional[timedelta] = None,
+        callback_queue: Optional[Queue] = None,
+        callback_runner: Optional[CallbackRunner] = None,
     ) -> None:
+        """
+        Args:
+            stale_window: Enables stale-while-revalidate. A local result that expired
+                less than `stale_window` ago is handed to the callbacks immediately,
+                and revalidated with the server in the background. Callbacks are only
+                run again if the data changed.
+            callback_queue: Hand fetched jobs and their results to this queue for
+                their callbacks, see :meth:`JobQueueWorker.callback_consumer`, rather
+                than running them before fetching the next job. Waits while the
+                queue is full.
+            callback_runner: The executors used by callbacks for blocking work.
+                Without one, callbacks use the default thread pool.
+        """
         if local_source is None and remote_source is None:
             raise ValueError("Must have at least one valid data source.")
 
@@ -415,6 +630,10 @@ class JobQueueWorker:
         # self.session = session
         self.observers = optional_object(observers, list)
         self.callback_manifest = optional_object(callback_manifest, new_manifest)
+        self.stale_window = stale_window
+        self.callback_queue = callback_queue
+        self.callback_runner = callback_runner
+        self.revalidations: Set[Task] = set()
 
     def update_observers(
         self,
@@ -443,6 +662,25 @@ class JobQueueWorker:
                 queue.task_done()
                 raise ex
 
+    async def callback_consumer(self, queue: Queue):
+        """Run the callbacks of the jobs handed over by fetching workers.
+
+        Queue items are a job and the result its callbacks get, as the result of
+        the job may be replaced before the callbacks run, e.g. by a revalidation.
+        """
+        while True:
+            job, result = await queue.get()
+            try:
+                await self.run_callbacks(job, result)
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.exception(
+                    "Exception %s trapped in callback worker for job %s",
+                    ex,
+                    str(job)[:500],
+                )
+            finally:
+                queue.task_done()
+
     async def from_local_source(self, job: EsiJob) -> Optional[EsiJobResult]:
         if self.local_source is not None:
             try:
@@ -471,26 +709,40 @@ class JobQueueWorker:
                 queue.task_done()
             return
         if local_result is not None:
+            assert self.local_source is not None
+            if self.local_source.is_fresh(local_result):
+                # Still fresh per Expires/Cache-Control, no need to ask the server.
+                self.local_source.requests_avoided += 1
+                self.update_observers(job=job, result=local_result, msg="Fresh Local")
+                job.result = local_result
+                await self._do_callbacks(job)
+                if queue is not None:
+                    queue.task_done()
+                return
+            if session is not None and self.within_stale_window(local_result):
+                # Serve the stale result now, revalidate in the background.
+                self.update_observers(job=job, result=local_result, msg="Stale Local")
+                job.result = local_result
+                await self._do_callbacks(job)
+                revalidation = create_task(
+                    self._revalidate(
+                        job=job, local_result=local_result, session=session
+                    )
+                )
+                self.revalidations.add(revalidation)
+                revalidation.add_done_callback(self.revalidations.discard)
+                if queue is not None:
+                    queue.task_done()
+                return
             etag = local_result.response.get_response_header("etag")
         else:
             etag = None
         if self.remote_source is not None and session is not None:
-            try:
-                remote_result = await self.remote_source.do_job(job, session, etag)
-                job.result = remote_result
-                self.update_observers(job=job, result=remote_result)
-                if self.local_source is not None:
-                    await self.local_source.store_result(remote_result)
-            except DataUnchangedException as ex:
-                # use local result
-                job.result = local_result
-            except EsiRemoteSourceException as ex:
-                self.update_observers(
-                    job=job,
-                    result=None,
-                    msg=f"Expected a result from the server, but there was an error. {ex}",
-                )
-                logger.exception("Error getting job data from Eve Esi, %s", ex)
+            async with self._fetch_lease(job) as shared_result:
+                if shared_result is not None:
+                    job.result = shared_result
+                else:
+                    await self._from_remote_source(job, session, local_result, etag)
         else:
             job.result = local_result
         if job.result is not None:
@@ -498,23 +750,221 @@ class JobQueueWorker:
         if queue is not None:
             queue.task_done()
 
+    @asynccontextmanager
+    async def _fetch_lease(self, job: EsiJob) -> AsyncIterator[Optional[EsiJobResult]]:
+        """Hold the local source fetch lease for a job while fetching it.
+
+        Yields a fresh local result if another process stored one while this worker
+        waited for the lease, otherwise None.
+        """
+        if self.local_source is None:
+            yield None
+            return
+        async with self.local_source.fetch_lease(job) as waited:
+            if waited:
+                shared_result = await self.from_local_source(job)
+                if shared_result is not None and self.local_source.is_fresh(
+                    shared_result
+                ):
+                    self.local_source.requests_avoided += 1
+                    self.update_observers(
+                        job=job, result=shared_result, msg="Fresh Shared"
+                    )
+                    yield shared_result
+                    return
+            yield None
+
+    async def _from_remote_source(
+        self,
+        job: EsiJob,
+        session: ClientSession,
+        local_result: Optional[EsiJobResult],
+        etag: Optional[str],
+    ):
+        assert self.remote_source is not None
+        try:
+            remote_result = await self.remote_source.do_job(job, session, etag)
+            job.result = remote_result
+            self.update_observers(job=job, result=remote_result, msg="From Remote")
+            if self.local_source is not None:
+                await self.local_source.store_result(remote_result)
+        except DataUnchangedException as ex:
+            # use local result
+            job.result = local_result
+            assert local_result is not None
+            self.update_observers(job=job, result=local_result, msg="Unchanged")
+            await self._refresh_local_result(local_result, ex)
+        except EsiRemoteSourceException as ex:
+            self.update_observers(
+                job=job,
+                result=None,
+                msg=f"Expected a result from the server, but there was an error. {ex}",
+            )
+            logger.exception("Error getting job data from Eve Esi, %s", ex)
+
+    def within_stale_window(self, local_result: EsiJobResult) -> bool:
+        """True if an expired local result may still be served while revalidating."""
+        if self.stale_window is None:
+            return False
+        expires = local_result.response.expires_at()
+        if expires is None:
+            return False
+        return datetime.now(timezone.utc) < expires + self.stale_window
+
+    async def wait_for_revalidations(self):
+        """Wait for any background revalidations to finish."""
+        if self.revalidations:
+            await gather(*self.revalidations, return_exceptions=True)
+
+    async def _revalidate(
+        self, job: EsiJob, local_result: EsiJobResult, session: ClientSession
+    ):
+        """Revalidate a stale result, running the callbacks again if it changed.
+
+        Holds the fetch lease like a foreground fetch, so processes sharing the
+        local source revalidate a result once. A fresh result stored by another
+        process meanwhile is used without asking the server.
+        """
+        async with self._fetch_lease(job) as shared_result:
+            if shared_result is not None:
+                new_result: Optional[EsiJobResult] = shared_result
+            else:
+                new_result = await self._revalidated_result(job, local_result, session)
+        if new_result is None:
+            return
+        # Identical JSON needs no parsing to compare.
+        if (
+            new_result.raw_json() != local_result.raw_json()
+            and new_result.data != local_result.data
+        ):
+            job.result = new_result
+            await self._do_callbacks(job)
+
+    async def _revalidated_result(
+        self, job: EsiJob, local_result: EsiJobResult, session: ClientSession
+    ) -> Optional[EsiJobResult]:
+        """The result from the server, stored, or None if unchanged or failed."""
+        assert self.remote_source is not None
+        etag = local_result.response.get_response_header("etag")
+        try:
+            remote_result = await self.remote_source.do_job(job, session, etag)
+        except DataUnchangedException as ex:
+            await self._refresh_local_result(local_result, ex)
+            return None
+        except EsiRemoteSourceException as ex:
+            self.update_observers(
+                job=job,
+                result=None,
+                msg=f"Error revalidating a stale local result. {ex}",
+            )
+            logger.exception("Error revalidating job data with Eve Esi, %s", ex)
+            return None
+        self.update_observers(job=job, result=remote_result, msg="Revalidated")
+        if self.local_source is not None:
+            await self.local_source.store_result(remote_result)
+        return remote_result
+
+    async def _refresh_local_result(
+        self, local_result: EsiJobResult, ex: DataUnchangedException
+    ):
+        """Keep the cache headers from a 304, so the local result is fresh again."""
+        if self.local_source is None:
+            return
+        response_meta = ResponseMeta.from_exception(
+            ex.status_exception.status_exception
+        )
+        try:
+            await self.local_source.refresh_result(
+                local_result, response_meta.response_headers
+            )
+        except EsiLocalSourceException as error:
+            logger.exception("Error refreshing local result. %r", error)
+
     async def _do_callbacks(self, job: EsiJob):
+        """Hand a job to the callback queue, or run its callbacks if there is none."""
+        if self.callback_queue is not None:
+            await self.callback_queue.put((job, job.result))
+            return
+        await self.run_callbacks(job, job.result)
+
+    async def run_callbacks(self, job: EsiJob, result: Optional[EsiJobResult] = None):
         """Do job callbacks after a successful retrieval
 
         intent is to report collected errors from callbacks to observer.
         one callbacks error will not stop other callbacks.
+
+        Callbacks run concurrently, stage by stage, see :class:`JobCallback`. They
+        get `result`, by default the result of the job. A job with a
+        :class:`~eve_esi_jobs.models.JobTransform` has the result transformed first,
+        and its callbacks are not run if that fails. The job itself is not
+        changed, callbacks get a copy of it with the result they are run for.
         """
-        for job_callback in job.callbacks:
-            errors: List[Exception] = []
+        if result is None:
+            result = job.result
+        if job.transform is not None and result is not None:
             try:
-                callback = self.callback_manifest.init_callback(job_callback, job)
-                await callback.do_callback()
+                result = await self._transformed_result(job.transform, result)
             except Exception as ex:
-                error = CallbackError(None, exception=ex, callback=callback)
-                logger.exception("Exception during %r, %r", job_callback, error)
-                errors.append(error)
-            finally:
-                self.update_observers(job=job, result=None, exceptions=errors)
+                logger.exception("Exception transforming the result of %r", job)
+                self.update_observers(job=job, result=None, exceptions=[ex])
+                return
+        callback_job = job
+        if result is not job.result:
+            callback_job = job.copy(update={"result": result})
+        stages: Dict[int, List[JobCallback]] = {}
+        for job_callback in job.callbacks:
+            stages.setdefault(job_callback.stage, []).append(job_callback)
+        for stage in sorted(stages):
+            await gather(
+                *(
+                    self._run_callback(job, callback_job, job_callback)
+                    for job_callback in stages[stage]
+                )
+            )
+
+    async def _transformed_result(
+        self, transform: JobTransform, result: EsiJobResult
+    ) -> EsiJobResult:
+        """A new result with the transformed data.
+
+        The result may be shared with the local source and other jobs, so it is
+        replaced, not modified. The transform works on the raw JSON, where its
+        `execution_mode` says.
+        """
+        raw_json = result.raw_json()
+        mode = ExecutionMode(transform.execution_mode)
+        if self.callback_runner is not None:
+            transformed = await self.callback_runner.run(
+                mode, transform_raw_json, transform, raw_json
+            )
+        elif mode is ExecutionMode.INLINE:
+            transformed = transform_raw_json(transform, raw_json)
+        else:
+            transformed = await asyncio.get_running_loop().run_in_executor(
+                None, transform_raw_json, transform, raw_json
+            )
+        return EsiJobResult.from_raw(
+            op_id=result.op_id,
+            param_sig=result.param_sig,
+            response=result.response,
+            raw=transformed,
+        )
+
+    async def _run_callback(
+        self, job: EsiJob, callback_job: EsiJob, job_callback: JobCallback
+    ):
+        errors: List[Exception] = []
+        callback = None
+        try:
+            callback = self.callback_manifest.init_callback(job_callback, callback_job)
+            callback.runner = self.callback_runner
+            await callback.do_callback()
+        except Exception as ex:
+            error = CallbackError(None, exception=ex, callback=callback)
+            logger.exception("Exception during %r, %r", job_callback, error)
+            errors.append(error)
+        finally:
+            self.update_observers(job=job, result=None, exceptions=errors)
 
 
 def get_worker_count(job_count, max_workers: int = 100) -> int:
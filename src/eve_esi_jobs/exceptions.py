@@ -23,7 +23,10 @@ class BadOpId(Exception):
 
 class CallbackError(Exception):
     def __init__(
-        self, msg: Optional[str], exception: Exception, callback: "EsiJobCallback"
+        self,
+        msg: Optional[str],
+        exception: Exception,
+        callback: Optional["EsiJobCallback"],
     ) -> None:
         if msg is None:
             message = (
@@ -1,5 +1,14 @@
 import logging
-from typing import Any, Callable, Dict, Optional, Sequence, TypeVar, Union
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Sequence, Set, TypeVar, Union
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+    import msvcrt
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -85,3 +94,139 @@ def nested_dict(top_dict: Dict, keys: list[str]) -> Optional[Any]:
         if result is None:
             return result
     return result
+
+
+class DirectoryCache:
+    """Directories known to exist, so writers make each one once.
+
+    Meant to last for a run, shared by the writers of the run. A directory removed
+    during the run is not made again, :meth:`DirectoryCache.clear` forgets them
+    all. Safe to use from threads, the worst case is making a directory twice.
+    """
+
+    def __init__(self) -> None:
+        self._known: Set[Path] = set()
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def __contains__(self, directory: Path) -> bool:
+        return directory in self._known
+
+    def make(self, directory: Path):
+        """Make a directory and its parents, unless already known to exist."""
+        if directory in self._known:
+            return
+        directory.mkdir(parents=True, exist_ok=True)
+        self._known.add(directory)
+
+    def make_parent(self, file_path: Path):
+        self.make(file_path.parent)
+
+    def clear(self):
+        self._known = set()
+
+
+def atomic_write(
+    file_path: Path,
+    data: Union[str, bytes],
+    directories: Optional[DirectoryCache] = None,
+):
+    """Write a file so readers see either the old or the new contents, never a mix.
+
+    The data is written to a temporary file in the same directory, then renamed
+    over the destination. Makes parent directories as needed, once per run with
+    `directories`.
+    """
+    if directories is not None:
+        directories.make_parent(file_path)
+    else:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = file_path.with_name(f".{file_path.name}.{uuid4().hex}.tmp")
+    try:
+        if isinstance(data, bytes):
+            temp_path.write_bytes(data)
+        else:
+            temp_path.write_text(data)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+class FileLock:
+    """An advisory, non-blocking lock on a file, shared between processes.
+
+    Uses `flock` where available, and `msvcrt.locking` on Windows. The lock file is
+    created as needed, and its modified time set whenever the lock is taken. Remove
+    an unused lock file with :meth:`FileLock.try_remove`, a holder checks that it
+    locked the file still at the lock path, so removing it doesn't split waiters
+    between two files. Locks are released when the process exits.
+    """
+
+    def __init__(self, lock_path: Path) -> None:
+        self.lock_path = lock_path
+        self._fd: Optional[int] = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        """Take the lock if it is free, returns False if another holder has it."""
+        if self._fd is not None:
+            return True
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            file_descriptor = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:  # pragma: no cover
+                    msvcrt.locking(file_descriptor, msvcrt.LK_NBLCK, 1)
+            except OSError:
+                os.close(file_descriptor)
+                return False
+            if self._is_at_lock_path(file_descriptor):
+                break
+            # Removed while it was being locked, lock the file now at the path.
+            os.close(file_descriptor)
+        self._fd = file_descriptor
+        try:
+            if os.utime in os.supports_fd:
+                os.utime(file_descriptor)
+            else:  # pragma: no cover
+                os.utime(self.lock_path)
+        except OSError as ex:
+            logger.debug("Unable to touch %s, %s", self.lock_path, ex)
+        return True
+
+    def _is_at_lock_path(self, file_descriptor: int) -> bool:
+        try:
+            return os.fstat(file_descriptor).st_ino == os.stat(self.lock_path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def try_remove(self) -> bool:
+        """Remove the lock file unless another holder has it, True if removed."""
+        if not self.try_acquire():
+            return False
+        try:
+            self.lock_path.unlink()
+        except FileNotFoundError:
+            return False
+        finally:
+            self.release()
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:  # pragma: no cover
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
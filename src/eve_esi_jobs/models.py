@@ -1,12 +1,18 @@
 import json
 import logging
+import operator
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
 from uuid import NAMESPACE_DNS, UUID, uuid4, uuid5
 
 import yaml
-from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+from pydantic import (  # pylint: disable=no-name-in-module
+    BaseModel,
+    Field,
+    PrivateAttr,
+    validator,
+)
 
 from eve_esi_jobs.aiohttp_queue import ResponseMeta
 from eve_esi_jobs.helpers import combine_dictionaries
@@ -14,6 +20,14 @@ from eve_esi_jobs.helpers import combine_dictionaries
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+WHITESPACE = " \t\n\r"
+
+
+def skip_whitespace(text: str, index: int) -> int:
+    while index < len(text) and text[index] in WHITESPACE:
+        index += 1
+    return index
+
 
 class SerializeMixin:
     """Provides serialization and deserialization functions for pydantic models."""
@@ -85,10 +99,14 @@ class JobCallback(BaseModel, SerializeMixin):
         kwargs (Dict[str, Any]): A dict used to init the callback
         config (Dict[str, Any]): A dict of values used in the factory function
             used to build the callback.
+        stage (int): Callbacks of a job run concurrently, stage by stage in
+            ascending order. Give a callback a later stage than the callbacks it
+            depends on.
     """
 
     callback_id: str
     kwargs: Dict[str, Any] = {}
+    stage: int = 0
 
     class Config:
         extra = "forbid"
@@ -98,17 +116,237 @@ class EsiJobResult(BaseModel, SerializeMixin):
     """
     The result of an executed :class:`EsiJob`.
 
-
+    A result made with :meth:`EsiJobResult.from_raw` holds the JSON body as
+    received, and `data` is parsed from it on first use. Consumers that only need
+    the JSON, like the local sources and :class:`SaveJobResultToJsonFile`, use
+    :meth:`EsiJobResult.raw_json` and never parse it. Parsed data should not be
+    modified in place, the raw JSON would no longer match it.
     """
 
     op_id: str
     param_sig: UUID
     response: ResponseMeta
-    data: Any
+    data_: Any = Field(None, alias="data")
+    _raw: Union[str, bytes, None] = PrivateAttr(None)
+
+    class Config:
+        extra = "forbid"
+        allow_population_by_field_name = True
+
+    @classmethod
+    def from_raw(
+        cls,
+        op_id: str,
+        param_sig: UUID,
+        response: ResponseMeta,
+        raw: Union[str, bytes],
+    ) -> "EsiJobResult":
+        """Make a result from an unparsed JSON body."""
+        result = cls(op_id=op_id, param_sig=param_sig, response=response)
+        result._raw = raw
+        return result
+
+    @property
+    def data(self) -> Any:
+        if self._raw is not None and self.data_ is None:
+            # Bypass validation, the value is cached, not set.
+            self.__dict__["data_"] = json.loads(self._raw)
+        return self.data_
+
+    @data.setter
+    def data(self, value: Any):
+        self._raw = None
+        self.data_ = value
+
+    @property
+    def is_parsed(self) -> bool:
+        """False if the data has not been parsed from the raw JSON yet."""
+        return self._raw is None or self.data_ is not None
+
+    def __setattr__(self, name, value):
+        if name == "data":
+            object.__setattr__(self, name, value)
+            return
+        super().__setattr__(name, value)
+
+    def raw_json(self) -> str:
+        """The data as JSON, without parsing or dumping it where possible."""
+        if self._raw is None:
+            return json.dumps(self.data_)
+        if isinstance(self._raw, bytes):
+            self._raw = self._raw.decode()
+        return self._raw
+
+    def dict(self, **kwargs):  # pylint: disable=arguments-differ
+        self.data  # pylint: disable=pointless-statement
+        kwargs["by_alias"] = True
+        return super().dict(**kwargs)
+
+    def json(self, **kwargs):  # pylint: disable=arguments-differ
+        self.data  # pylint: disable=pointless-statement
+        kwargs["by_alias"] = True
+        return super().json(**kwargs)
+
+    def serialize_raw(self) -> str:
+        """Serialize to JSON, with the raw JSON used for `data`.
+
+        The data is not parsed, and is always the last key. See
+        :meth:`EsiJobResult.deserialize_raw`.
+        """
+        envelope = super().json(exclude={"data_"}, exclude_defaults=True)
+        return f'{envelope[:-1]},"data":{self.raw_json()}}}'
+
+    @classmethod
+    def deserialize_raw(cls, json_string: Union[str, bytes]) -> "EsiJobResult":
+        """Deserialize JSON with `data` as the last key, without parsing `data`.
+
+        Falls back to parsing everything if `data` is not last.
+        """
+        if isinstance(json_string, bytes):
+            json_string = json_string.decode()
+        decoder = json.JSONDecoder()
+        envelope: Dict[str, Any] = {}
+        index = skip_whitespace(json_string, 0)
+        if json_string[index : index + 1] != "{":
+            return cls.deserialize_json(json_string)
+        index += 1
+        while True:
+            index = skip_whitespace(json_string, index)
+            key, index = decoder.raw_decode(json_string, index)
+            index = skip_whitespace(json_string, index)
+            if json_string[index : index + 1] != ":":
+                return cls.deserialize_json(json_string)
+            index = skip_whitespace(json_string, index + 1)
+            if key == "data":
+                raw = json_string[index:].rstrip()
+                if not raw.endswith("}"):
+                    return cls.deserialize_json(json_string)
+                return cls.from_raw(raw=raw[:-1].rstrip(), **envelope)
+            envelope[key], index = decoder.raw_decode(json_string, index)
+            index = skip_whitespace(json_string, index)
+            if json_string[index : index + 1] != ",":
+                # No data, or data was not the last key.
+                return cls.deserialize_json(json_string)
+            index += 1
+
+
+ROW_FILTER_OPS: Dict[str, Callable[[Any, Any], bool]] = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "le": operator.le,
+    "gt": operator.gt,
+    "ge": operator.ge,
+    "in": lambda value, values: value in values,
+    "not_in": lambda value, values: value not in values,
+}
+"""The comparisons usable in a :class:`RowFilter`."""
+
+TRANSFORM_EXECUTION_MODES = ("inline", "thread", "process")
+"""Where a :class:`JobTransform` may run, see `eve_esi_jobs.callbacks.ExecutionMode`."""
+
+
+class RowFilter(BaseModel, SerializeMixin):
+    """
+    Keep the rows of a result whose `field` compares to `value`.
+
+    Args:
+        field (str): The field compared.
+        op (str): One of "eq", "ne", "lt", "le", "gt", "ge", "in" or "not_in".
+        value (Any): The value compared to, a list for "in" and "not_in".
+    """
+
+    field: str
+    op: str = "eq"
+    value: Any = None
 
     class Config:
         extra = "forbid"
 
+    @validator("op")
+    def check_op(cls, op):  # pylint: disable=no-self-argument
+        if op not in ROW_FILTER_OPS:
+            raise ValueError(f"op must be one of {list(ROW_FILTER_OPS)}, got {op!r}")
+        return op
+
+    def matches(self, row: Dict[str, Any]) -> bool:
+        """False if the row has no such field, or it cannot be compared."""
+        if self.field not in row:
+            return False
+        try:
+            return bool(ROW_FILTER_OPS[self.op](row[self.field], self.value))
+        except TypeError:
+            return False
+
+
+class JobTransform(BaseModel, SerializeMixin):
+    """
+    A transform of the result data of a job, done once before its callbacks, which
+    all get the transformed data.
+
+    Rows of a list of dict result are kept if they match all the `filters`, then
+    cut down to the `fields`, then the fields are renamed. A dict result only has
+    its fields selected and renamed. Other data is left as it is.
+
+    Args:
+        fields (Optional[List[str]]): The fields kept, in order. None keeps all.
+        filters (List[RowFilter]): The filters a row must match to be kept.
+        rename (Dict[str, str]): New names of fields, by old name.
+        execution_mode (str): Where the transform runs, "inline" on the event
+            loop, in a "thread", or in a "process" for large results. Default is
+            "thread".
+    """
+
+    fields: Optional[List[str]] = None
+    filters: List[RowFilter] = []
+    rename: Dict[str, str] = {}
+    execution_mode: str = "thread"
+
+    class Config:
+        extra = "forbid"
+
+    @validator("execution_mode")
+    def check_execution_mode(cls, mode):  # pylint: disable=no-self-argument
+        if mode not in TRANSFORM_EXECUTION_MODES:
+            raise ValueError(
+                f"execution_mode must be one of {list(TRANSFORM_EXECUTION_MODES)}, "
+                f"got {mode!r}"
+            )
+        return mode
+
+    def apply(self, data: Any) -> Any:
+        """Transformed copies of the data, the data is not modified."""
+        if isinstance(data, dict):
+            return self._reshape(data)
+        if not isinstance(data, list):
+            return data
+        rows = data
+        if self.filters:
+            rows = [
+                row
+                for row in rows
+                if not isinstance(row, dict)
+                or all(row_filter.matches(row) for row_filter in self.filters)
+            ]
+        if self.fields is None and not self.rename:
+            return list(rows)
+        return [self._reshape(row) if isinstance(row, dict) else row for row in rows]
+
+    def _reshape(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        if self.fields is not None:
+            row = {field: row[field] for field in self.fields if field in row}
+        if self.rename:
+            row = {self.rename.get(key, key): value for key, value in row.items()}
+        return row
+
+
+def transform_raw_json(transform: JobTransform, raw_json: str) -> str:
+    """Transform the data of a JSON body, see :meth:`JobTransform.apply`.
+
+    A module level function, so it can be run in a process pool.
+    """
+    return json.dumps(transform.apply(json.loads(raw_json)))
+
 
 class EsiJob(BaseModel, SerializeMixin):
     """
@@ -126,6 +364,8 @@ class EsiJob(BaseModel, SerializeMixin):
         additional_attributes (Dict[str, Any]): Additional attributes that can be used
             by callbacks.
         callbacks (CallbackCollection): Callbacks used by the job.
+        transform (Optional[JobTransform]): A transform of the result data, done
+            before the callbacks. see :class:`JobTransform`
         result (Optional[EsiJobResult]): Information on the results of a job, only
             available when certain callbacks have been used. see :class:`EsiJobResult`
         source: Info from the source used, including error messages and state.
@@ -140,6 +380,7 @@ class EsiJob(BaseModel, SerializeMixin):
     parameters: Dict[str, Any] = {}
     additional_attributes: Dict[str, Any] = {}
     callbacks: List[JobCallback] = []
+    transform: Optional[JobTransform] = None
     result: Optional[EsiJobResult] = None
     source: Optional[str] = None  # for future reporting on source
 
@@ -174,6 +415,22 @@ class EsiJob(BaseModel, SerializeMixin):
 
         return params
 
+    def template_values(self, names: Sequence[str]) -> Dict[str, Any]:
+        """The named values of :func:`EsiJob.attributes`, missing names left out.
+
+        Cheaper than :func:`EsiJob.attributes` for a few names, as only the job
+        attributes named are made.
+        """
+        values: Dict[str, Any] = {}
+        for name in names:
+            if name in self.additional_attributes:
+                values[name] = self.additional_attributes[name]
+            elif name in JOB_ATTRIBUTES:
+                values[name] = JOB_ATTRIBUTES[name](self)
+            elif name in self.parameters:
+                values[name] = self.parameters[name]
+        return values
+
     def job_attributes(self) -> Dict[str, str]:
         """Make a dict of all the esi_job attributes usable in templates
 
@@ -181,15 +438,21 @@ class EsiJob(BaseModel, SerializeMixin):
             Do not use this function directly to get attributes. Use :py:func:`EsiJob.attributes`
         """
         params: Dict[str, str] = {
-            "esi_job_name": self.name,
-            "esi_job_id_": self.id_,
-            "esi_job_op_id": self.op_id,
-            "esi_job_uid": str(self.uid),
-            "esi_job_iso_date_time": datetime.now().isoformat().replace(":", "-"),
+            name: attribute(self) for name, attribute in JOB_ATTRIBUTES.items()
         }
         return params
 
 
+JOB_ATTRIBUTES: Dict[str, Callable[[EsiJob], str]] = {
+    "esi_job_name": lambda job: job.name,
+    "esi_job_id_": lambda job: job.id_,
+    "esi_job_op_id": lambda job: job.op_id,
+    "esi_job_uid": lambda job: str(job.uid),
+    "esi_job_iso_date_time": lambda job: datetime.now().isoformat().replace(":", "-"),
+}
+"""The esi_job attributes usable in templates, see :func:`EsiJob.job_attributes`."""
+
+
 class EsiWorkOrder(BaseModel, SerializeMixin):
     """
     A container class for :class:`EsiJob` s.
@@ -1,6 +1,7 @@
 import logging
 from typing import List, Optional
 
+from eve_esi_jobs.cache_index import RunStats
 from eve_esi_jobs.models import EsiJob, EsiJobResult
 
 logger = logging.getLogger(__name__)
@@ -51,3 +52,31 @@ class LoggingObserver(QueueObserver):
             exceptions,
             kwargs,
         )
+
+
+class RunStatsObserver(QueueObserver):
+    """Count how the jobs of a run were served, from the worker messages."""
+
+    def __init__(self, stats: Optional[RunStats] = None) -> None:
+        super().__init__()
+        self.stats = stats if stats is not None else RunStats()
+
+    def update(
+        self,
+        worker,
+        job: EsiJob,
+        result: Optional[EsiJobResult] = None,
+        msg: str = "",
+        exceptions: Optional[List[Exception]] = None,
+        **kwargs,
+    ):
+        if msg in ("Fresh Local", "Fresh Shared"):
+            self.stats.fresh += 1
+        elif msg == "Stale Local":
+            self.stats.stale += 1
+        elif msg == "Unchanged":
+            self.stats.unchanged += 1
+        elif msg == "From Remote":
+            self.stats.fetched += 1
+        elif msg.startswith("Expected a result from the server"):
+            self.stats.errors += 1
@@ -0,0 +1,160 @@
+"""Per-type summaries of market order books, computed with NumPy.
+
+Needs the optional `numpy` package. Orders, as returned by
+`get_markets_region_id_orders`, are loaded into arrays once, sorted by type, and
+aggregated per type with `np.add.reduceat` and friends, so the cost
+per order is a few vectorized operations rather than a Python loop.
+"""
+import logging
+from math import isnan
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_DEPTH_PERCENTS: List[float] = [5.0]
+
+
+def check_numpy():
+    """Raise a ValueError if numpy is not installed."""
+    if numpy is None:
+        raise ValueError("Order book summaries need the numpy package installed.")
+
+
+def summary_field_names(depth_percents: Sequence[float]) -> List[str]:
+    """The fields of a summary row, in order."""
+    field_names = [
+        "type_id",
+        "best_bid",
+        "best_ask",
+        "spread",
+        "buy_orders",
+        "sell_orders",
+        "buy_volume",
+        "sell_volume",
+        "buy_weighted_price",
+        "sell_weighted_price",
+    ]
+    for percent in depth_percents:
+        field_names.append(f"buy_depth_{percent:g}pct")
+        field_names.append(f"sell_depth_{percent:g}pct")
+    return field_names
+
+
+def order_book_arrays(orders: List[Dict[str, Any]]):
+    """The type ids, prices, remaining volumes and buy flags of orders, as arrays."""
+    count = len(orders)
+    type_ids = numpy.fromiter(
+        (order["type_id"] for order in orders), numpy.int64, count
+    )
+    prices = numpy.fromiter((order["price"] for order in orders), numpy.float64, count)
+    volumes = numpy.fromiter(
+        (order["volume_remain"] for order in orders), numpy.int64, count
+    )
+    is_buy = numpy.fromiter(
+        (order["is_buy_order"] for order in orders), numpy.bool_, count
+    )
+    return type_ids, prices, volumes, is_buy
+
+
+def side_summary(
+    type_ids, prices, volumes, is_buy: bool, depth_percents: Sequence[float]
+) -> Dict[str, Any]:
+    """Aggregates per type of the orders of one side of the book.
+
+    The best price is the highest bid or the lowest ask. Depth is the volume of
+    orders priced within a percentage of the best price.
+    """
+    if not len(type_ids):  # pylint: disable=len-as-condition
+        return {
+            "type_ids": type_ids,
+            "orders": numpy.zeros(0, numpy.int64),
+            "best": prices,
+            "volume": volumes,
+            "weighted": prices,
+            "depths": [volumes for _ in depth_percents],
+        }
+    order = numpy.argsort(type_ids, kind="stable")
+    type_ids = type_ids[order]
+    prices = prices[order]
+    volumes = volumes[order]
+    starts = numpy.flatnonzero(numpy.r_[True, type_ids[1:] != type_ids[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(type_ids)])
+    if is_buy:
+        best = numpy.maximum.reduceat(prices, starts)
+    else:
+        best = numpy.minimum.reduceat(prices, starts)
+    volume = numpy.add.reduceat(volumes, starts)
+    value = numpy.add.reduceat(prices * volumes, starts)
+    weighted = numpy.full(len(starts), numpy.nan)
+    numpy.divide(value, volume, out=weighted, where=volume > 0)
+    best_of_order = numpy.repeat(best, counts)
+    depths = []
+    for percent in depth_percents:
+        if is_buy:
+            in_depth = prices >= best_of_order * (1 - percent / 100)
+        else:
+            in_depth = prices <= best_of_order * (1 + percent / 100)
+        depths.append(numpy.add.reduceat(numpy.where(in_depth, volumes, 0), starts))
+    return {
+        "type_ids": type_ids[starts],
+        "orders": counts,
+        "best": best,
+        "volume": volume,
+        "weighted": weighted,
+        "depths": depths,
+    }
+
+
+def spread_out(values, index, size: int, fill):
+    """A column of `size` rows, with the values at the index, the rest `fill`."""
+    column = numpy.full(size, fill, dtype=values.dtype)
+    column[index] = values
+    return column
+
+
+def summarize_order_book(
+    orders: List[Dict[str, Any]], depth_percents: Optional[Sequence[float]] = None
+) -> List[Dict[str, Any]]:
+    """One summary row per type, ordered by type id, see :func:`summary_field_names`.
+
+    Prices of a side without orders are None, its volumes 0.
+    """
+    check_numpy()
+    if depth_percents is None:
+        depth_percents = DEFAULT_DEPTH_PERCENTS
+    if not orders:
+        return []
+    type_ids, prices, volumes, is_buy = order_book_arrays(orders)
+    all_type_ids = numpy.unique(type_ids)
+    columns: Dict[str, Any] = {"type_id": all_type_ids}
+    for side, mask, side_is_buy in (("buy", is_buy, True), ("sell", ~is_buy, False)):
+        summary = side_summary(
+            type_ids[mask], prices[mask], volumes[mask], side_is_buy, depth_percents
+        )
+        index = numpy.searchsorted(all_type_ids, summary["type_ids"])
+        size = len(all_type_ids)
+        best_name = "best_bid" if side_is_buy else "best_ask"
+        columns[best_name] = spread_out(summary["best"], index, size, numpy.nan)
+        columns[f"{side}_orders"] = spread_out(summary["orders"], index, size, 0)
+        columns[f"{side}_volume"] = spread_out(summary["volume"], index, size, 0)
+        columns[f"{side}_weighted_price"] = spread_out(
+            summary["weighted"], index, size, numpy.nan
+        )
+        for percent, depth in zip(depth_percents, summary["depths"]):
+            columns[f"{side}_depth_{percent:g}pct"] = spread_out(depth, index, size, 0)
+    columns["spread"] = columns["best_ask"] - columns["best_bid"]
+    field_names = summary_field_names(depth_percents)
+    values = [
+        [
+            None if isinstance(value, float) and isnan(value) else value
+            for value in columns[name].tolist()
+        ]
+        for name in field_names
+    ]
+    return [dict(zip(field_names, row)) for row in zip(*values)]
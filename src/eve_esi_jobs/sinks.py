@@ -0,0 +1,520 @@
+"""Destinations shared by the callbacks of a run.
+
+A sink collects the output of many jobs in one place, like a JSON Lines file for
+a whole workorder, instead of a file per job. Sinks are kept in the
+:class:`SinkRegistry` of the run's
+:class:`~eve_esi_jobs.callbacks.CallbackRunner`, keyed by their destination, and
+are closed when the run ends. A :class:`ContentHashIndex` is shared the same
+way, so file callbacks can skip writing output that has not changed.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+from eve_esi_jobs.helpers import DirectoryCache, atomic_write, combine_dictionaries
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Sink:
+    """A destination shared by the callbacks of a run.
+
+    A sink with a `flush_interval` has :meth:`Sink.aflush` called that often by
+    its :class:`SinkRegistry`, so buffered output is written even when no more
+    arrives.
+    """
+
+    flush_interval: Optional[float] = None
+
+    async def aflush(self):
+        """Write anything buffered."""
+
+    async def aclose(self):
+        """Write anything buffered and release the destination."""
+        raise NotImplementedError()
+
+
+S = TypeVar("S", bound=Sink)  # pylint: disable=invalid-name
+
+
+class SinkRegistry:
+    """The sinks of one run, keyed by destination.
+
+    Sinks with a `flush_interval` are flushed by a task on the event loop, from
+    when they are made until the registry is closed.
+    """
+
+    def __init__(self) -> None:
+        self._sinks: Dict[Hashable, Sink] = {}
+        self._flush_tasks: List["asyncio.Task[None]"] = []
+
+    def get(self, key: Hashable, factory: Callable[[], S]) -> S:
+        """The sink for `key`, made with `factory` on first use."""
+        sink = self._sinks.get(key, None)
+        if sink is None:
+            sink = factory()
+            self._sinks[key] = sink
+            if sink.flush_interval is not None:
+                self._flush_tasks.append(
+                    asyncio.get_running_loop().create_task(
+                        self._flush_periodically(sink, sink.flush_interval)
+                    )
+                )
+        return sink  # type: ignore
+
+    @staticmethod
+    async def _flush_periodically(sink: Sink, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await sink.aflush()
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.exception("Error flushing %r, %s", sink, ex)
+
+    def __len__(self) -> int:
+        return len(self._sinks)
+
+    async def close(self):
+        """Close all sinks. Errors are logged, so one sink can't keep another open."""
+        flush_tasks, self._flush_tasks = self._flush_tasks, []
+        for task in flush_tasks:
+            task.cancel()
+        await asyncio.gather(*flush_tasks, return_exceptions=True)
+        sinks = list(self._sinks.values())
+        self._sinks = {}
+        for sink in sinks:
+            try:
+                await sink.aclose()
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.exception("Error closing %r, %s", sink, ex)
+
+
+class JsonLinesSink(Sink):
+    """Append lines to a file, buffered in memory.
+
+    Lines are buffered on the event loop with :meth:`JsonLinesSink.write`, which
+    says when the buffer is due to be written. Take the buffered lines with
+    :meth:`JsonLinesSink.take`, and write them with
+    :meth:`JsonLinesSink.write_lines` in a thread. In a :class:`SinkRegistry`,
+    lines are also written every `flush_seconds` when no more arrive.
+
+    Args:
+        file_path: The file appended to.
+        flush_lines: Write the buffer once it holds this many lines.
+        flush_seconds: Write the buffer once its oldest line is this old.
+    """
+
+    def __init__(
+        self, file_path: Path, flush_lines: int = 1000, flush_seconds: float = 5.0
+    ) -> None:
+        self.file_path = file_path
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.flush_interval = flush_seconds
+        self.lines_written = 0
+        self._buffer: List[str] = []
+        self._buffered_since: Optional[float] = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(file_path={self.file_path!r})"
+
+    def write(self, line: str) -> bool:
+        """Buffer a line, without its newline. True if the buffer should be flushed."""
+        if self._buffered_since is None:
+            self._buffered_since = monotonic()
+        self._buffer.append(line)
+        return (
+            len(self._buffer) >= self.flush_lines
+            or monotonic() - self._buffered_since >= self.flush_seconds
+        )
+
+    def take(self) -> List[str]:
+        """Empty the buffer, returning its lines."""
+        lines, self._buffer = self._buffer, []
+        self._buffered_since = None
+        return lines
+
+    def write_lines(self, lines: List[str]):
+        if not lines:
+            return
+        with self._lock:
+            if self._file is None:
+                self.file_path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(  # pylint: disable=consider-using-with
+                    self.file_path, mode="a", encoding="utf-8"
+                )
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+            self.lines_written += len(lines)
+
+    def flush(self):
+        """Write the buffered lines, from the event loop thread."""
+        self.write_lines(self.take())
+
+    def close(self):
+        """Write the buffered lines and close the file, from the event loop thread."""
+        self._close(self.take())
+
+    async def aflush(self):
+        lines = self.take()
+        if lines:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.write_lines, lines
+            )
+
+    async def aclose(self):
+        lines = self.take()
+        await asyncio.get_running_loop().run_in_executor(None, self._close, lines)
+
+    def _close(self, lines: List[str]):
+        self.write_lines(lines)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logger.info("Wrote %s lines to %s", self.lines_written, self.file_path)
+
+
+CONTENT_HASH_INDEX = ".esi-content-hashes.json"
+
+
+class ContentHashIndex(Sink):
+    """The content hashes of the files written to a directory.
+
+    Kept in a hidden JSON file in the directory. A file is unchanged when its
+    recorded hash matches, and its size and modification time still match the
+    recorded ones, so the file itself is never read. The index is loaded on first
+    use, and saved when closed.
+
+    Args:
+        directory: The directory of the files.
+        directories: The directories known to exist of the run.
+    """
+
+    def __init__(
+        self, directory: Path, directories: Optional[DirectoryCache] = None
+    ) -> None:
+        self.directory = directory
+        self.directories = directories
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self._changed = False
+        self._load_lock = asyncio.Lock()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(directory={self.directory!r})"
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / CONTENT_HASH_INDEX
+
+    async def entries(self) -> Dict[str, Dict[str, Any]]:
+        async with self._load_lock:
+            if self._entries is None:
+                self._entries = await asyncio.get_running_loop().run_in_executor(
+                    None, self._load
+                )
+        return self._entries
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            return json.loads(self.index_path.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError as ex:
+            logger.warning("Ignoring unreadable %s, %s", self.index_path, ex)
+            return {}
+
+    async def is_unchanged(self, file_path: Path, content_hash: str) -> bool:
+        """True if `file_path` holds the content with `content_hash`."""
+        entry = (await self.entries()).get(file_path.name, None)
+        if entry is None or entry["hash"] != content_hash:
+            return False
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return False
+        return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]
+
+    async def record(self, file_path: Path, content_hash: str):
+        """Record the content hash of a file just written."""
+        entries = await self.entries()
+        stat = os.stat(file_path)
+        entries[file_path.name] = {
+            "hash": content_hash,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        self._changed = True
+
+    async def aclose(self):
+        if self._entries is None or not self._changed:
+            return
+        data = json.dumps(self._entries, sort_keys=True)
+        await asyncio.get_running_loop().run_in_executor(
+            None, atomic_write, self.index_path, data, self.directories
+        )
+        self._changed = False
+
+
+SWAGGER_SQLITE_TYPES = {
+    "integer": "INTEGER",
+    "number": "REAL",
+    "boolean": "INTEGER",
+    "string": "TEXT",
+}
+"""SQLite column types for swagger types, anything else is stored as JSON text."""
+
+
+def sqlite_columns_from_schema(responses: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    """Columns for the items of a list of objects response, from an operation's
+    swagger responses. None if the 200 response is not a list of objects.
+    """
+    schema = responses.get("200", {}).get("schema", {})
+    if schema.get("type") != "array":
+        return None
+    properties = schema.get("items", {}).get("properties", None)
+    if not properties:
+        return None
+    return {
+        name: SWAGGER_SQLITE_TYPES.get(property_schema.get("type", ""), "TEXT")
+        for name, property_schema in properties.items()
+    }
+
+
+def sqlite_columns_from_record(record: Dict[str, Any]) -> Dict[str, str]:
+    columns = {}
+    for name, value in record.items():
+        if isinstance(value, (bool, int)):
+            columns[name] = "INTEGER"
+        elif isinstance(value, float):
+            columns[name] = "REAL"
+        else:
+            columns[name] = "TEXT"
+    return columns
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+@dataclass
+class SqliteTable:
+    """Where the records of a list of dict result go.
+
+    Args:
+        name: The table name.
+        columns: Column names and SQLite types. None infers them from the first
+            record written.
+        key_columns: Upsert on these columns, replacing the other columns of an
+            existing row. None appends every record.
+    """
+
+    name: str
+    columns: Optional[Dict[str, str]] = None
+    key_columns: Optional[List[str]] = None
+
+
+class SqliteSink(Sink):
+    """Write list of dict results to tables of a SQLite database.
+
+    Results are queued with :meth:`SqliteSink.put`, and written by a single writer
+    task, so concurrent jobs don't contend for the database. The writer takes up to
+    `batch_size` queued results at a time, and writes them in one transaction with
+    an `executemany` per table. Parsing the JSON and all database access happen in
+    the writer's own thread. Putting waits while `max_queued` results are queued.
+
+    Tables are created as needed. Nested values are stored as JSON text. Record
+    fields without a column are not stored.
+
+    If a batch fails, its results are written again one at a time, so a result
+    that can't be written doesn't take the others with it. Results that still
+    fail are logged and counted in `errors`.
+
+    Args:
+        db_path: The database file.
+        batch_size: The maximum number of results written per transaction.
+        max_queued: The maximum number of results waiting to be written.
+    """
+
+    def __init__(self, db_path: Path, batch_size: int = 100, max_queued: int = 1000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.rows_written = 0
+        self.errors = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="esi-sqlite-sink"
+        )
+        self._connection: Optional[sqlite3.Connection] = None
+        self._tables: Dict[str, Tuple[str, List[str]]] = {}
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(db_path={self.db_path!r})"
+
+    async def put(
+        self,
+        table: SqliteTable,
+        raw_json: str,
+        additional_fields: Optional[Dict[str, Any]] = None,
+    ):
+        """Queue the JSON of a list of dict result for writing."""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queued)
+            self._writer = asyncio.create_task(self._write_loop())
+        await self._queue.put((table, raw_json, additional_fields))
+
+    async def _write_loop(self):
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            items = [await self._queue.get()]
+            while not self._queue.empty() and len(items) < self.batch_size:
+                items.append(self._queue.get_nowait())
+            if items[-1] is None:
+                # Closing, nothing is queued after the sentinel.
+                closing = True
+                items.pop()
+            if not items:
+                continue
+            try:
+                await loop.run_in_executor(self._executor, self._write, items)
+            except Exception as ex:  # pylint: disable=broad-except
+                if len(items) == 1:
+                    self._log_error(items[0], ex)
+                    continue
+                logger.warning(
+                    "Error writing %s results to %s, writing them one at a time. %s",
+                    len(items),
+                    self.db_path,
+                    ex,
+                )
+                for item in items:
+                    try:
+                        await loop.run_in_executor(self._executor, self._write, [item])
+                    except Exception as item_ex:  # pylint: disable=broad-except
+                        self._log_error(item, item_ex)
+
+    def _log_error(self, item: Tuple[SqliteTable, str, Optional[Dict]], ex: Exception):
+        self.errors += 1
+        logger.error(
+            "Error writing a result to table %s of %s, %s. Result: %s",
+            item[0].name,
+            self.db_path,
+            ex,
+            item[1][:500],
+        )
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.db_path))
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        return self._connection
+
+    def _write(self, items: List[Tuple[SqliteTable, str, Optional[Dict]]]):
+        rows_by_table: Dict[str, List[Tuple]] = {}
+        try:
+            self._write_rows(items, rows_by_table)
+        except Exception:
+            # Tables made in the failed transaction were rolled back.
+            self._tables.clear()
+            raise
+        self.rows_written += sum(len(rows) for rows in rows_by_table.values())
+
+    def _write_rows(
+        self,
+        items: List[Tuple[SqliteTable, str, Optional[Dict]]],
+        rows_by_table: Dict[str, List[Tuple]],
+    ):
+        with self.connection:
+            for table, raw_json, additional_fields in items:
+                records: List[Dict[str, Any]] = json.loads(raw_json)
+                if not records:
+                    continue
+                if additional_fields:
+                    records = [
+                        combine_dictionaries(record, [additional_fields])
+                        for record in records
+                    ]
+                sql, columns = self._prepare_table(table, records[0])
+                rows = rows_by_table.setdefault(sql, [])
+                for record in records:
+                    rows.append(
+                        tuple(self._sqlite_value(record.get(name)) for name in columns)
+                    )
+            for sql, rows in rows_by_table.items():
+                self.connection.executemany(sql, rows)
+
+    def _prepare_table(
+        self, table: SqliteTable, record: Dict[str, Any]
+    ) -> Tuple[str, List[str]]:
+        """Create the table if needed, returns its insert statement and columns."""
+        prepared = self._tables.get(table.name, None)
+        if prepared is not None:
+            return prepared
+        columns = table.columns or sqlite_columns_from_record(record)
+        definitions = [
+            f"{quote_identifier(name)} {column_type}"
+            for name, column_type in columns.items()
+        ]
+        if table.key_columns:
+            keys = ", ".join(quote_identifier(name) for name in table.key_columns)
+            definitions.append(f"PRIMARY KEY ({keys})")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {quote_identifier(table.name)} "
+            f"({', '.join(definitions)})"
+        )
+        names = list(columns)
+        sql = (
+            f"INSERT INTO {quote_identifier(table.name)} "
+            f"({', '.join(quote_identifier(name) for name in names)}) "
+            f"VALUES ({', '.join('?' for _ in names)})"
+        )
+        if table.key_columns:
+            updates = [
+                f"{quote_identifier(name)} = excluded.{quote_identifier(name)}"
+                for name in names
+                if name not in table.key_columns
+            ]
+            keys = ", ".join(quote_identifier(name) for name in table.key_columns)
+            sql += f" ON CONFLICT ({keys}) DO " + (
+                f"UPDATE SET {', '.join(updates)}" if updates else "NOTHING"
+            )
+        self._tables[table.name] = (sql, names)
+        return sql, names
+
+    @staticmethod
+    def _sqlite_value(value: Any) -> Any:
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+
+    async def aclose(self):
+        if self._queue is not None and self._writer is not None:
+            await self._queue.put(None)
+            await self._writer
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_connection)
+        self._executor.shutdown(wait=True)
+        logger.info("Wrote %s rows to %s", self.rows_written, self.db_path)
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
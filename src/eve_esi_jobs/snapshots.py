@@ -0,0 +1,257 @@
+"""Delta-encoded history of list-of-dict results.
+
+A :class:`SnapshotStore` keeps the history of one repeatedly polled result, like
+the market orders of a region. Records are matched between polls by a key field,
+e.g. `order_id`, and each poll is stored as the records added, removed and
+changed since the previous one.
+
+History is kept in segments, each a base snapshot followed by deltas. A new
+segment is started every `checkpoint_every` deltas, which bounds the work needed
+to rebuild a snapshot. :meth:`SnapshotStore.compact` thins out old history by
+merging deltas.
+"""
+import json
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from eve_esi_jobs.compression import check_compression, compress, decompress
+from eve_esi_jobs.helpers import atomic_write
+from eve_esi_jobs.sinks import Sink
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+Records = Dict[Any, Dict[str, Any]]
+
+
+@dataclass
+class SnapshotDelta:
+    """The changes between two snapshots. `timestamp` is a POSIX timestamp."""
+
+    timestamp: float
+    added: List[Dict[str, Any]] = field(default_factory=list)
+    removed: List[Any] = field(default_factory=list)
+    changed: List[Dict[str, Any]] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.changed)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "timestamp": self.timestamp,
+                "added": self.added,
+                "removed": self.removed,
+                "changed": self.changed,
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, json_string: str) -> "SnapshotDelta":
+        return cls(**json.loads(json_string))
+
+
+class SnapshotStore(Sink):
+    """The delta-encoded history of a list-of-dict result, in one directory.
+
+    Adding a poll reads the latest segment and then appends to it, so a store
+    can be shared between threads, :meth:`SnapshotStore.add` and
+    :meth:`SnapshotStore.compact` take turns. Callbacks share a store per
+    directory through the run's sinks.
+
+    Args:
+        path: The directory holding the history.
+        key_field: The field identifying a record between polls.
+        checkpoint_every: The number of deltas before a new base snapshot is saved.
+        compression: Compress base snapshots, one of "gzip" or "zstd".
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        key_field: str,
+        checkpoint_every: int = 100,
+        compression: Optional[str] = None,
+    ) -> None:
+        check_compression(compression)
+        self.path = path
+        self.key_field = key_field
+        self.checkpoint_every = checkpoint_every
+        self.compression = compression
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(path={self.path!r})"
+
+    async def aclose(self):
+        """Nothing is buffered, polls are written as they are added."""
+
+    def base_path(self, segment: int) -> Path:
+        return self.path / Path(f"{segment:020d}.base.json")
+
+    def deltas_path(self, segment: int) -> Path:
+        return self.path / Path(f"{segment:020d}.deltas.jsonl")
+
+    def segments(self) -> List[int]:
+        """The segments, named by the timestamp of their base in microseconds."""
+        return sorted(
+            int(base_path.name.split(".")[0])
+            for base_path in self.path.glob("*.base.json")
+        )
+
+    def add(
+        self, records: List[Dict[str, Any]], timestamp: Optional[datetime] = None
+    ) -> Optional[SnapshotDelta]:
+        """Save a poll, returns the delta saved, or None for a new base snapshot.
+
+        A poll at the time of the latest snapshot, with the same records, was
+        already saved, e.g. a cached result handed out again. Adding it again
+        saves nothing and returns None.
+
+        Raises:
+            ValueError: If the poll is older than the latest snapshot, or at its
+                time with other records.
+        """
+        with self._lock:
+            return self._add(records, timestamp)
+
+    def _add(
+        self, records: List[Dict[str, Any]], timestamp: Optional[datetime]
+    ) -> Optional[SnapshotDelta]:
+        moment = (timestamp or datetime.now(timezone.utc)).timestamp()
+        new_state = self._keyed(records)
+        segments = self.segments()
+        if not segments:
+            self._write_base(moment, new_state)
+            return None
+        segment = segments[-1]
+        state, deltas = self._load_segment(segment)
+        for delta in deltas:
+            self.apply(state, delta)
+        if deltas:
+            is_latest = moment == deltas[-1].timestamp
+        else:
+            is_latest = int(moment * 1e6) == segment
+        if is_latest:
+            if state != new_state:
+                raise ValueError(f"Snapshot at {timestamp} differs from the saved one.")
+            logger.debug("Snapshot at %s already saved in %s", timestamp, self.path)
+            return None
+        if moment <= segment / 1e6 or (deltas and moment <= deltas[-1].timestamp):
+            raise ValueError(f"Snapshot at {timestamp} is not after the latest one.")
+        if len(deltas) >= self.checkpoint_every:
+            self._write_base(moment, new_state)
+            return None
+        delta = self.diff(state, new_state, moment)
+        with open(self.deltas_path(segment), "a") as file:
+            file.write(delta.to_json() + "\n")
+        return delta
+
+    def snapshot_at(self, timestamp: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Rebuild the records as they were at `timestamp`, default the latest."""
+        moment = timestamp.timestamp() if timestamp is not None else None
+        segments = self.segments()
+        if moment is not None:
+            segments = [segment for segment in segments if segment / 1e6 <= moment]
+        if not segments:
+            raise ValueError(f"No snapshot at or before {timestamp}.")
+        state, deltas = self._load_segment(segments[-1])
+        for delta in deltas:
+            if moment is not None and delta.timestamp > moment:
+                break
+            self.apply(state, delta)
+        return list(state.values())
+
+    def timestamps(self) -> List[datetime]:
+        """The times of the stored snapshots."""
+        moments: List[float] = []
+        for segment in self.segments():
+            moments.append(segment / 1e6)
+            moments.extend(delta.timestamp for delta in self._read_deltas(segment))
+        return [datetime.fromtimestamp(moment, timezone.utc) for moment in moments]
+
+    def compact(self, older_than: datetime, resolution: timedelta) -> int:
+        """Keep one snapshot per `resolution` for history before `older_than`.
+
+        Base snapshots are always kept. Returns the number of snapshots removed.
+        """
+        with self._lock:
+            return self._compact(older_than, resolution)
+
+    def _compact(self, older_than: datetime, resolution: timedelta) -> int:
+        cutoff = older_than.timestamp()
+        step = resolution.total_seconds()
+        removed = 0
+        for segment in self.segments():
+            state, deltas = self._load_segment(segment)
+            if not deltas or deltas[0].timestamp >= cutoff:
+                continue
+            kept: List[SnapshotDelta] = []
+            kept_state = dict(state)
+            for index, delta in enumerate(deltas):
+                self.apply(state, delta)
+                is_old = delta.timestamp < cutoff
+                next_delta = deltas[index + 1] if index + 1 < len(deltas) else None
+                same_bucket = (
+                    next_delta is not None
+                    and next_delta.timestamp < cutoff
+                    and next_delta.timestamp // step == delta.timestamp // step
+                )
+                if is_old and same_bucket:
+                    # A later delta in the same bucket carries these changes.
+                    removed += 1
+                    continue
+                kept.append(self.diff(kept_state, state, delta.timestamp))
+                kept_state = dict(state)
+            atomic_write(
+                self.deltas_path(segment),
+                "".join(delta.to_json() + "\n" for delta in kept),
+            )
+        logger.info("Compacted %s, removed %s snapshots.", self.path, removed)
+        return removed
+
+    def diff(self, old: Records, new: Records, timestamp: float) -> SnapshotDelta:
+        delta = SnapshotDelta(timestamp=timestamp)
+        for key, record in new.items():
+            previous = old.get(key, None)
+            if previous is None:
+                delta.added.append(record)
+            elif previous != record:
+                delta.changed.append(record)
+        delta.removed = [key for key in old if key not in new]
+        return delta
+
+    def apply(self, state: Records, delta: SnapshotDelta):
+        for key in delta.removed:
+            state.pop(key, None)
+        for record in delta.added:
+            state[record[self.key_field]] = record
+        for record in delta.changed:
+            state[record[self.key_field]] = record
+
+    def _keyed(self, records: List[Dict[str, Any]]) -> Records:
+        return {record[self.key_field]: record for record in records}
+
+    def _write_base(self, moment: float, state: Records):
+        data = json.dumps(list(state.values()), separators=(",", ":")).encode()
+        segment = int(moment * 1e6)
+        atomic_write(self.base_path(segment), compress(data, self.compression))
+        atomic_write(self.deltas_path(segment), "")
+
+    def _load_segment(self, segment: int) -> Tuple[Records, List[SnapshotDelta]]:
+        records = json.loads(decompress(self.base_path(segment).read_bytes()))
+        return self._keyed(records), list(self._read_deltas(segment))
+
+    def _read_deltas(self, segment: int) -> Iterator[SnapshotDelta]:
+        try:
+            with open(self.deltas_path(segment)) as file:
+                for line in file:
+                    if line.strip():
+                        yield SnapshotDelta.from_json(line)
+        except FileNotFoundError:
+            return
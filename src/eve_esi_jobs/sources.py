@@ -1,8 +1,34 @@
+import asyncio
+import hashlib
+import json
 import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from pathlib import Path
 from string import Template
-from time import perf_counter_ns
-from typing import List, Optional
+from time import perf_counter, perf_counter_ns, time, time_ns
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from uuid import UUID
 
 from aiohttp import ClientResponseError, ClientSession
 
@@ -14,7 +40,9 @@ from eve_esi_jobs.aiohttp_queue import (
     RateLimiter,
     ResponseMeta,
     ResponseType,
+    join_json_arrays,
 )
+from eve_esi_jobs.compression import check_compression, compress, decompress
 from eve_esi_jobs.exceptions import (
     BadDataException,
     BadStatusException,
@@ -22,43 +50,978 @@ from eve_esi_jobs.exceptions import (
     FailedRetryException,
     RetrievalError,
 )
-from eve_esi_jobs.helpers import optional_object
+from eve_esi_jobs.helpers import (
+    DirectoryCache,
+    FileLock,
+    atomic_write,
+    optional_object,
+)
 from eve_esi_jobs.models import EsiJob, EsiJobResult
 from eve_esi_jobs.operation_manifest import OperationManifest
 
+if TYPE_CHECKING:
+    from eve_esi_jobs.cache_index import CacheIndex
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+T = TypeVar("T")  # pylint: disable=invalid-name
+
+
+@dataclass
+class CacheEntry:
+    """Information about a stored result, gathered without decoding it.
+
+    Times are POSIX timestamps. `expires` is None when not known without
+    reading the result, see :meth:`EsiLocalSource.entry_expires`.
+    """
+
+    op_id: str
+    param_sig: str
+    size: int
+    stored: float
+    last_access: float
+    expires: Optional[float] = None
+
 
 class EsiLocalSource:
-    def __init__(self, root_path: Path) -> None:
+    """A local store of :class:`EsiJobResult` s.
+
+    File access is done in a bounded thread pool, so reading or writing a large
+    result does not stall the event loop. Results are written to a temporary file
+    and renamed into place, a reader never sees a partially written result.
+
+    The JSON body of a result is stored as received, and is not parsed when a
+    stored result is read, see :meth:`EsiJobResult.deserialize_raw`.
+
+    Args:
+        root_path: The directory used to store results.
+        check_expires: Serve stored results without contacting the server while
+            their `Expires`/`Cache-Control` headers say they are still fresh.
+        io_workers: The maximum number of threads used for file access.
+        compression: Compress stored results, one of "gzip" or "zstd". Stored
+            results are recognized when read, whatever the current setting.
+        compression_level: The compression level, None uses the codec default.
+        track_access: Record the last access time of a result when it is read, used
+            for least recently used eviction.
+        shared: The directory is shared by several processes. A process fetching a
+            result holds a lock file, see :meth:`EsiLocalSource.fetch_lease`, so
+            the others wait for its result instead of fetching it again.
+        index: Record stored, read and removed results in a
+            :class:`~eve_esi_jobs.cache_index.CacheIndex`.
+    """
+
+    json_indent: Optional[int] = None
+    """Indent used for uncompressed results, compressed results are always compact.
+
+    None stores the body as received. An indent is easier to read, but the data is
+    parsed and dumped to format it.
+    """
+    lease_timeout: float = 30.0
+    """Seconds to wait for another process to finish a fetch, before fetching anyway."""
+    lease_poll_interval: float = 0.1
+
+    def __init__(
+        self,
+        root_path: Path,
+        check_expires: bool = True,
+        io_workers: int = 4,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        track_access: bool = True,
+        shared: bool = False,
+        index: Optional["CacheIndex"] = None,
+    ) -> None:
+        check_compression(compression)
         self.root_path = root_path
+        self.check_expires = check_expires
+        self.io_workers = io_workers
+        self.compression = compression
+        self.compression_level = compression_level
+        self.track_access = track_access
+        self.shared = shared
+        self.index = index
+        self.requests_avoided = 0
+        """The number of remote requests skipped because a local result was fresh."""
+        self.directories = DirectoryCache()
+        """The directories known to exist, replaced by a run's shared cache."""
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.io_workers, thread_name_prefix="esi-local-source"
+            )
+        return self._executor
+
+    async def run_io(self, func: Callable[..., T], *args) -> T:
+        """Run a blocking function in the io thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    def use_directories(self, directories: DirectoryCache):
+        """Share the cache of directories known to exist of a run."""
+        self.directories = directories
+
+    def is_fresh(self, result: EsiJobResult, now: Optional[datetime] = None) -> bool:
+        """True if a stored result can be used without revalidating with the server."""
+        if not self.check_expires:
+            return False
+        return result.response.is_fresh(now)
 
     async def do_job(self, job: EsiJob) -> Optional[EsiJobResult]:
         try:
             result = await self._get_job_from_source(job)
-            return result
         except Exception as ex:
             raise RetrievalError("Error retrieving job from local source.", ex) from ex
+        if result is not None and self.index is not None and self.track_access:
+            self.index.record_accessed(job.op_id, str(job.param_sig()), time())
+        return result
+
+    async def refresh_result(self, result: EsiJobResult, response_headers: List[Dict]):
+        """Store a result again with the cache headers of a 304 response."""
+        result.response.refresh_headers(response_headers)
+        await self.store_result(result)
+
+    def result_path(self, op_id: str, param_sig: Union[str, UUID]) -> Path:
+        return self.root_path / Path(f"{op_id}-{param_sig}.json")
+
+    @staticmethod
+    def parse_result_name(file_name: str) -> Optional[Tuple[str, str]]:
+        """Get the (op_id, param_sig) from a result file name made by `result_path`."""
+        # param_sig is a 36 character uuid string.
+        if not file_name.endswith(".json") or len(file_name) < 43:
+            return None
+        op_id, param_sig = file_name[:-42], file_name[-41:-5]
+        if file_name[-42] != "-" or not op_id or file_name.startswith("."):
+            return None
+        return op_id, param_sig
 
     async def _get_job_from_source(self, job: EsiJob) -> Optional[EsiJobResult]:
-        job_path = Path(f"{job.op_id}-{job.param_sig()}.json")
-        file_path = self.root_path / job_path
-        if file_path.exists():
-            data = file_path.read_text()
-            result = EsiJobResult.deserialize_json(data)
-            return result
-        return None
+        file_path = self.result_path(job.op_id, job.param_sig())
+        return await self.run_io(self._read_result, file_path)
 
     async def store_result(self, result: EsiJobResult):
         try:
-            job_path = Path(f"{result.op_id}-{result.param_sig}.json")
-            file_path = self.root_path / job_path
-            file_path.parent.mkdir(exist_ok=True, parents=True)
-            file_path.write_text(result.serialize_json())
+            file_path = self.result_path(result.op_id, result.param_sig)
+            size = await self.run_io(self._write_result, file_path, result)
+        except Exception as ex:
+            raise RetrievalError("Error saving job to local source.", ex) from ex
+        self._index_stored(result, size)
+
+    def _index_stored(self, result: EsiJobResult, size: int):
+        if self.index is None:
             return
+        stored = time()
+        expires = result.response.expires_at()
+        self.index.record_stored(
+            CacheEntry(
+                op_id=result.op_id,
+                param_sig=str(result.param_sig),
+                size=size,
+                stored=stored,
+                last_access=stored,
+                expires=expires.timestamp() if expires is not None else None,
+            )
+        )
+
+    def load_result(
+        self, op_id: str, param_sig: Union[str, UUID]
+    ) -> Optional[EsiJobResult]:
+        """Read a stored result by its key, for inspecting the cache."""
+        return self._read_result(self.result_path(op_id, param_sig))
+
+    def _read_result(self, file_path: Path) -> Optional[EsiJobResult]:
+        try:
+            with open(file_path, "rb") as file:
+                data = file.read()
+                if self.track_access:
+                    self._touch(file.fileno(), file_path)
+        except FileNotFoundError:
+            return None
+        return self._decode_result(data)
+
+    @staticmethod
+    def _touch(file_descriptor: int, file_path: Path):
+        """Set the access time of a file to now, leaving the modified time."""
+        try:
+            stat = os.fstat(file_descriptor)
+            times = (time_ns(), stat.st_mtime_ns)
+            if os.utime in os.supports_fd:
+                os.utime(file_descriptor, ns=times)
+            else:
+                os.utime(file_path, ns=times)
+        except OSError as ex:
+            logger.debug("Unable to record access time for %s, %s", file_path, ex)
+
+    async def record_accesses(self, accessed: Dict[Tuple[str, str], float]):
+        """Record results used without reading them, e.g. served from memory.
+
+        `accessed` holds access times by (op_id, param_sig).
+        """
+        if not self.track_access or not accessed:
+            return
+        if self.index is not None:
+            for (op_id, param_sig), moment in accessed.items():
+                self.index.record_accessed(op_id, param_sig, moment)
+        await self._write_accesses(accessed)
+
+    async def _write_accesses(self, accessed: Dict[Tuple[str, str], float]):
+        await self.run_io(self._touch_results, accessed)
+
+    def _touch_results(self, accessed: Dict[Tuple[str, str], float]):
+        """Set the access time of result files, unless they were read since."""
+        for (op_id, param_sig), moment in accessed.items():
+            file_path = self.result_path(op_id, param_sig)
+            try:
+                stat = file_path.stat()
+                times = (max(int(moment * 1e9), stat.st_atime_ns), stat.st_mtime_ns)
+                os.utime(file_path, ns=times)
+            except FileNotFoundError:
+                continue
+            except OSError as ex:
+                logger.debug("Unable to record access time for %s, %s", file_path, ex)
+
+    def _write_result(self, file_path: Path, result: EsiJobResult) -> int:
+        """Write a result, returns the number of bytes stored."""
+        data = self._encode_result(result)
+        atomic_write(file_path, data, self.directories)
+        return len(data)
+
+    def _encode_result(self, result: EsiJobResult) -> Union[str, bytes]:
+        if self.compression is None and self.json_indent is not None:
+            return result.serialize_json(indent=self.json_indent)
+        if self.compression is None:
+            return result.serialize_raw()
+        data = result.serialize_raw().encode()
+        return compress(data, self.compression, self.compression_level)
+
+    def _decode_result(self, data: Union[str, bytes]) -> EsiJobResult:
+        if isinstance(data, bytes):
+            data = decompress(data)
+        return EsiJobResult.deserialize_raw(data)
+
+    def scan_entries(self) -> Iterator[CacheEntry]:
+        """Yield the stored entries, without decoding the results."""
+        try:
+            scanner = os.scandir(self.root_path)
+        except FileNotFoundError:
+            return
+        with scanner:
+            for dir_entry in scanner:
+                key = self.parse_result_name(dir_entry.name)
+                if key is None:
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield CacheEntry(
+                    op_id=key[0],
+                    param_sig=key[1],
+                    size=stat.st_size,
+                    stored=stat.st_mtime,
+                    last_access=stat.st_atime,
+                )
+
+    def entry_expires(self, entry: CacheEntry) -> Optional[float]:
+        """The expiry time of an entry, reading the stored result if needed."""
+        if entry.expires is not None:
+            return entry.expires
+        file_path = self.result_path(entry.op_id, entry.param_sig)
+        try:
+            data = file_path.read_bytes()
+        except FileNotFoundError:
+            return None
+        expires = self._decode_result(data).response.expires_at()
+        return expires.timestamp() if expires is not None else None
+
+    def remove_entry(self, entry: CacheEntry) -> bool:
+        """Remove a stored entry, returns False if it was already gone.
+
+        An entry stored again since it was scanned, e.g. by a concurrent run, is
+        kept, and False returned.
+        """
+        file_path = self.result_path(entry.op_id, entry.param_sig)
+        try:
+            if not self._is_scanned_file(entry, file_path.stat()):
+                return False
+            file_path.unlink()
+        except FileNotFoundError:
+            return False
+        if self.index is not None:
+            self.index.record_removed(entry.op_id, entry.param_sig)
+        return True
+
+    @staticmethod
+    def _is_scanned_file(entry: CacheEntry, stat: os.stat_result) -> bool:
+        """True if the file of an entry is still the one scanned."""
+        return stat.st_mtime == entry.stored and stat.st_size == entry.size
+
+    def remove_stale_temp_files(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        """Remove temp files left behind by interrupted writes, and stale locks."""
+        cutoff = time() - max_age.total_seconds()
+        removed = self.remove_stale_locks(max_age)
+        for file_path in self.root_path.glob(".*.tmp"):
+            try:
+                if file_path.stat().st_mtime < cutoff:
+                    file_path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def remove_stale_locks(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        """Remove the fetch lease lock files not taken for `max_age`."""
+        cutoff = time() - max_age.total_seconds()
+        removed = 0
+        for lock_path in self.root_path.glob(".locks/*.lock"):
+            try:
+                if lock_path.stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            if FileLock(lock_path).try_remove():
+                removed += 1
+        return removed
+
+    def remove_unreferenced_blobs(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        """Remove stored bodies no entry refers to. Whole results have none."""
+        return 0
+
+    def lock_path(self, op_id: str, param_sig: Union[str, UUID]) -> Path:
+        return self.root_path / Path(".locks") / Path(f"{op_id}-{param_sig}.lock")
+
+    @asynccontextmanager
+    async def fetch_lease(self, job: EsiJob) -> AsyncIterator[bool]:
+        """Hold the lease to fetch a job's result from the server.
+
+        Only one process sharing the directory holds the lease for a result at a
+        time. Yields True if the lease was held by another process when asked for,
+        in which case that process may have stored a fresh result in the meantime.
+        Does nothing unless `shared` is set.
+        """
+        if not self.shared:
+            yield False
+            return
+        lock = FileLock(self.lock_path(job.op_id, job.param_sig()))
+        waited = False
+        deadline = perf_counter() + self.lease_timeout
+        while not await self.run_io(lock.try_acquire):
+            waited = True
+            if perf_counter() > deadline:
+                logger.warning(
+                    "Timed out waiting for the fetch lease of %s, fetching anyway.",
+                    lock.lock_path,
+                )
+                break
+            await asyncio.sleep(self.lease_poll_interval)
+        try:
+            yield waited
+        finally:
+            lock.release()
+
+    async def flush(self):
+        """Write any buffered results. Results are written immediately by default."""
+        if self.index is not None:
+            await self.run_io(self.index.flush)
+
+    def close(self):
+        """Release the io thread pool and close the index."""
+        if self.index is not None:
+            self.index.close()
+        self.shutdown_io()
+
+    def shutdown_io(self):
+        """Release the io thread pool, waiting for running work."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class EsiBlobSource(EsiLocalSource):
+    """A local source that stores each distinct response body once.
+
+    Bodies are stored under their sha256 hash in `root_path/blobs`. The entry for an
+    (op_id, param_sig) holds the response metadata and a reference to its body, so
+    results with identical data, like the empty lists returned for types without
+    market orders, share one copy on disk. A body that is already stored is not
+    written again.
+
+    Bodies are removed by :meth:`EsiBlobSource.remove_unreferenced_blobs`, which
+    :class:`~eve_esi_jobs.cache_maintenance.CacheCollector` calls after removing
+    entries. Entries written by :class:`EsiLocalSource` can still be read.
+
+    Args:
+        root_path: The directory holding the entries and bodies.
+        check_expires: See :class:`EsiLocalSource`.
+        io_workers: See :class:`EsiLocalSource`.
+        compression: See :class:`EsiLocalSource`. Applies to the bodies.
+        compression_level: See :class:`EsiLocalSource`.
+        track_access: See :class:`EsiLocalSource`.
+        shared: See :class:`EsiLocalSource`.
+        index: See :class:`EsiLocalSource`.
+    """
+
+    def __init__(
+        self,
+        root_path: Path,
+        check_expires: bool = True,
+        io_workers: int = 4,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        track_access: bool = True,
+        shared: bool = False,
+        index: Optional["CacheIndex"] = None,
+    ) -> None:
+        super().__init__(
+            root_path,
+            check_expires=check_expires,
+            io_workers=io_workers,
+            compression=compression,
+            compression_level=compression_level,
+            track_access=track_access,
+            shared=shared,
+            index=index,
+        )
+        self.blob_root = root_path / Path("blobs")
+        self.blobs_written = 0
+        """The number of bodies written."""
+        self.blobs_reused = 0
+        """The number of results stored without writing their body."""
+
+    def blob_path(self, digest: str) -> Path:
+        return self.blob_root / Path(digest[:2]) / Path(f"{digest}.json")
+
+    def _write_result(self, file_path: Path, result: EsiJobResult) -> int:
+        body = result.raw_json().encode()
+        digest = hashlib.sha256(body).hexdigest()
+        blob_path = self.blob_path(digest)
+        try:
+            # A fresh mtime keeps the body from being collected before the
+            # entry referring to it is written.
+            os.utime(blob_path)
+            blob_size = blob_path.stat().st_size
+            self.blobs_reused += 1
+        except FileNotFoundError:
+            blob = compress(body, self.compression, self.compression_level)
+            atomic_write(blob_path, blob, self.directories)
+            blob_size = len(blob)
+            self.blobs_written += 1
+        entry = json.loads(result.json(exclude={"data_"}, exclude_defaults=True))
+        entry["blob"] = digest
+        entry["blob_size"] = blob_size
+        data = json.dumps(entry)
+        atomic_write(file_path, data, self.directories)
+        return len(data) + blob_size
+
+    def _read_result(self, file_path: Path) -> Optional[EsiJobResult]:
+        try:
+            with open(file_path, "rb") as file:
+                data = file.read()
+                if self.track_access:
+                    self._touch(file.fileno(), file_path)
+        except FileNotFoundError:
+            return None
+        entry = self._decode_entry(data)
+        if "blob" not in entry:
+            return EsiJobResult.deserialize_obj(entry)
+        try:
+            body = self.blob_path(entry.pop("blob")).read_bytes()
+        except FileNotFoundError:
+            logger.warning("Missing body for %s, treating as not stored.", file_path)
+            return None
+        entry.pop("blob_size", None)
+        return EsiJobResult.from_raw(raw=decompress(body), **entry)
+
+    @staticmethod
+    def _decode_entry(data: bytes) -> Dict[str, Any]:
+        return json.loads(decompress(data))
+
+    def _read_entry(self, entry: CacheEntry) -> Optional[Dict[str, Any]]:
+        try:
+            data = self.result_path(entry.op_id, entry.param_sig).read_bytes()
+        except FileNotFoundError:
+            return None
+        return self._decode_entry(data)
+
+    def scan_entries(self) -> Iterator[CacheEntry]:
+        """Yield the stored entries, with the size and expiry of their bodies.
+
+        Shared bodies count towards the size of every entry using them.
+        """
+        for entry in super().scan_entries():
+            stored = self._read_entry(entry)
+            if stored is None:
+                continue
+            entry.size += stored.get("blob_size", 0)
+            expires = ResponseMeta(**stored["response"]).expires_at()
+            entry.expires = expires.timestamp() if expires is not None else None
+            yield entry
+
+    @staticmethod
+    def _is_scanned_file(entry: CacheEntry, stat: os.stat_result) -> bool:
+        # The size of a scanned entry includes its body.
+        return stat.st_mtime == entry.stored
+
+    def entry_expires(self, entry: CacheEntry) -> Optional[float]:
+        if entry.expires is not None:
+            return entry.expires
+        stored = self._read_entry(entry)
+        if stored is None:
+            return None
+        expires = ResponseMeta(**stored["response"]).expires_at()
+        return expires.timestamp() if expires is not None else None
+
+    def remove_stale_temp_files(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        removed = super().remove_stale_temp_files(max_age)
+        cutoff = time() - max_age.total_seconds()
+        for file_path in self.blob_root.glob("*/.*.tmp"):
+            try:
+                if file_path.stat().st_mtime < cutoff:
+                    file_path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def remove_unreferenced_blobs(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        """Remove bodies no entry refers to, that are older than `max_age`.
+
+        `max_age` protects bodies written for entries that are still being stored.
+        """
+        referenced = set()
+        for entry in super().scan_entries():
+            stored = self._read_entry(entry)
+            if stored is not None and "blob" in stored:
+                referenced.add(stored["blob"])
+        cutoff = time() - max_age.total_seconds()
+        removed = 0
+        for blob_path in self.blob_root.glob("*/*.json"):
+            if blob_path.stem in referenced:
+                continue
+            try:
+                if blob_path.stat().st_mtime < cutoff:
+                    blob_path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+class EsiSqliteSource(EsiLocalSource):
+    """A local source that keeps :class:`EsiJobResult` s in a SQLite database.
+
+    Results are indexed by (op_id, param_sig), with the etag and expiry kept in their
+    own columns so entries can be listed and expired without decoding them. The
+    database uses WAL mode, and stored results are written in batches, one
+    transaction per `batch_size` results. Call :meth:`EsiSqliteSource.flush` to
+    write a partial batch, the job runners do this at the end of a run.
+
+    Database access happens in the io thread pool, one query at a time.
+
+    Args:
+        root_path: The directory holding the database.
+        db_name: The file name of the database.
+        batch_size: The number of results written per transaction.
+        check_expires: See :class:`EsiLocalSource`.
+        io_workers: See :class:`EsiLocalSource`.
+        compression: See :class:`EsiLocalSource`.
+        compression_level: See :class:`EsiLocalSource`.
+        track_access: See :class:`EsiLocalSource`. Access times are written with
+            the next batch.
+        shared: See :class:`EsiLocalSource`. Several processes can use the
+            database, SQLite serializes their writes. Results are written
+            immediately rather than in batches.
+        index: See :class:`EsiLocalSource`.
+    """
+
+    def __init__(
+        self,
+        root_path: Path,
+        db_name: str = "esi-results.sqlite",
+        batch_size: int = 100,
+        check_expires: bool = True,
+        io_workers: int = 4,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        track_access: bool = True,
+        shared: bool = False,
+        index: Optional["CacheIndex"] = None,
+    ) -> None:
+        super().__init__(
+            root_path,
+            check_expires=check_expires,
+            io_workers=io_workers,
+            compression=compression,
+            compression_level=compression_level,
+            track_access=track_access,
+            shared=shared,
+            index=index,
+        )
+        self.db_path = root_path / Path(db_name)
+        self.batch_size = batch_size
+        self._pending: Dict[Tuple[str, str], Tuple] = {}
+        self._writing: Dict[Tuple[str, str], Tuple] = {}
+        self._accessed: Dict[Tuple[str, str], float] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS esi_results ("
+                    "op_id TEXT NOT NULL, "
+                    "param_sig TEXT NOT NULL, "
+                    "etag TEXT, "
+                    "expires REAL, "
+                    "stored REAL NOT NULL, "
+                    "accessed REAL NOT NULL, "
+                    "result TEXT NOT NULL, "
+                    "PRIMARY KEY (op_id, param_sig))"
+                )
+                columns = [
+                    row[1]
+                    for row in connection.execute("PRAGMA table_info(esi_results)")
+                ]
+                if "accessed" not in columns:
+                    # Databases made before access tracking.
+                    connection.execute(
+                        "ALTER TABLE esi_results "
+                        "ADD COLUMN accessed REAL NOT NULL DEFAULT 0"
+                    )
+                    connection.execute("UPDATE esi_results SET accessed = stored")
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS esi_results_expires "
+                    "ON esi_results (expires)"
+                )
+            self._connection = connection
+        return self._connection
+
+    async def _get_job_from_source(self, job: EsiJob) -> Optional[EsiJobResult]:
+        key = (job.op_id, str(job.param_sig()))
+        row = self._pending.get(key, None) or self._writing.get(key, None)
+        if row is not None:
+            return self._decode_result(row[-1])
+        result = await self.run_io(self._read_row, key)
+        if result is not None and self.track_access:
+            self._accessed[key] = time()
+        return result
+
+    async def _write_accesses(self, accessed: Dict[Tuple[str, str], float]):
+        # Written with the next batch.
+        for key, moment in accessed.items():
+            self._accessed[key] = max(moment, self._accessed.get(key, moment))
+
+    def load_result(
+        self, op_id: str, param_sig: Union[str, UUID]
+    ) -> Optional[EsiJobResult]:
+        self._write_pending_sync()
+        return self._read_row((op_id, str(param_sig)))
+
+    def _read_row(self, key: Tuple[str, str]) -> Optional[EsiJobResult]:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT result FROM esi_results WHERE op_id = ? AND param_sig = ?", key
+            ).fetchone()
+        if row is None:
+            return None
+        return self._decode_result(row[0])
+
+    async def store_result(self, result: EsiJobResult):
+        try:
+            expires = result.response.expires_at()
+            stored = time()
+            row = (
+                result.op_id,
+                str(result.param_sig),
+                result.response.get_response_header("etag"),
+                expires.timestamp() if expires is not None else None,
+                stored,
+                stored,
+                self._encode_result(result),
+            )
+            self._pending[(row[0], row[1])] = row
+            # Other processes only see written results, don't hold them back.
+            if self.shared or len(self._pending) >= self.batch_size:
+                await self._write_pending()
         except Exception as ex:
             raise RetrievalError("Error saving job to local source.", ex) from ex
+        self._index_stored(result, len(row[-1]))
+
+    async def flush(self):
+        try:
+            await self._write_pending()
+        except Exception as ex:
+            raise RetrievalError("Error saving jobs to local source.", ex) from ex
+        await super().flush()
+
+    async def _write_pending(self):
+        if not self._pending and not self._accessed:
+            return
+        batch = self._pending
+        accessed = self._accessed
+        self._pending = {}
+        self._accessed = {}
+        # Keep the batch readable until it is in the database.
+        self._writing.update(batch)
+        try:
+            await self.run_io(self._write_rows, list(batch.values()), accessed)
+        finally:
+            for key, row in batch.items():
+                if self._writing.get(key, None) is row:
+                    del self._writing[key]
+
+    def _write_pending_sync(self):
+        if not self._pending and not self._accessed:
+            return
+        # May run in the io thread while results are stored on the event loop,
+        # swap the buffers out so results stored meanwhile wait for the next write.
+        batch, self._pending = self._pending, {}
+        accessed, self._accessed = self._accessed, {}
+        self._write_rows(list(batch.values()), accessed)
+
+    def _write_rows(
+        self, rows: List[Tuple], accessed: Optional[Dict[Tuple[str, str], float]] = None
+    ):
+        with self._lock:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO esi_results "
+                    "(op_id, param_sig, etag, expires, stored, accessed, result) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                if accessed:
+                    self.connection.executemany(
+                        "UPDATE esi_results SET accessed = ? "
+                        "WHERE op_id = ? AND param_sig = ?",
+                        [(value, *key) for key, value in accessed.items()],
+                    )
+        logger.debug("Wrote %s results to %s", len(rows), self.db_path)
+
+    def list_entries(self, op_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """List stored entries without decoding the results."""
+        self._write_pending_sync()
+        query = "SELECT op_id, param_sig, etag, expires, stored FROM esi_results"
+        params: Tuple = ()
+        if op_id is not None:
+            query += " WHERE op_id = ?"
+            params = (op_id,)
+        with self._lock:
+            cursor = self.connection.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    def scan_entries(self) -> Iterator[CacheEntry]:
+        self._write_pending_sync()
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self.connection.execute(
+                    "SELECT rowid, op_id, param_sig, length(result), stored, accessed, "
+                    "expires FROM esi_results WHERE rowid > ? ORDER BY rowid LIMIT 1000",
+                    (last_rowid,),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield CacheEntry(*row[1:])
+            last_rowid = rows[-1][0]
+
+    def remove_entry(self, entry: CacheEntry) -> bool:
+        key = (entry.op_id, entry.param_sig)
+        if key in self._pending or key in self._writing:
+            # Replaced by a result stored since the scan, which is kept.
+            return False
+        if self.index is not None:
+            self.index.record_removed(*key)
+        with self._lock:
+            with self.connection:
+                cursor = self.connection.execute(
+                    "DELETE FROM esi_results WHERE op_id = ? AND param_sig = ?", key
+                )
+        return cursor.rowcount > 0
+
+    def remove_stale_temp_files(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        return self.remove_stale_locks(max_age)
+
+    def remove_expired(self, now: Optional[datetime] = None) -> int:
+        """Delete entries whose expiry has passed, returning the number removed."""
+        self._write_pending_sync()
+        if now is None:
+            now = datetime.now(timezone.utc)
+        with self._lock:
+            with self.connection:
+                cursor = self.connection.execute(
+                    "DELETE FROM esi_results WHERE expires < ?", (now.timestamp(),)
+                )
+        if self.index is not None:
+            self.index.record_expired_removed(now.timestamp())
+        return cursor.rowcount
+
+    def close(self):
+        """Write pending results and close the database connection."""
+        self._write_pending_sync()
+        super().close()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class EsiMemoryCacheSource(EsiLocalSource):
+    """An in-memory LRU tier in front of another local source.
+
+    Results are kept in memory keyed by (op_id, param_sig), up to `max_bytes` of
+    estimated size. The least recently used results are evicted first. Stored
+    results are written through to the wrapped source. Results handed out are
+    shared between jobs, and should not be modified. Results served from memory
+    are recorded as accessed in the wrapped source on :meth:`flush`, so least
+    recently used eviction of the cache sees them as used.
+
+    The size of a result is the length of its raw JSON. Results that have been
+    parsed are estimated from their JSON encoded data, sampling the first
+    `sample_size` items of list data.
+
+    Args:
+        source: The local source holding the results.
+        max_bytes: The maximum total estimated size of the results in memory.
+        sample_size: The number of list items used to estimate a result's size.
+    """
+
+    def __init__(
+        self,
+        source: EsiLocalSource,
+        max_bytes: int = 256 * 1024 * 1024,
+        sample_size: int = 100,
+    ) -> None:
+        super().__init__(
+            source.root_path,
+            check_expires=source.check_expires,
+            io_workers=source.io_workers,
+            index=source.index,
+        )
+        self.source = source
+        self.max_bytes = max_bytes
+        self.sample_size = sample_size
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[EsiJobResult, int]]" = (
+            OrderedDict()
+        )
+        self._accessed: Dict[Tuple[str, str], float] = {}
+
+    def use_directories(self, directories: DirectoryCache):
+        super().use_directories(directories)
+        self.source.use_directories(directories)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "current_bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def estimate_size(self, result: EsiJobResult) -> int:
+        headers_size = len(json.dumps(result.response.response_headers))
+        if not result.is_parsed:
+            return len(result.raw_json()) + headers_size
+        data = result.data
+        if isinstance(data, list) and len(data) > self.sample_size:
+            sample = json.dumps(data[: self.sample_size])
+            data_size = len(sample) * len(data) // self.sample_size
+        else:
+            data_size = len(json.dumps(data))
+        return data_size + headers_size
+
+    async def do_job(self, job: EsiJob) -> Optional[EsiJobResult]:
+        key = (job.op_id, str(job.param_sig()))
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            if self.source.track_access:
+                self._accessed[key] = time()
+            return entry[0]
+        self.misses += 1
+        result = await self.source.do_job(job)
+        if result is not None:
+            self._put(key, result)
+        return result
+
+    async def store_result(self, result: EsiJobResult):
+        await self.source.store_result(result)
+        self._put((result.op_id, str(result.param_sig)), result)
+
+    def _put(self, key: Tuple[str, str], result: EsiJobResult):
+        size = self.estimate_size(result)
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.current_bytes -= previous[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (result, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+    def scan_entries(self) -> Iterator[CacheEntry]:
+        return self.source.scan_entries()
+
+    def entry_expires(self, entry: CacheEntry) -> Optional[float]:
+        return self.source.entry_expires(entry)
+
+    def remove_entry(self, entry: CacheEntry) -> bool:
+        if not self.source.remove_entry(entry):
+            return False
+        previous = self._entries.pop((entry.op_id, entry.param_sig), None)
+        if previous is not None:
+            self.current_bytes -= previous[1]
+        return True
+
+    def remove_stale_temp_files(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        return self.source.remove_stale_temp_files(max_age)
+
+    def remove_unreferenced_blobs(self, max_age: timedelta = timedelta(hours=1)) -> int:
+        return self.source.remove_unreferenced_blobs(max_age)
+
+    def fetch_lease(self, job: EsiJob) -> AsyncContextManager[bool]:
+        return self.source.fetch_lease(job)
+
+    def load_result(
+        self, op_id: str, param_sig: Union[str, UUID]
+    ) -> Optional[EsiJobResult]:
+        return self.source.load_result(op_id, param_sig)
+
+    def clear(self):
+        """Empty the memory tier, the wrapped source is unchanged."""
+        self._entries.clear()
+        self.current_bytes = 0
+
+    async def flush(self):
+        """Record the results served from memory, then flush the wrapped source."""
+        accessed, self._accessed = self._accessed, {}
+        await self.source.record_accesses(accessed)
+        await self.source.flush()
+
+    def close(self):
+        """Close the wrapped source, which closes the shared index."""
+        self.source.close()
+        self.shutdown_io()
 
 
 class EsiRemoteSource:
@@ -78,6 +1041,13 @@ class EsiRemoteSource:
     ) -> EsiJobResult:
         request = self.request_from_job(job=job, etag=etag)
         await self.make_request(request, session)
+        if isinstance(request.data, bytes):
+            return EsiJobResult.from_raw(
+                op_id=job.op_id,
+                param_sig=job.param_sig(),
+                response=request.response_meta,
+                raw=request.data,
+            )
         result = EsiJobResult(
             op_id=job.op_id,
             param_sig=job.param_sig(),
@@ -202,6 +1172,11 @@ class EsiRemoteSource:
         assert request.data is not None
         assert request.response_meta is not None
         try:
+            if isinstance(request.data, bytes):
+                request.data = join_json_arrays(
+                    [request.data] + [sub_request.data for sub_request in page_requests]
+                )
+                return
             for sub_request in page_requests:
                 request.data.extend(sub_request.data)
         except Exception as ex:
@@ -228,7 +1203,7 @@ class EsiRemoteSource:
             params=request_params.query,
             json=request_params.body,
             headers=request_params.header,
-            response_type=ResponseType.AUTO,
+            response_type=ResponseType.RAW_JSON,
             kwargs={"raise_for_status": True},
         )
         return request
@@ -4,7 +4,7 @@ import logging
 import os
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 import click
 
@@ -17,6 +17,7 @@ class EveEsiJobConfig:
         schema_url: str,
         log_level: Union[int, str],
         aiohttp_queue_log_level: Union[int, str],
+        cache_dir: Optional[str] = None,
     ) -> None:
         self.app_name = app_name
         """The name of the app. Should be namespaced to prevent collision."""
@@ -24,6 +25,10 @@ class EveEsiJobConfig:
         """The app data directory. Location is system dependent."""
         self.schema_url = schema_url
         """The url to the current version of the Eve ESI schema."""
+        self.cache_dir = (
+            Path(cache_dir) if cache_dir is not None else self.app_dir / Path("cache")
+        )
+        """The directory of the local source used to cache ESI results."""
         self.log_level = int(log_level)
         self.aiohttp_queue_log_level = int(aiohttp_queue_log_level)
         log_path = Path(app_dir) / Path("logs")
@@ -50,8 +55,9 @@ def make_config_from_env():
     aiohttp_queue_log_level = os.getenv(
         "PFMSOFT_eve_esi_jobs_aiohttp_queue_LOG_LEVEL", str(logging.WARNING)
     )
+    cache_dir = os.getenv("PFMSOFT_eve_esi_jobs_CACHE_DIR", None)
     config = EveEsiJobConfig(
-        app_name, app_dir, schema_url, log_level, aiohttp_queue_log_level
+        app_name, app_dir, schema_url, log_level, aiohttp_queue_log_level, cache_dir
     )
     return config
 
@@ -0,0 +1,243 @@
+"""Maintain the local cache of ESI results."""
+import logging
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+from eve_esi_jobs.cache_index import CacheIndex
+from eve_esi_jobs.cache_maintenance import CacheCollector, CachePolicy
+from eve_esi_jobs.eve_esi_jobs import EveEsiJobs
+from eve_esi_jobs.sources import EsiBlobSource, EsiLocalSource, EsiSqliteSource
+from eve_esi_jobs.typer_cli.app_config import EveEsiJobConfig
+from eve_esi_jobs.typer_cli.cli_helpers import (
+    report_finished_task,
+    validate_input_path,
+)
+
+logger = logging.getLogger(__name__)
+app = typer.Typer(help="Maintain the local cache of ESI results.")
+
+MEBIBYTE = 1024 * 1024
+
+
+def cache_source(ctx: typer.Context, cache_dir: Optional[Path]) -> EsiLocalSource:
+    """The local source in the cache directory, default the one jobs use."""
+    if cache_dir is None:
+        config: EveEsiJobConfig = ctx.obj["config"]
+        cache_dir = config.cache_dir
+    return local_source_in(cache_dir)
+
+
+def local_source_in(cache_dir: Path) -> EsiLocalSource:
+    """The indexed local source in a cache directory, by the files it holds."""
+    index = CacheIndex.in_dir(cache_dir)
+    if (cache_dir / Path("esi-results.sqlite")).exists():
+        return EsiSqliteSource(cache_dir, index=index)
+    if (cache_dir / Path("blobs")).is_dir():
+        return EsiBlobSource(cache_dir, index=index)
+    return EsiLocalSource(cache_dir, index=index)
+
+
+def source_index(source: EsiLocalSource, rebuild: bool) -> CacheIndex:
+    """The index of a source, built by scanning the source if missing."""
+    assert source.index is not None
+    if rebuild or not source.index.exists():
+        typer.echo(f"Indexing {source.root_path}...", err=True)
+        source.index.rebuild(source)
+    return source.index
+
+
+def format_time(timestamp: Optional[float]) -> str:
+    if timestamp is None:
+        return "-"
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    return moment.isoformat(timespec="seconds")
+
+
+def format_mb(size: int) -> str:
+    return f"{size / MEBIBYTE:.1f} MiB"
+
+
+CACHE_DIR_OPTION = typer.Option(
+    None,
+    "--cache-dir",
+    help="The cache directory. Defaults to the cache in the app data directory.",
+)
+REBUILD_OPTION = typer.Option(
+    False, "--rebuild", help="Rebuild the index by scanning the cache first."
+)
+
+
+@app.command()
+def gc(
+    ctx: typer.Context,
+    cache_dir: Optional[Path] = CACHE_DIR_OPTION,
+    expired_hours: Optional[float] = typer.Option(
+        0.0,
+        "--expired-hours",
+        help="Remove results expired longer ago than this. Negative keeps them.",
+    ),
+    max_mb: Optional[float] = typer.Option(
+        None, "--max-mb", help="Size quota for the whole cache, in MiB."
+    ),
+    max_mb_per_op_id: Optional[float] = typer.Option(
+        None, "--max-mb-per-op-id", help="Size quota for each op_id, in MiB."
+    ),
+):
+    """Remove expired results, then least recently used results over quota."""
+    policy = CachePolicy(
+        expired_grace=(
+            timedelta(hours=expired_hours)
+            if expired_hours is not None and expired_hours >= 0
+            else None
+        ),
+        max_bytes=int(max_mb * MEBIBYTE) if max_mb is not None else None,
+        max_bytes_per_op_id=(
+            int(max_mb_per_op_id * MEBIBYTE) if max_mb_per_op_id is not None else None
+        ),
+    )
+    source = cache_source(ctx, cache_dir)
+    try:
+        report = CacheCollector(source, policy).do_collect()
+    finally:
+        source.close()
+    typer.echo(str(report))
+    report_finished_task(ctx)
+
+
+@app.command()
+def warm(
+    ctx: typer.Context,
+    path_in: str = typer.Argument(..., help="Path to the workorder file."),
+    cache_dir: Optional[Path] = CACHE_DIR_OPTION,
+    rate: float = typer.Option(2.0, "--rate", help="Requests per second."),
+    workers: int = typer.Option(2, "--workers", help="Jobs fetched at once."),
+):
+    """Revalidate the cached results of a workorder's jobs, without callbacks."""
+    path_in = validate_input_path(path_in)
+    runner: EveEsiJobs = ctx.obj["runner"]
+    try:
+        ewo = runner.deserialize_workorder(Path(path_in))
+    except Exception as ex:
+        logger.exception("Error deserializing workorder from file: %s", path_in)
+        raise typer.BadParameter(f"Error decoding workorder at {path_in}, msg: {ex}")
+    source = cache_source(ctx, cache_dir)
+    try:
+        report = runner.warm_cache(
+            ewo, local_source=source, rate=rate, max_workers=workers
+        )
+    finally:
+        source.close()
+    typer.echo(str(report))
+    report_finished_task(ctx)
+
+
+@app.command()
+def stats(
+    ctx: typer.Context,
+    cache_dir: Optional[Path] = CACHE_DIR_OPTION,
+    rebuild: bool = REBUILD_OPTION,
+    runs: int = typer.Option(5, "--runs", help="The number of recent runs shown."),
+):
+    """Show counts, sizes, ages and expiry per op_id, and recent hit rates."""
+    source = cache_source(ctx, cache_dir)
+    try:
+        index = source_index(source, rebuild)
+        cache_stats = index.stats()
+        recent_runs = index.runs(limit=runs)
+    finally:
+        source.close()
+    typer.echo(
+        f"{cache_stats.entries} entries, {format_mb(cache_stats.size)}: "
+        f"{cache_stats.fresh} fresh, {cache_stats.expired} expired, "
+        f"{cache_stats.no_expiry} without expiry."
+    )
+    typer.echo(
+        "Stored: "
+        + ", ".join(f"{name} {count}" for name, count in cache_stats.ages.items())
+    )
+    for op_id_stats in cache_stats.op_ids:
+        typer.echo(
+            f"  {op_id_stats.op_id}: {op_id_stats.entries} entries, "
+            f"{format_mb(op_id_stats.size)}, {op_id_stats.fresh} fresh, "
+            f"{op_id_stats.expired} expired, "
+            f"stored {format_time(op_id_stats.oldest)} "
+            f"to {format_time(op_id_stats.newest)}"
+        )
+    if recent_runs:
+        typer.echo("Recent runs:")
+    else:
+        typer.echo("No runs recorded, runs are recorded by `eve-esi --use-cache do`.")
+    for run_stats in recent_runs:
+        hit_ratio = (
+            f"{run_stats.hit_ratio:.0%}" if run_stats.hit_ratio is not None else "-"
+        )
+        typer.echo(
+            f"  {format_time(run_stats.started)}: {run_stats.jobs} jobs, "
+            f"hit ratio {hit_ratio} ({run_stats.hits} hits: {run_stats.fresh} "
+            f"fresh, {run_stats.stale} stale, {run_stats.unchanged} unchanged; "
+            f"{run_stats.misses} misses), {run_stats.errors} errors"
+        )
+    report_finished_task(ctx)
+
+
+@app.command("list")
+def list_entries(
+    ctx: typer.Context,
+    cache_dir: Optional[Path] = CACHE_DIR_OPTION,
+    rebuild: bool = REBUILD_OPTION,
+    op_id: Optional[str] = typer.Option(None, "--op-id", help="Only this op_id."),
+    expired: Optional[bool] = typer.Option(
+        None, "--expired/--fresh", help="Only expired, or only fresh entries."
+    ),
+    limit: int = typer.Option(50, "--limit", help="The maximum number listed."),
+):
+    """List entries, most recently stored first."""
+    source = cache_source(ctx, cache_dir)
+    try:
+        entries = source_index(source, rebuild).list_entries(
+            op_id=op_id, expired=expired, limit=limit
+        )
+    finally:
+        source.close()
+    for entry in entries:
+        typer.echo(
+            f"{entry.op_id} {entry.param_sig} {entry.size} "
+            f"stored {format_time(entry.stored)} "
+            f"expires {format_time(entry.expires)}"
+        )
+    report_finished_task(ctx)
+
+
+@app.command()
+def show(
+    ctx: typer.Context,
+    op_id: str = typer.Argument(..., help="The op_id of the entry."),
+    param_sig: str = typer.Argument(..., help="The param_sig of the entry."),
+    cache_dir: Optional[Path] = CACHE_DIR_OPTION,
+    data: bool = typer.Option(False, "--data", help="Also print the JSON body."),
+):
+    """Show the response metadata of an entry."""
+    source = cache_source(ctx, cache_dir)
+    try:
+        result = source.load_result(op_id, param_sig)
+    finally:
+        source.close()
+    if result is None:
+        raise typer.BadParameter(f"No entry for {op_id} {param_sig}.")
+    response = result.response
+    typer.echo(f"{result.op_id} {result.param_sig}")
+    typer.echo(f"{response.status} {response.reason} {response.url}")
+    expires = response.expires_at()
+    typer.echo(
+        f"Expires: {expires.isoformat() if expires is not None else '-'}, "
+        f"fresh: {source.is_fresh(result)}"
+    )
+    for header in response.response_headers:
+        for key, value in header.items():
+            typer.echo(f"  {key}: {value}")
+    if data:
+        typer.echo(result.raw_json())
+    report_finished_task(ctx)
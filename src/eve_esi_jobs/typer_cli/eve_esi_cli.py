@@ -15,6 +15,8 @@ from eve_esi_jobs.eve_esi_jobs import EveEsiJobs
 from eve_esi_jobs.operation_manifest import OperationManifest
 from eve_esi_jobs.typer_cli.app_config import make_config_from_env
 from eve_esi_jobs.typer_cli.app_data import load_schema
+from eve_esi_jobs.typer_cli.cache import app as cache_app
+from eve_esi_jobs.typer_cli.cache import local_source_in
 from eve_esi_jobs.typer_cli.create import app as create_app
 from eve_esi_jobs.typer_cli.do_work_order import app as do_app
 from eve_esi_jobs.typer_cli.examples import app as examples_app
@@ -26,6 +28,7 @@ app.add_typer(do_app, name="do")
 app.add_typer(schema_app, name="schema")
 app.add_typer(create_app, name="create")
 app.add_typer(examples_app, name="examples")
+app.add_typer(cache_app, name="cache")
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +44,14 @@ def eve_esi(
     schema_path: Optional[Path] = typer.Option(
         None, "--schema-path", "-s", help="Path to local schema file."
     ),
+    use_cache: bool = typer.Option(
+        False,
+        "--use-cache",
+        help=(
+            "Keep job results in the cache maintained by `eve-esi cache`, and serve"
+            " results that are still fresh from it."
+        ),
+    ),
 ):
     """
     Welcome to Eve Esi Jobs. Get started by downloading a schema, or checkout the
@@ -76,7 +87,8 @@ def eve_esi(
             schema = download_json(config.schema_url)
             schema_source = config.schema_url
     try:
-        runner = EveEsiJobs(esi_schema=schema)
+        local_source = local_source_in(config.cache_dir) if use_cache else None
+        runner = EveEsiJobs(esi_schema=schema, local_source=local_source)
     except Exception as ex:
         logger.exception(
             "Tried to make EveEsiJobs with invalid schema. version: %s, source: %s, error: %s, msg: %s",
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from aiohttp import ClientSession
+from tests.eve_esi_jobs.conftest import StaticRemoteSource, make_result
+
+from eve_esi_jobs.cache_index import CacheIndex
+from eve_esi_jobs.eve_esi_jobs import JobQueueWorker
+from eve_esi_jobs.models import EsiJob
+from eve_esi_jobs.observers import RunStatsObserver
+from eve_esi_jobs.sources import EsiLocalSource
+
+
+@pytest.mark.asyncio
+async def test_cache_index_follows_source(tmp_path: Path):
+    index = CacheIndex.in_dir(tmp_path)
+    local_source = EsiLocalSource(tmp_path, index=index)
+    now = datetime.now(timezone.utc)
+    jobs = [
+        EsiJob(op_id="get_markets_region_id_history", parameters={"type_id": type_id})
+        for type_id in range(3)
+    ]
+    prices_job = EsiJob(op_id="get_markets_prices")
+    for job in jobs:
+        await local_source.store_result(make_result(job, now + timedelta(hours=1)))
+    await local_source.store_result(make_result(prices_job, now - timedelta(hours=1)))
+    assert await local_source.do_job(jobs[0]) is not None
+    removed = next(
+        entry
+        for entry in local_source.scan_entries()
+        if entry.param_sig == str(jobs[2].param_sig())
+    )
+    assert local_source.remove_entry(removed)
+    await local_source.flush()
+    stats = index.stats()
+    assert stats.entries == 3
+    assert stats.fresh == 2
+    assert stats.expired == 1
+    assert stats.ages["< 1 hour"] == 3
+    assert [op_id_stats.op_id for op_id_stats in stats.op_ids] == [
+        "get_markets_prices",
+        "get_markets_region_id_history",
+    ]
+    assert stats.size == sum(entry.size for entry in local_source.scan_entries())
+    expired = index.list_entries(expired=True)
+    assert [entry.op_id for entry in expired] == ["get_markets_prices"]
+    assert index.get_entry(removed.op_id, removed.param_sig) is None
+    assert index.rebuild(local_source) == 3
+    assert len(index.list_entries(op_id="get_markets_region_id_history")) == 2
+    local_source.close()
+
+
+@pytest.mark.asyncio
+async def test_run_stats(tmp_path: Path):
+    index = CacheIndex.in_dir(tmp_path)
+    local_source = EsiLocalSource(tmp_path, index=index)
+    fresh_job = EsiJob(op_id="get_markets_prices")
+    fetched_job = EsiJob(op_id="get_markets_region_id_history")
+    expires = datetime.now(timezone.utc) + timedelta(hours=1)
+    await local_source.store_result(make_result(fresh_job, expires))
+    observer = RunStatsObserver()
+    worker = JobQueueWorker(
+        local_source=local_source,
+        remote_source=StaticRemoteSource([]),
+        observers=[observer],
+    )
+    async with ClientSession() as session:
+        await worker.do_job(fresh_job, session=session)
+        await worker.do_job(fetched_job, session=session)
+    observer.stats.jobs = 2
+    assert observer.stats.fresh == 1
+    assert observer.stats.fetched == 1
+    assert observer.stats.hit_ratio == 0.5
+    run_id = index.record_run(observer.stats)
+    runs = index.runs()
+    assert [run.run_id for run in runs] == [run_id]
+    assert runs[0].hit_ratio == 0.5
+    local_source.close()
@@ -0,0 +1,252 @@
+import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from typing import List, Optional
+
+import pytest
+from aiohttp import ClientResponseError, ClientSession, RequestInfo
+from multidict import CIMultiDict, CIMultiDictProxy
+from tests.eve_esi_jobs.conftest import make_result
+from yarl import URL
+
+from eve_esi_jobs.aiohttp_queue import AiohttpRequest, RaiseForStatus
+from eve_esi_jobs.cache_maintenance import CacheCollector, CachePolicy, CacheWarmer
+from eve_esi_jobs.exceptions import BadStatusException, DataUnchangedException
+from eve_esi_jobs.models import EsiJob, EsiJobResult
+from eve_esi_jobs.sources import (
+    EsiBlobSource,
+    EsiLocalSource,
+    EsiRemoteSource,
+    EsiSqliteSource,
+)
+
+
+def history_jobs(count: int):
+    return [
+        EsiJob(op_id="get_markets_region_id_history", parameters={"type_id": type_id})
+        for type_id in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_gc_expired_and_lru(tmp_path: Path):
+    local_source = EsiLocalSource(tmp_path)
+    now = datetime.now(timezone.utc)
+    jobs = history_jobs(4)
+    await local_source.store_result(make_result(jobs[0], now - timedelta(hours=2)))
+    for age, job in enumerate(jobs[1:]):
+        await local_source.store_result(make_result(job, now + timedelta(hours=1)))
+        path = local_source.result_path(job.op_id, job.param_sig())
+        accessed = now.timestamp() - 100 + age
+        os.utime(path, (accessed, accessed))
+    # Reading a result makes it the most recently used.
+    assert await local_source.do_job(jobs[1]) is not None
+    temp_file = tmp_path / Path(".left-behind.tmp")
+    temp_file.write_text("partial")
+    os.utime(temp_file, (0, 0))
+    entries = list(local_source.scan_entries())
+    assert len(entries) == 4
+    entry_size = entries[0].size
+    policy = CachePolicy(expired_grace=timedelta(hours=1), max_bytes=entry_size * 2)
+    report = await CacheCollector(local_source, policy, batch_size=2).collect()
+    assert report.scanned == 4
+    assert report.expired == 1
+    assert report.evicted == 1
+    assert report.temp_files == 1
+    assert await local_source.do_job(jobs[0]) is None
+    assert await local_source.do_job(jobs[2]) is None
+    assert await local_source.do_job(jobs[1]) is not None
+    assert await local_source.do_job(jobs[3]) is not None
+
+
+@pytest.mark.asyncio
+async def test_gc_sqlite_op_id_quota(tmp_path: Path):
+    local_source = EsiSqliteSource(tmp_path, batch_size=10)
+    now = datetime.now(timezone.utc)
+    jobs = history_jobs(3)
+    prices_job = EsiJob(op_id="get_markets_prices")
+    for job in jobs + [prices_job]:
+        await local_source.store_result(make_result(job, now - timedelta(minutes=5)))
+    await local_source.flush()
+    entry_size = next(local_source.scan_entries()).size
+    policy = CachePolicy(
+        expired_grace=None,
+        max_bytes_per_op_id=entry_size,
+        op_id_max_bytes={"get_markets_prices": entry_size * 2},
+    )
+    report = await CacheCollector(local_source, policy).collect()
+    assert report.expired == 0
+    assert report.evicted == 2
+    assert await local_source.do_job(prices_job) is not None
+
+
+@pytest.mark.asyncio
+async def test_gc_sqlite_keeps_results_stored_meanwhile(tmp_path: Path):
+    now = datetime.now(timezone.utc)
+    jobs = history_jobs(3)
+    late_result = make_result(jobs[2], now + timedelta(hours=1))
+
+    class StoreDuringWrite(EsiSqliteSource):
+        def _write_rows(self, rows, accessed=None):
+            if late_result.param_sig not in (row[1] for row in rows):
+                # As if the event loop stored a result while the io thread writes.
+                self._pending[(jobs[2].op_id, str(jobs[2].param_sig()))] = (
+                    jobs[2].op_id,
+                    str(jobs[2].param_sig()),
+                    None,
+                    None,
+                    now.timestamp(),
+                    now.timestamp(),
+                    self._encode_result(late_result),
+                )
+            super()._write_rows(rows, accessed)
+
+    local_source = StoreDuringWrite(tmp_path, batch_size=10)
+    await local_source.store_result(make_result(jobs[0], now - timedelta(hours=2)))
+    local_source._write_pending_sync()  # pylint: disable=protected-access
+    # A newer result for an entry being removed is kept.
+    await local_source.store_result(make_result(jobs[0], now + timedelta(hours=1)))
+    report = await CacheCollector(local_source, CachePolicy()).collect()
+    assert report.expired == 0
+    assert await local_source.do_job(jobs[0]) is not None
+    await local_source.flush()
+    assert len(local_source.list_entries()) == 2
+    assert await local_source.do_job(jobs[2]) is not None
+
+
+@pytest.mark.asyncio
+async def test_gc_counts_only_removed_entries(tmp_path: Path):
+    class StuckSource(EsiSqliteSource):
+        def remove_entry(self, entry):
+            if entry.param_sig == str(jobs[0].param_sig()):
+                return False
+            return super().remove_entry(entry)
+
+    local_source = StuckSource(tmp_path)
+    now = datetime.now(timezone.utc)
+    jobs = history_jobs(3)
+    for job in jobs:
+        await local_source.store_result(make_result(job, now + timedelta(hours=1)))
+    entries = list(local_source.scan_entries())
+    policy = CachePolicy(max_bytes=1)
+    report = await CacheCollector(local_source, policy).collect()
+    assert report.evicted == 2
+    assert report.removed_bytes == sum(
+        entry.size for entry in entries if entry.param_sig != str(jobs[0].param_sig())
+    )
+    assert await local_source.do_job(jobs[0]) is not None
+    assert len(local_source.list_entries(op_id=jobs[0].op_id)) == 1
+    local_source.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("source_class", [EsiLocalSource, EsiBlobSource])
+async def test_gc_keeps_files_stored_meanwhile(tmp_path: Path, source_class):
+    """A result stored again between the scan and the removal is kept."""
+    now = datetime.now(timezone.utc)
+    jobs = history_jobs(3)
+    restored = make_result(jobs[0], now + timedelta(hours=1), data=[{"type_id": 36}])
+
+    class StoreDuringRemove(source_class):
+        def remove_entry(self, entry):
+            if entry.param_sig == str(jobs[0].param_sig()):
+                self._write_result(
+                    self.result_path(entry.op_id, entry.param_sig), restored
+                )
+            return super().remove_entry(entry)
+
+    local_source = StoreDuringRemove(tmp_path)
+    for job in jobs:
+        await local_source.store_result(make_result(job, now + timedelta(hours=1)))
+    # Scanned as written long ago.
+    for job in jobs:
+        os.utime(local_source.result_path(job.op_id, job.param_sig()), (0, 0))
+    report = await CacheCollector(local_source, CachePolicy(max_bytes=1)).collect()
+    assert report.evicted == 2
+    kept = await local_source.do_job(jobs[0])
+    assert kept is not None and kept.data == [{"type_id": 36}]
+    assert await local_source.do_job(jobs[1]) is None
+
+
+@pytest.mark.asyncio
+async def test_gc_unreferenced_blobs(tmp_path: Path):
+    local_source = EsiBlobSource(tmp_path)
+    now = datetime.now(timezone.utc)
+    jobs = history_jobs(3)
+    await local_source.store_result(make_result(jobs[0], now - timedelta(hours=2)))
+    for job in jobs[1:]:
+        await local_source.store_result(
+            make_result(job, now + timedelta(hours=1), data=[])
+        )
+    for blob_path in local_source.blob_root.glob("*/*.json"):
+        os.utime(blob_path, (0, 0))
+    report = await CacheCollector(local_source, CachePolicy()).collect()
+    assert report.expired == 1
+    assert report.blobs == 1
+    # The shared body is still in use.
+    assert len(list(local_source.blob_root.glob("*/*.json"))) == 1
+    assert (await local_source.do_job(jobs[2])).data == []
+
+
+class UnchangedRemoteSource(EsiRemoteSource):
+    """Answers 304 for known etags, otherwise new data, and fails for type_id 0."""
+
+    def __init__(self) -> None:
+        # pylint: disable=super-init-not-called
+        self.etags: List[Optional[str]] = []
+
+    async def do_job(
+        self, job: EsiJob, session: ClientSession, etag: Optional[str] = None
+    ) -> EsiJobResult:
+        self.etags.append(etag)
+        request = AiohttpRequest(id_="1", method="GET", url="https://esi.test/")
+        if job.parameters.get("type_id") == 0:
+            raise BadStatusException(None, exception=self.status(request, 404, {}))
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        if etag is not None:
+            headers = {"Expires": format_datetime(expires, usegmt=True), "ETag": etag}
+            raise DataUnchangedException(
+                None, exception=self.status(request, 304, headers)
+            )
+        return make_result(job, expires, data=[{"type_id": 36}])
+
+    @staticmethod
+    def status(request: AiohttpRequest, status: int, headers) -> RaiseForStatus:
+        request_info = RequestInfo(
+            URL(request.url),
+            request.method,
+            CIMultiDictProxy(CIMultiDict()),
+            URL(request.url),
+        )
+        error = ClientResponseError(
+            request_info, (), status=status, headers=CIMultiDict(headers)
+        )
+        return RaiseForStatus(None, request=request, exception=error)
+
+
+@pytest.mark.asyncio
+async def test_cache_warmer(tmp_path: Path):
+    local_source = EsiLocalSource(tmp_path)
+    now = datetime.now(timezone.utc)
+    jobs = history_jobs(4)
+    await local_source.store_result(make_result(jobs[1], now + timedelta(hours=1)))
+    await local_source.store_result(make_result(jobs[2], now - timedelta(hours=1)))
+    remote_source = UnchangedRemoteSource()
+    warmer = CacheWarmer(local_source, remote_source)
+    async with ClientSession() as session:
+        report = await warmer.warm(jobs, session)
+    assert report.jobs == 4
+    assert report.fresh == 1
+    assert report.revalidated == 1
+    assert report.updated == 1
+    assert report.errors == 1
+    assert sorted(remote_source.etags, key=lambda etag: etag or "") == [
+        None,
+        None,
+        '"abc"',
+    ]
+    revalidated = await local_source.do_job(jobs[2])
+    assert revalidated is not None and local_source.is_fresh(revalidated)
+    updated = await local_source.do_job(jobs[3])
+    assert updated is not None and updated.data == [{"type_id": 36}]
@@ -11,3 +11,631 @@
 
 
 # TODO test each callback here
+
+import asyncio
+import csv
+import json
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from pathlib import Path
+from string import Template
+from typing import List, Optional
+
+import pytest
+import yaml
+from tests.eve_esi_jobs.conftest import FileResource, StaticRemoteSource, make_result
+
+from eve_esi_jobs.callback_manifest import new_manifest
+from eve_esi_jobs.callbacks import CallbackRunner, PathTemplate
+from eve_esi_jobs.columnar import ArrowFileSink
+from eve_esi_jobs.compression import decompress
+from eve_esi_jobs.eve_esi_jobs import EveEsiJobs
+from eve_esi_jobs.models import EsiJob, EsiJobResult, JobCallback
+from eve_esi_jobs.sinks import JsonLinesSink, SinkRegistry, SqliteSink, SqliteTable
+from eve_esi_jobs.sources import EsiLocalSource
+
+DATA = [
+    {"type_id": 34, "average_price": 5.0},
+    {"type_id": 35, "average_price": 6.0},
+]
+
+
+def result_job(tmp_path: Path) -> EsiJob:
+    job = EsiJob(op_id="get_markets_prices")
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    result = make_result(job, expires)
+    job.result = EsiJobResult.from_raw(
+        op_id=result.op_id,
+        param_sig=result.param_sig,
+        response=result.response,
+        raw=json.dumps(DATA),
+    )
+    job.callbacks = [
+        JobCallback(
+            callback_id="save_result_to_json_file",
+            kwargs={"file_path_template": str(tmp_path / "prices"), "indent": 2},
+        ),
+        JobCallback(
+            callback_id="save_result_to_yaml_file",
+            kwargs={"file_path_template": str(tmp_path / "prices")},
+        ),
+        JobCallback(
+            callback_id="save_list_of_dict_result_to_csv_file",
+            kwargs={
+                "file_path_template": str(tmp_path / "prices"),
+                "additional_fields": {"region_id": 10000002},
+            },
+        ),
+    ]
+    return job
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_processes", [1, 0, None])
+async def test_file_callbacks(tmp_path: Path, max_processes: Optional[int]):
+    job = result_job(tmp_path)
+    # None leaves the callbacks without a runner.
+    runner = (
+        CallbackRunner(max_processes=max_processes)
+        if max_processes is not None
+        else None
+    )
+    manifest = new_manifest()
+    try:
+        for job_callback in job.callbacks:
+            callback = manifest.init_callback(job_callback, job)
+            callback.runner = runner
+            await callback.do_callback()
+    finally:
+        if runner is not None:
+            runner.close()
+    assert json.loads((tmp_path / "prices.json").read_text()) == DATA
+    assert (tmp_path / "prices.json").read_text().startswith("[\n  {")
+    assert yaml.safe_load((tmp_path / "prices.yaml").read_text()) == DATA
+    with open(tmp_path / "prices.csv", newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert rows[1] == {"type_id": "35", "average_price": "6.0", "region_id": "10000002"}
+    assert not job.result.is_parsed
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+async def test_compressed_file_callbacks(tmp_path: Path, compression: str):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    job = result_job(tmp_path)
+    job.callbacks.append(
+        JobCallback(
+            callback_id="save_result_to_json_file",
+            kwargs={"file_path_template": str(tmp_path / "raw-prices")},
+        )
+    )
+    for job_callback in job.callbacks:
+        job_callback.kwargs["compression"] = compression
+    runner = CallbackRunner(max_processes=0)
+    manifest = new_manifest()
+    try:
+        for job_callback in job.callbacks:
+            callback = manifest.init_callback(job_callback, job)
+            callback.runner = runner
+            await callback.do_callback()
+    finally:
+        await runner.aclose()
+    suffix = {"gzip": ".gz", "zstd": ".zst"}[compression]
+
+    def read_text(file_name: str) -> str:
+        data = (tmp_path / f"{file_name}{suffix}").read_bytes()
+        return decompress(data).decode()
+
+    assert json.loads(read_text("prices.json")) == DATA
+    assert read_text("prices.json").startswith("[\n  {")
+    assert json.loads(read_text("raw-prices.json")) == DATA
+    assert yaml.safe_load(read_text("prices.yaml")) == DATA
+    rows = list(csv.DictReader(read_text("prices.csv").splitlines()))
+    assert rows[1] == {"type_id": "35", "average_price": "6.0", "region_id": "10000002"}
+    assert not (tmp_path / "prices.json").exists()
+    assert runner.files_written == 4
+
+
+def test_jsonl_sink(tmp_path: Path, esi_schema: FileResource):
+    runner = EveEsiJobs(
+        esi_schema=esi_schema.data, remote_source=StaticRemoteSource([{"a": 1}])
+    )
+    jobs = [
+        EsiJob(
+            op_id="get_markets_region_id_history",
+            parameters={"region_id": 10000002, "type_id": type_id},
+            callbacks=[
+                JobCallback(
+                    callback_id="save_result_to_jsonl",
+                    kwargs={
+                        "file_path_template": str(tmp_path / "${region_id}-history"),
+                        "flush_lines": 3,
+                    },
+                )
+            ],
+        )
+        for type_id in range(10)
+    ]
+    runner.do_jobs(jobs)
+    lines = (tmp_path / "10000002-history.jsonl").read_text().splitlines()
+    assert len(lines) == 10
+    records = [json.loads(line) for line in lines]
+    assert sorted(record["parameters"]["type_id"] for record in records) == list(
+        range(10)
+    )
+    assert records[0]["data"] == [{"a": 1}]
+    assert records[0]["op_id"] == "get_markets_region_id_history"
+
+
+@pytest.mark.asyncio
+async def test_jsonl_sink_flushes_on_timer(tmp_path: Path):
+    sinks = SinkRegistry()
+    file_path = tmp_path / "timed.jsonl"
+    sink = sinks.get(
+        "timed", partial(JsonLinesSink, file_path, flush_lines=10, flush_seconds=0.05)
+    )
+    assert not sink.write('{"a": 1}')
+    # No more lines arrive, the registry writes the buffered one.
+    for _ in range(100):
+        await asyncio.sleep(0.02)
+        if file_path.exists() and file_path.read_text():
+            break
+    assert file_path.read_text() == '{"a": 1}\n'
+    sink.write('{"a": 2}')
+    await sinks.close()
+    assert file_path.read_text().splitlines() == ['{"a": 1}', '{"a": 2}']
+
+
+@pytest.mark.asyncio
+async def test_jsonl_line_breaks(tmp_path: Path):
+    job = result_job(tmp_path)
+    assert job.result is not None
+    job.result = EsiJobResult.from_raw(
+        op_id=job.op_id,
+        param_sig=job.param_sig(),
+        response=job.result.response,
+        raw=json.dumps(DATA, indent=2),
+    )
+    job_callback = JobCallback(
+        callback_id="save_result_to_jsonl",
+        kwargs={
+            "file_path_template": str(tmp_path / "prices"),
+            "include_attributes": True,
+        },
+    )
+    callback = new_manifest().init_callback(job_callback, job)
+    await callback.do_callback()
+    await callback.do_callback()
+    lines = (tmp_path / "prices.jsonl").read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[1])["data"] == DATA
+    assert "attributes" in json.loads(lines[1])
+
+
+def test_sqlite_sink(tmp_path: Path, esi_schema: FileResource):
+    history = [
+        {"date": "2021-06-01", "average": 5.0, "volume": 10, "order_count": 2},
+        {"date": "2021-06-02", "average": 6.0, "volume": 12, "order_count": 3},
+    ]
+    runner = EveEsiJobs(
+        esi_schema=esi_schema.data, remote_source=StaticRemoteSource(history)
+    )
+    jobs = [
+        EsiJob(
+            op_id="get_markets_region_id_history",
+            parameters={"region_id": 10000002, "type_id": type_id},
+            callbacks=[
+                JobCallback(
+                    callback_id="save_result_to_sqlite",
+                    kwargs={
+                        "file_path_template": str(tmp_path / "market"),
+                        "table": "history_${region_id}",
+                        "key_columns": ["type_id", "date"],
+                        "additional_fields": {"type_id": type_id},
+                        "batch_size": 3,
+                    },
+                )
+            ],
+        )
+        for type_id in range(10)
+    ]
+    runner.do_jobs(jobs)
+    runner.do_jobs(jobs)
+    with sqlite3.connect(str(tmp_path / "market.sqlite")) as connection:
+        columns = {
+            row[1]: row[2]
+            for row in connection.execute("PRAGMA table_info(history_10000002)")
+        }
+        rows = connection.execute(
+            "SELECT type_id, date, average, volume FROM history_10000002 "
+            "ORDER BY type_id, date"
+        ).fetchall()
+    # Columns come from the response schema, plus the additional fields.
+    assert columns["highest"] == "REAL"
+    assert columns["order_count"] == "INTEGER"
+    assert columns["type_id"] == "INTEGER"
+    # Upserted, so the second run replaced the rows of the first.
+    assert len(rows) == 20
+    assert rows[0] == (0, "2021-06-01", 5.0, 10)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_inferred_columns(tmp_path: Path):
+    job = result_job(tmp_path)
+    job_callback = JobCallback(
+        callback_id="save_result_to_sqlite",
+        kwargs={"file_path_template": str(tmp_path / "prices")},
+    )
+    callback = new_manifest().init_callback(job_callback, job)
+    await callback.do_callback()
+    await callback.do_callback()
+    with sqlite3.connect(str(tmp_path / "prices.sqlite")) as connection:
+        rows = connection.execute(
+            "SELECT type_id, average_price FROM get_markets_prices"
+        ).fetchall()
+    # No key columns, so rows are appended.
+    assert len(rows) == 4
+    assert rows[:2] == [(34, 5.0), (35, 6.0)]
+
+
+@pytest.mark.asyncio
+async def test_sqlite_sink_keeps_good_results(tmp_path: Path):
+    """A result that can't be written doesn't lose the rest of its batch."""
+    sink = SqliteSink(tmp_path / "prices.sqlite", batch_size=10)
+    table = SqliteTable(name="prices")
+    await sink.put(table, json.dumps([{"type_id": 34}]))
+    await sink.put(table, "not json")
+    await sink.put(table, json.dumps([{"type_id": 35}]))
+    await sink.aclose()
+    assert (sink.rows_written, sink.errors) == (2, 1)
+    with sqlite3.connect(str(tmp_path / "prices.sqlite")) as connection:
+        rows = connection.execute("SELECT type_id FROM prices").fetchall()
+    assert rows == [(34,), (35,)]
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "feather"])
+def test_arrow_file(tmp_path: Path, esi_schema: FileResource, file_format: str):
+    pyarrow = pytest.importorskip("pyarrow")
+    history = [
+        {"date": "2021-06-01", "average": 5.0, "volume": 10, "order_count": 2},
+        {"date": "2021-06-02", "average": 6.0, "volume": 12, "order_count": 3},
+    ]
+    runner = EveEsiJobs(
+        esi_schema=esi_schema.data, remote_source=StaticRemoteSource(history)
+    )
+    jobs = [
+        EsiJob(
+            op_id="get_markets_region_id_history",
+            parameters={"region_id": 10000002, "type_id": type_id},
+            callbacks=[
+                JobCallback(
+                    callback_id="save_result_to_parquet",
+                    kwargs={
+                        "file_path_template": str(tmp_path / "history"),
+                        "file_format": file_format,
+                        "additional_fields": {"type_id": type_id},
+                        "row_group_size": 4,
+                        "flush_results": 3,
+                    },
+                )
+            ],
+        )
+        for type_id in range(10)
+    ]
+    runner.do_jobs(jobs)
+    file_path = tmp_path / f"history.{file_format}"
+    if file_format == "parquet":
+        import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+
+        assert pyarrow.parquet.ParquetFile(file_path).num_row_groups == 5
+        table = pyarrow.parquet.read_table(file_path)
+    else:
+        import pyarrow.feather  # pylint: disable=import-outside-toplevel
+
+        table = pyarrow.feather.read_table(file_path)
+    assert table.num_rows == 20
+    # Types come from the response schema.
+    assert table.schema.field("date").type == pyarrow.date32()
+    assert table.schema.field("volume").type == pyarrow.int64()
+    assert table.schema.field("highest").type == pyarrow.float64()
+    assert sorted(set(table.column("type_id").to_pylist())) == list(range(10))
+    assert table.column("date").to_pylist()[0].isoformat() == "2021-06-01"
+
+
+@pytest.mark.asyncio
+async def test_arrow_file_inferred_schema(tmp_path: Path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+
+    job = result_job(tmp_path)
+    job_callback = JobCallback(
+        callback_id="save_result_to_parquet",
+        kwargs={"file_path_template": str(tmp_path / "prices")},
+    )
+    callback = new_manifest().init_callback(job_callback, job)
+    await callback.do_callback()
+    table = pyarrow.parquet.read_table(tmp_path / "prices.parquet")
+    assert table.to_pylist() == DATA
+
+
+@pytest.mark.asyncio
+async def test_arrow_file_keeps_good_results(tmp_path: Path):
+    """A result that can't be converted doesn't lose the other buffered results."""
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+
+    sink = ArrowFileSink(tmp_path / "prices.parquet")
+    for raw_json in (json.dumps(DATA[:1]), "not json", json.dumps(DATA[1:])):
+        sink.write(raw_json)
+    await sink.aclose()
+    assert (sink.rows_written, sink.errors) == (len(DATA), 1)
+    table = pyarrow.parquet.read_table(tmp_path / "prices.parquet")
+    assert table.to_pylist() == DATA
+
+
+def test_skip_unchanged_files(tmp_path: Path, esi_schema: FileResource):
+    remote_source = StaticRemoteSource(DATA)
+    runner = EveEsiJobs(esi_schema=esi_schema.data, remote_source=remote_source)
+
+    def jobs(indent: Optional[int]):
+        return [
+            EsiJob(
+                op_id="get_markets_region_id_history",
+                parameters={"region_id": 10000002, "type_id": type_id},
+                callbacks=[
+                    JobCallback(
+                        callback_id="save_result_to_json_file",
+                        kwargs={
+                            "file_path_template": str(tmp_path / "${type_id}"),
+                            "indent": indent,
+                        },
+                    ),
+                    JobCallback(
+                        callback_id="save_list_of_dict_result_to_csv_file",
+                        kwargs={"file_path_template": str(tmp_path / "${type_id}")},
+                    ),
+                ],
+            )
+            for type_id in range(5)
+        ]
+
+    runner.do_jobs(jobs(indent=None))
+    assert (runner.files_written, runner.files_skipped) == (10, 0)
+    mtime = (tmp_path / "0.json").stat().st_mtime_ns
+    runner.do_jobs(jobs(indent=None))
+    assert (runner.files_written, runner.files_skipped) == (10, 10)
+    assert (tmp_path / "0.json").stat().st_mtime_ns == mtime
+    # Changed outside the run, or rendered differently, the file is written again.
+    (tmp_path / "0.csv").write_text("edited")
+    runner.do_jobs(jobs(indent=2))
+    assert (runner.files_written, runner.files_skipped) == (16, 14)
+    assert json.loads((tmp_path / "0.json").read_text()) == DATA
+    with open(tmp_path / "0.csv", newline="") as file:
+        assert len(list(csv.DictReader(file))) == 2
+
+
+@pytest.mark.asyncio
+async def test_skip_unchanged_needs_a_runner(tmp_path: Path):
+    """Callbacks without a runner have no shared hash index, and always write."""
+    manifest = new_manifest()
+    jobs = [
+        EsiJob(
+            op_id="get_markets_region_id_history",
+            parameters={"region_id": 10000002, "type_id": type_id},
+            callbacks=[
+                JobCallback(
+                    callback_id="save_result_to_json_file",
+                    kwargs={"file_path_template": str(tmp_path / "${type_id}")},
+                )
+            ],
+        )
+        for type_id in range(5)
+    ]
+    for job in jobs:
+        job.result = make_result(job, None, DATA)
+    callbacks = [manifest.init_callback(job.callbacks[0], job) for job in jobs]
+    await asyncio.gather(*(callback.do_callback() for callback in callbacks))
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        f"{type_id}.json" for type_id in range(5)
+    ]
+
+
+@pytest.mark.parametrize(
+    "template,file_ending",
+    [
+        ("data/market-history-${region_id}-${type_id}.json", ".json"),
+        ("data/${esi_job_op_id}/${region_id}/$type_id", ".csv"),
+        ("data/${region_id}.${type_id}.tar", ".gz"),
+        ("data/$$${missing}-{${type_id}}-$", ".json"),
+        ("data/.hidden", ".json"),
+        ("data/${region_id}/", None),
+        ("data/constant.txt", ".json"),
+    ],
+)
+def test_path_template(template: str, file_ending: Optional[str]):
+    job = EsiJob(
+        op_id="get_markets_region_id_history",
+        parameters={"region_id": 10000002, "type_id": 34},
+    )
+    expected = Path(Template(template).safe_substitute(job.attributes()))
+    if file_ending is not None:
+        expected = expected.with_suffix(file_ending)
+    assert PathTemplate(template, file_ending).resolve(job) == expected
+
+
+def test_callback_plans():
+    manifest = new_manifest()
+    jobs = [
+        EsiJob(
+            op_id="get_markets_prices",
+            parameters={"type_id": type_id},
+            callbacks=[
+                JobCallback(
+                    callback_id="save_result_to_json_file",
+                    kwargs={"file_path_template": "data/${type_id}"},
+                )
+            ],
+        )
+        for type_id in range(3)
+    ]
+    callbacks = [manifest.init_callback(job.callbacks[0], job) for job in jobs]
+    # Equal definitions share a plan, and its parsed path template.
+    assert manifest.plan(jobs[0].callbacks[0]) is manifest.plan(jobs[2].callbacks[0])
+    for callback in callbacks:
+        callback.refine_path()
+    assert callbacks[0].path_template is callbacks[2].path_template
+    assert [callback.file_path for callback in callbacks] == [
+        Path(f"data/{type_id}.json") for type_id in range(3)
+    ]
+    # Bad kwargs are found when the plan is made.
+    with pytest.raises(TypeError):
+        manifest.plan(
+            JobCallback(
+                callback_id="save_result_to_json_file",
+                kwargs={"file_path_template": "data/x", "no_such_kwarg": 1},
+            )
+        )
+
+
+def test_callback_plans_are_bounded():
+    manifest = new_manifest()
+    manifest.max_plans = 3
+
+    def job_callback(type_id: int) -> JobCallback:
+        return JobCallback(
+            callback_id="save_result_to_json_file",
+            kwargs={"file_path_template": f"data/{type_id}"},
+        )
+
+    first = manifest.plan(job_callback(0))
+    for type_id in range(1, 10):
+        manifest.plan(job_callback(type_id))
+        # Recently used plans are kept.
+        assert manifest.plan(job_callback(0)) is first
+    assert len(manifest._plans) == 3  # pylint: disable=protected-access
+
+
+def test_directories_made_once_per_run(
+    tmp_path: Path, esi_schema: FileResource, monkeypatch
+):
+    local_source = EsiLocalSource(tmp_path / "cache")
+    runner = EveEsiJobs(
+        esi_schema=esi_schema.data,
+        local_source=local_source,
+        remote_source=StaticRemoteSource(DATA),
+    )
+    jobs = [
+        EsiJob(
+            op_id="get_markets_region_id_history",
+            parameters={"region_id": region_id, "type_id": type_id},
+            callbacks=[
+                JobCallback(
+                    callback_id="save_result_to_json_file",
+                    kwargs={
+                        "file_path_template": str(
+                            tmp_path / "out" / "${region_id}" / "${type_id}"
+                        ),
+                    },
+                )
+            ],
+        )
+        for region_id in range(2)
+        for type_id in range(10)
+    ]
+    made: List[Path] = []
+    mkdir = Path.mkdir
+
+    def counting_mkdir(self, *args, **kwargs):
+        made.append(self)
+        mkdir(self, *args, **kwargs)
+
+    monkeypatch.setattr(Path, "mkdir", counting_mkdir)
+    runner.do_jobs(jobs)
+    assert len(list((tmp_path / "out").glob("*/[0-9].json"))) == 20
+    assert len(list((tmp_path / "cache").glob("get_*.json"))) == 20
+    # The cache directory and the output directories, made once per run rather
+    # than once per job. Making a missing parent retries the child.
+    assert set(made) == {
+        tmp_path / "cache",
+        tmp_path / "out",
+        tmp_path / "out" / "0",
+        tmp_path / "out" / "1",
+    }
+    assert len(made) <= 6
+    assert tmp_path / "cache" in local_source.directories
+
+
+ORDERS = [
+    {"type_id": 34, "is_buy_order": True, "price": 4.0, "volume_remain": 10},
+    {"type_id": 34, "is_buy_order": False, "price": 5.2, "volume_remain": 10},
+    {"type_id": 35, "is_buy_order": False, "price": 7.0, "volume_remain": 3},
+    {"type_id": 34, "is_buy_order": True, "price": 3.0, "volume_remain": 100},
+    {"type_id": 34, "is_buy_order": False, "price": 5.0, "volume_remain": 20},
+    {"type_id": 34, "is_buy_order": True, "price": 3.9, "volume_remain": 5},
+    {"type_id": 34, "is_buy_order": False, "price": 6.0, "volume_remain": 1},
+]
+
+
+def test_summarize_order_book():
+    pytest.importorskip("numpy")
+    from eve_esi_jobs.order_book import (  # pylint: disable=import-outside-toplevel
+        summarize_order_book,
+    )
+
+    rows = summarize_order_book(ORDERS, [5.0, 50.0])
+    assert [row["type_id"] for row in rows] == [34, 35]
+    assert rows[0] == {
+        "type_id": 34,
+        "best_bid": 4.0,
+        "best_ask": 5.0,
+        "spread": 1.0,
+        "buy_orders": 3,
+        "sell_orders": 3,
+        "buy_volume": 115,
+        "sell_volume": 31,
+        "buy_weighted_price": pytest.approx(359.5 / 115),
+        "sell_weighted_price": pytest.approx(158 / 31),
+        "buy_depth_5pct": 15,
+        "sell_depth_5pct": 30,
+        "buy_depth_50pct": 115,
+        "sell_depth_50pct": 31,
+    }
+    # A type without buy orders.
+    assert rows[1]["best_bid"] is None
+    assert rows[1]["spread"] is None
+    assert rows[1]["buy_volume"] == 0
+    assert rows[1]["sell_weighted_price"] == 7.0
+    assert summarize_order_book([]) == []
+    only_sells = summarize_order_book(ORDERS[2:3])
+    assert only_sells[0]["best_ask"] == 7.0
+    assert only_sells[0]["buy_orders"] == 0
+
+
+def test_order_book_summary_callback(tmp_path: Path, esi_schema: FileResource):
+    pytest.importorskip("numpy")
+    runner = EveEsiJobs(
+        esi_schema=esi_schema.data, remote_source=StaticRemoteSource(ORDERS)
+    )
+    job = EsiJob(
+        op_id="get_markets_region_id_orders",
+        parameters={"region_id": 10000002, "order_type": "all"},
+        callbacks=[
+            JobCallback(
+                callback_id="save_order_book_summary_to_csv_file",
+                kwargs={
+                    "file_path_template": str(tmp_path / "summary-${region_id}"),
+                    "additional_fields": {"region_id": 10000002},
+                },
+            )
+        ],
+    )
+    runner.do_jobs([job])
+    with open(tmp_path / "summary-10000002.csv", newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert [row["type_id"] for row in rows] == ["34", "35"]
+    assert rows[0]["best_bid"] == "4.0"
+    assert rows[0]["sell_depth_5pct"] == "30"
+    assert rows[1]["best_bid"] == ""
+    assert rows[1]["region_id"] == "10000002"
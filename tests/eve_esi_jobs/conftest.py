@@ -2,18 +2,24 @@
 import json
 import logging
 from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
 from importlib import resources
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 import pytest
+from aiohttp import ClientSession
 from rich import inspect
 
+from eve_esi_jobs.aiohttp_queue import ResponseMeta
 from eve_esi_jobs.helpers import optional_object
+from eve_esi_jobs.models import EsiJob, EsiJobResult
 
 # from eve_esi_jobs.esi_provider import EsiProvider
 from eve_esi_jobs.operation_manifest import OperationManifest
+from eve_esi_jobs.sources import EsiRemoteSource
 
 APP_LOG_LEVEL = logging.INFO
 
@@ -24,6 +30,46 @@ class FileResource:
     data: Any
 
 
+def make_response_meta(expires: Optional[datetime], etag: str = '"abc"'):
+    headers = [{"ETag": etag}]
+    if expires is not None:
+        headers.append({"Expires": format_datetime(expires, usegmt=True)})
+    return ResponseMeta(
+        version="1.1",
+        status=200,
+        reason="OK",
+        cookies="",
+        response_headers=headers,
+        method="GET",
+        url="https://esi.evetech.net/latest/markets/prices/",
+        real_url="https://esi.evetech.net/latest/markets/prices/",
+        request_headers=[],
+    )
+
+
+def make_result(job: EsiJob, expires: Optional[datetime], data=None) -> EsiJobResult:
+    return EsiJobResult(
+        op_id=job.op_id,
+        param_sig=job.param_sig(),
+        response=make_response_meta(expires),
+        data=data if data is not None else [{"type_id": 34, "average_price": 5.0}],
+    )
+
+
+class StaticRemoteSource(EsiRemoteSource):
+    def __init__(self, data) -> None:
+        # pylint: disable=super-init-not-called
+        self.requests = 0
+        self.data = data
+
+    async def do_job(
+        self, job: EsiJob, session: ClientSession, etag: Optional[str] = None
+    ) -> EsiJobResult:
+        self.requests += 1
+        expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+        return make_result(job, expires, data=self.data)
+
+
 @pytest.fixture(scope="session", name="logger")
 def logger_(test_log_path):
     log_level = logging.DEBUG
@@ -1,16 +1,26 @@
 import asyncio
+import json
+from asyncio import Queue
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from logging import Logger
 from pathlib import Path
-from typing import Dict
+from time import perf_counter
+from typing import Dict, List, Optional
 
 import pytest
 from aiohttp import ClientSession
 from rich import print
-from tests.eve_esi_jobs.conftest import FileResource
+from tests.eve_esi_jobs.conftest import FileResource, make_result
 
+from eve_esi_jobs.callback_manifest import new_manifest
+from eve_esi_jobs.callbacks import EsiJobCallback
+from eve_esi_jobs.eve_esi_jobs import EveEsiJobs, JobQueueWorker
 from eve_esi_jobs.examples import jobs as example_jobs
-from eve_esi_jobs.models import EsiJob
+from eve_esi_jobs.models import EsiJob, EsiJobResult, JobCallback
+from eve_esi_jobs.observers import QueueObserver
 from eve_esi_jobs.operation_manifest import OperationManifest
+from eve_esi_jobs.sources import EsiRemoteSource
 
 # @pytest.mark.asyncio
 # async def test_queue_worker(
@@ -136,3 +146,196 @@ from eve_esi_jobs.operation_manifest import OperationManifest
 #     assert len(files) == 1
 #     for file in files:
 #         assert file.stat().st_size > 5
+
+
+class SlowRemoteSource(EsiRemoteSource):
+    """Counts the fetches in flight at once."""
+
+    def __init__(self) -> None:
+        # pylint: disable=super-init-not-called
+        self.active = 0
+        self.max_active = 0
+        self.fetched: List[float] = []
+
+    async def do_job(
+        self, job: EsiJob, session: ClientSession, etag: Optional[str] = None
+    ) -> EsiJobResult:
+        self.active += 1
+        self.max_active = max(self.active, self.max_active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        self.fetched.append(perf_counter())
+        expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+        return make_result(job, expires)
+
+
+class SlowCallback(EsiJobCallback):
+    active = 0
+    max_active = 0
+    finished: List[float] = []
+
+    async def do_callback(self):
+        SlowCallback.active += 1
+        SlowCallback.max_active = max(SlowCallback.active, SlowCallback.max_active)
+        await asyncio.sleep(0.05)
+        SlowCallback.active -= 1
+        SlowCallback.finished.append(perf_counter())
+
+
+def test_callback_workers(esi_schema: FileResource):
+    callback_manifest = new_manifest()
+    callback_manifest.add_callback("slow", SlowCallback, SlowCallback)
+    remote_source = SlowRemoteSource()
+    runner = EveEsiJobs(
+        esi_schema=esi_schema.data,
+        remote_source=remote_source,
+        callback_manifest=callback_manifest,
+        callback_workers=2,
+        callback_queue_size=1,
+    )
+    jobs = [
+        EsiJob(
+            op_id="get_markets_region_id_history",
+            parameters={"region_id": 10000002, "type_id": type_id},
+            callbacks=[JobCallback(callback_id="slow")],
+        )
+        for type_id in range(6)
+    ]
+    runner.do_jobs(jobs, max_workers=3)
+    assert all(job.result is not None for job in jobs)
+    assert remote_source.max_active == 3
+    assert len(SlowCallback.finished) == 6
+    assert SlowCallback.max_active == 2
+    # Fetching finished while callbacks were still running.
+    assert max(remote_source.fetched) < max(SlowCallback.finished)
+
+
+class RecordingCallback(EsiJobCallback):
+    def __init__(self, job: EsiJob, name: str, events: List[str]) -> None:
+        super().__init__(job)
+        self.name = name
+        self.events = events
+
+    async def do_callback(self):
+        self.events.append(f"start {self.name}")
+        await asyncio.sleep(0.01)
+        if self.name == "broken":
+            raise ValueError("Broken callback")
+        self.events.append(f"end {self.name}")
+
+
+@pytest.mark.asyncio
+async def test_callback_stages():
+    events: List[str] = []
+    callback_manifest = new_manifest()
+    callback_manifest.add_callback(
+        "record", RecordingCallback, partial(RecordingCallback, events=events)
+    )
+    job = EsiJob(
+        op_id="get_markets_prices",
+        callbacks=[
+            JobCallback(callback_id="record", kwargs={"name": "csv"}),
+            JobCallback(callback_id="record", kwargs={"name": "index"}, stage=1),
+            JobCallback(callback_id="record", kwargs={"name": "broken"}),
+            JobCallback(callback_id="record", kwargs={"name": "json"}),
+        ],
+    )
+    errors: List[Exception] = []
+
+    class ErrorObserver(QueueObserver):
+        def update(self, worker, job, result=None, msg="", exceptions=None, **kwargs):
+            errors.extend(exceptions or [])
+
+    worker = JobQueueWorker(
+        local_source=None,
+        remote_source=SlowRemoteSource(),
+        callback_manifest=callback_manifest,
+        observers=[ErrorObserver()],
+    )
+    await worker.run_callbacks(job)
+    # Stage 0 callbacks overlap, stage 1 waits for them.
+    assert events[:3] == ["start csv", "start broken", "start json"]
+    assert events[-2:] == ["start index", "end index"]
+    assert len(errors) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("execution_mode", ["inline", "thread"])
+async def test_job_transform(tmp_path: Path, execution_mode: str):
+    orders = [
+        {"type_id": 34, "price": 5.0, "is_buy_order": True, "volume_remain": 10},
+        {"type_id": 35, "price": 6.0, "is_buy_order": False, "volume_remain": 20},
+        {"type_id": 36, "price": 7.0, "is_buy_order": False, "volume_remain": 30},
+    ]
+    shared_result = make_result(
+        EsiJob(op_id="get_markets_region_id_orders"),
+        datetime.now(timezone.utc) + timedelta(minutes=5),
+    )
+    shared_result.data = orders
+    job = EsiJob(
+        op_id="get_markets_region_id_orders",
+        transform={
+            "fields": ["type_id", "price"],
+            "filters": [{"field": "is_buy_order", "value": False}],
+            "rename": {"price": "sell_price"},
+            "execution_mode": execution_mode,
+        },
+        callbacks=[
+            JobCallback(
+                callback_id="save_result_to_json_file",
+                kwargs={"file_path_template": str(tmp_path / "orders.json")},
+            ),
+            JobCallback(
+                callback_id="save_list_of_dict_result_to_csv_file",
+                kwargs={"file_path_template": str(tmp_path / "orders.csv")},
+            ),
+        ],
+    )
+    job.result = shared_result
+    worker = JobQueueWorker(
+        local_source=None,
+        remote_source=SlowRemoteSource(),
+        callback_manifest=new_manifest(),
+    )
+    await worker.run_callbacks(job)
+    expected = [
+        {"type_id": 35, "sell_price": 6.0},
+        {"type_id": 36, "sell_price": 7.0},
+    ]
+    assert json.loads((tmp_path / "orders.json").read_text()) == expected
+    csv_lines = (tmp_path / "orders.csv").read_text().splitlines()
+    assert csv_lines == ["type_id,sell_price", "35,6.0", "36,7.0"]
+    # The job and the shared result are untouched.
+    assert job.result is shared_result
+    assert shared_result.data == orders
+
+
+@pytest.mark.asyncio
+async def test_queued_callbacks_keep_their_result(tmp_path: Path):
+    """A result replaced while the callbacks wait, e.g. by a revalidation, is not
+    the one they get."""
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    job = EsiJob(
+        op_id="get_markets_prices",
+        callbacks=[
+            JobCallback(
+                callback_id="save_result_to_json_file",
+                kwargs={"file_path_template": str(tmp_path / "prices.json")},
+            )
+        ],
+    )
+    queued_result = make_result(job, expires, data=[{"type_id": 34}])
+    job.result = queued_result
+    callback_queue: Queue = Queue()
+    worker = JobQueueWorker(
+        local_source=None,
+        remote_source=SlowRemoteSource(),
+        callback_manifest=new_manifest(),
+        callback_queue=callback_queue,
+    )
+    await worker._do_callbacks(job)  # pylint: disable=protected-access
+    job.result = make_result(job, expires, data=[{"type_id": 35}])
+    consumer = asyncio.create_task(worker.callback_consumer(callback_queue))
+    await callback_queue.join()
+    consumer.cancel()
+    assert json.loads((tmp_path / "prices.json").read_text()) == [{"type_id": 34}]
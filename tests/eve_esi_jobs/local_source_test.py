@@ -0,0 +1,394 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from typing import List, Optional
+
+import pytest
+from aiohttp import ClientSession
+from tests.eve_esi_jobs.conftest import (
+    StaticRemoteSource,
+    make_response_meta,
+    make_result,
+)
+
+from eve_esi_jobs.cache_index import CacheIndex
+from eve_esi_jobs.eve_esi_jobs import JobQueueWorker
+from eve_esi_jobs.helpers import FileLock
+from eve_esi_jobs.models import EsiJob, EsiJobResult
+from eve_esi_jobs.observers import QueueObserver
+from eve_esi_jobs.sources import (
+    EsiBlobSource,
+    EsiLocalSource,
+    EsiMemoryCacheSource,
+    EsiRemoteSource,
+    EsiSqliteSource,
+)
+
+
+class NoNetworkRemoteSource(EsiRemoteSource):
+    def __init__(self) -> None:
+        # pylint: disable=super-init-not-called
+        self.requests = 0
+
+    async def do_job(
+        self, job: EsiJob, session: ClientSession, etag: Optional[str] = None
+    ) -> EsiJobResult:
+        self.requests += 1
+        raise AssertionError("Remote source should not have been called.")
+
+
+class MessageObserver(QueueObserver):
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages: List[str] = []
+
+    def update(
+        self, worker, job: EsiJob, result=None, msg="", exceptions=None, **kwargs
+    ):
+        if msg:
+            self.messages.append(msg)
+
+
+def test_response_expires():
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    meta = make_response_meta(now + timedelta(minutes=5))
+    assert meta.expires_at() == now + timedelta(minutes=5)
+    assert meta.is_fresh(now)
+    assert not meta.is_fresh(now + timedelta(minutes=6))
+    meta.response_headers.append({"Cache-Control": "no-cache"})
+    assert not meta.is_fresh(now)
+    meta = make_response_meta(None)
+    meta.response_headers.append({"Date": format_datetime(now, usegmt=True)})
+    meta.response_headers.append({"Cache-Control": "public, max-age=60"})
+    assert meta.expires_at() == now + timedelta(seconds=60)
+
+
+@pytest.mark.asyncio
+async def test_fresh_local_result_skips_remote(tmp_path: Path):
+    job = EsiJob(op_id="get_markets_prices")
+    local_source = EsiLocalSource(tmp_path)
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    await local_source.store_result(make_result(job, expires))
+    remote_source = NoNetworkRemoteSource()
+    worker = JobQueueWorker(local_source=local_source, remote_source=remote_source)
+    async with ClientSession() as session:
+        await worker.do_job(job, session=session)
+    assert remote_source.requests == 0
+    assert local_source.requests_avoided == 1
+    assert job.result is not None
+    assert job.result.data[0]["type_id"] == 34
+
+
+@pytest.mark.asyncio
+async def test_expired_local_result_uses_remote(tmp_path: Path):
+    job = EsiJob(op_id="get_markets_prices")
+    local_source = EsiLocalSource(tmp_path)
+    expires = datetime.now(timezone.utc) - timedelta(minutes=5)
+    await local_source.store_result(make_result(job, expires))
+    remote_source = NoNetworkRemoteSource()
+    worker = JobQueueWorker(local_source=local_source, remote_source=remote_source)
+    async with ClientSession() as session:
+        with pytest.raises(AssertionError):
+            await worker.do_job(job, session=session)
+    assert remote_source.requests == 1
+    assert local_source.requests_avoided == 0
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate(tmp_path: Path):
+    job = EsiJob(op_id="get_markets_prices")
+    local_source = EsiLocalSource(tmp_path)
+    expires = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await local_source.store_result(make_result(job, expires))
+    new_data = [{"type_id": 35, "average_price": 6.0}]
+    remote_source = StaticRemoteSource(new_data)
+    observer = MessageObserver()
+    worker = JobQueueWorker(
+        local_source=local_source,
+        remote_source=remote_source,
+        observers=[observer],
+        stale_window=timedelta(minutes=10),
+    )
+    async with ClientSession() as session:
+        await worker.do_job(job, session=session)
+        assert "Stale Local" in observer.messages
+        assert job.result is not None
+        assert job.result.data[0]["type_id"] == 34
+        await worker.wait_for_revalidations()
+    assert remote_source.requests == 1
+    assert "Revalidated" in observer.messages
+    assert job.result.data == new_data
+    stored = await local_source.do_job(job)
+    assert stored is not None
+    assert stored.data == new_data
+
+
+@pytest.mark.asyncio
+async def test_stale_window_exceeded(tmp_path: Path):
+    job = EsiJob(op_id="get_markets_prices")
+    local_source = EsiLocalSource(tmp_path)
+    expires = datetime.now(timezone.utc) - timedelta(minutes=20)
+    await local_source.store_result(make_result(job, expires))
+    new_data = [{"type_id": 35, "average_price": 6.0}]
+    remote_source = StaticRemoteSource(new_data)
+    observer = MessageObserver()
+    worker = JobQueueWorker(
+        local_source=local_source,
+        remote_source=remote_source,
+        observers=[observer],
+        stale_window=timedelta(minutes=10),
+    )
+    async with ClientSession() as session:
+        await worker.do_job(job, session=session)
+    assert "Stale Local" not in observer.messages
+    assert job.result is not None
+    assert job.result.data == new_data
+
+
+@pytest.mark.asyncio
+async def test_sqlite_source(tmp_path: Path):
+    local_source = EsiSqliteSource(tmp_path, batch_size=2)
+    now = datetime.now(timezone.utc)
+    jobs = [
+        EsiJob(op_id="get_markets_region_id_history", parameters={"type_id": type_id})
+        for type_id in (34, 35, 36)
+    ]
+    await local_source.store_result(make_result(jobs[0], now - timedelta(minutes=5)))
+    assert not local_source.db_path.exists()
+    # Pending results are readable before they are written.
+    pending = await local_source.do_job(jobs[0])
+    assert pending is not None
+    await local_source.store_result(make_result(jobs[1], now + timedelta(minutes=5)))
+    await local_source.store_result(make_result(jobs[2], now + timedelta(minutes=5)))
+    await local_source.flush()
+    assert len(local_source.list_entries()) == 3
+    assert len(local_source.list_entries(op_id="get_markets_prices")) == 0
+    local_source.close()
+
+    reopened = EsiSqliteSource(tmp_path)
+    result = await reopened.do_job(jobs[1])
+    assert result is not None
+    assert result.param_sig == jobs[1].param_sig()
+    assert reopened.is_fresh(result)
+    assert reopened.remove_expired() == 1
+    assert await reopened.do_job(jobs[0]) is None
+    reopened.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+async def test_compressed_local_source(tmp_path: Path, compression: str):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    job = EsiJob(op_id="get_markets_prices")
+    other_job = EsiJob(op_id="get_markets_prices", parameters={"datasource": "tq"})
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    plain_source = EsiLocalSource(tmp_path)
+    await plain_source.store_result(make_result(other_job, expires))
+    local_source = EsiLocalSource(tmp_path, compression=compression)
+    await local_source.store_result(make_result(job, expires))
+    stored = local_source.result_path(job.op_id, job.param_sig()).read_bytes()
+    assert not stored.startswith(b"{")
+    # Compressed and uncompressed entries can be read by either source.
+    for source in (plain_source, local_source):
+        for test_job in (job, other_job):
+            result = await source.do_job(test_job)
+            assert result is not None
+            assert result.data[0]["type_id"] == 34
+
+
+def test_unknown_compression(tmp_path: Path):
+    with pytest.raises(ValueError):
+        EsiLocalSource(tmp_path, compression="lzma")
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_source(tmp_path: Path):
+    disk_source = EsiLocalSource(tmp_path)
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    jobs = [
+        EsiJob(op_id="get_markets_region_id_history", parameters={"type_id": type_id})
+        for type_id in (34, 35, 36)
+    ]
+    results = [make_result(job, expires) for job in jobs]
+    size = EsiMemoryCacheSource(disk_source).estimate_size(results[0])
+    memory_source = EsiMemoryCacheSource(disk_source, max_bytes=size * 2)
+    for result in results[:2]:
+        await memory_source.store_result(result)
+    # Write through to disk.
+    assert await disk_source.do_job(jobs[0]) is not None
+    assert await memory_source.do_job(jobs[0]) is results[0]
+    await memory_source.store_result(results[2])
+    # jobs[1] was least recently used.
+    assert memory_source.evictions == 1
+    assert memory_source.current_bytes <= memory_source.max_bytes
+    assert memory_source.hits == 1
+    from_disk = await memory_source.do_job(jobs[1])
+    assert from_disk is not None and from_disk is not results[1]
+    assert memory_source.misses == 1
+    assert memory_source.stats()["entries"] == 2
+
+
+def test_memory_cache_source_closes_index_once(tmp_path: Path):
+    closed: List[Path] = []
+
+    class CountingIndex(CacheIndex):
+        def close(self):
+            closed.append(self.db_path)
+            super().close()
+
+    disk_source = EsiLocalSource(tmp_path, index=CountingIndex.in_dir(tmp_path))
+    memory_source = EsiMemoryCacheSource(disk_source)
+    memory_source.close()
+    assert closed == [tmp_path / "cache-index.sqlite"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("source_class", [EsiLocalSource, EsiSqliteSource])
+async def test_memory_cache_source_records_access(tmp_path: Path, source_class):
+    """Results served from memory don't look unused to least recently used gc."""
+    disk_source = source_class(tmp_path, index=CacheIndex.in_dir(tmp_path))
+    memory_source = EsiMemoryCacheSource(disk_source)
+    job = EsiJob(op_id="get_markets_prices")
+    param_sig = str(job.param_sig())
+    await memory_source.store_result(
+        make_result(job, datetime.now(timezone.utc) + timedelta(minutes=5))
+    )
+    await memory_source.flush()
+    # Stored long ago, and served from memory since.
+    long_ago = datetime.now(timezone.utc).timestamp() - 3600
+    assert disk_source.index is not None
+    disk_source.index.record_accessed(job.op_id, param_sig, long_ago)
+    if source_class is EsiSqliteSource:
+        await disk_source.record_accesses({(job.op_id, param_sig): long_ago})
+    else:
+        result_path = disk_source.result_path(job.op_id, param_sig)
+        stat = result_path.stat()
+        os.utime(result_path, ns=(int(long_ago * 1e9), stat.st_mtime_ns))
+    await disk_source.flush()
+    assert await memory_source.do_job(job) is not None
+    assert memory_source.stats()["hits"] == 1
+    await memory_source.flush()
+    (entry,) = list(disk_source.scan_entries())
+    assert entry.last_access > long_ago + 60
+    indexed = disk_source.index.get_entry(job.op_id, param_sig)
+    assert indexed is not None and indexed.last_access > long_ago + 60
+    memory_source.close()
+
+
+@pytest.mark.asyncio
+async def test_blob_source_deduplicates(tmp_path: Path):
+    plain_source = EsiLocalSource(tmp_path)
+    local_source = EsiBlobSource(tmp_path, compression="gzip")
+    expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+    jobs = [
+        EsiJob(op_id="get_markets_region_id_history", parameters={"type_id": type_id})
+        for type_id in (34, 35, 36)
+    ]
+    await plain_source.store_result(make_result(jobs[0], expires))
+    for job in jobs[1:]:
+        await local_source.store_result(make_result(job, expires, data=[]))
+    assert local_source.blobs_written == 1
+    assert local_source.blobs_reused == 1
+    assert len(list(local_source.blob_root.glob("*/*.json"))) == 1
+    # Entries from EsiLocalSource are still readable.
+    for job in jobs:
+        result = await local_source.do_job(job)
+        assert result is not None
+        assert result.param_sig == job.param_sig()
+        assert local_source.is_fresh(result)
+    assert (await local_source.do_job(jobs[1])).data == []
+    entries = list(local_source.scan_entries())
+    assert len(entries) == 3
+    assert all(entry.expires is not None for entry in entries)
+
+
+@pytest.mark.asyncio
+async def test_shared_fetch_lease(tmp_path: Path):
+    job = EsiJob(op_id="get_markets_prices")
+    fetching_source = EsiLocalSource(tmp_path, shared=True)
+    waiting_source = EsiLocalSource(tmp_path, shared=True)
+    waiting_source.lease_poll_interval = 0.01
+    remote_source = NoNetworkRemoteSource()
+    observer = MessageObserver()
+    worker = JobQueueWorker(
+        local_source=waiting_source, remote_source=remote_source, observers=[observer]
+    )
+    async with ClientSession() as session:
+        async with fetching_source.fetch_lease(job) as waited:
+            assert not waited
+            # The worker waits for the lease while the result is fetched elsewhere.
+            waiting = asyncio.create_task(worker.do_job(job, session=session))
+            await asyncio.sleep(0.05)
+            assert not waiting.done()
+            expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+            await fetching_source.store_result(make_result(job, expires))
+        await waiting
+    assert remote_source.requests == 0
+    assert "Fresh Shared" in observer.messages
+    assert job.result is not None
+    assert job.result.data[0]["type_id"] == 34
+
+
+@pytest.mark.asyncio
+async def test_shared_stale_revalidation(tmp_path: Path):
+    """A stale result revalidated by another process is not fetched again."""
+    job = EsiJob(op_id="get_markets_prices")
+    fetching_source = EsiLocalSource(tmp_path, shared=True)
+    waiting_source = EsiLocalSource(tmp_path, shared=True)
+    waiting_source.lease_poll_interval = 0.01
+    stale = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await fetching_source.store_result(make_result(job, stale))
+    remote_source = NoNetworkRemoteSource()
+    observer = MessageObserver()
+    worker = JobQueueWorker(
+        local_source=waiting_source,
+        remote_source=remote_source,
+        observers=[observer],
+        stale_window=timedelta(minutes=10),
+    )
+    new_data = [{"type_id": 35, "average_price": 6.0}]
+    async with ClientSession() as session:
+        async with fetching_source.fetch_lease(job):
+            await worker.do_job(job, session=session)
+            assert "Stale Local" in observer.messages
+            # The revalidation waits for the lease while another process fetches.
+            await asyncio.sleep(0.05)
+            assert worker.revalidations
+            expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+            await fetching_source.store_result(make_result(job, expires, new_data))
+        await worker.wait_for_revalidations()
+    assert remote_source.requests == 0
+    assert "Fresh Shared" in observer.messages
+    assert job.result is not None
+    assert job.result.data == new_data
+
+
+def test_remove_stale_locks(tmp_path: Path):
+    local_source = EsiLocalSource(tmp_path, shared=True)
+    jobs = [
+        EsiJob(op_id="get_markets_prices", parameters={"type_id": 34 + n})
+        for n in range(3)
+    ]
+    locks = [
+        FileLock(local_source.lock_path(job.op_id, job.param_sig())) for job in jobs
+    ]
+    for lock in locks:
+        assert lock.try_acquire()
+        lock.release()
+    # The first was used recently, the second is old but held.
+    for lock in locks[1:]:
+        os.utime(lock.lock_path, (0, 0))
+    holder = FileLock(locks[1].lock_path)
+    assert holder.try_acquire()
+    os.utime(locks[1].lock_path, (0, 0))
+    try:
+        assert local_source.remove_stale_temp_files() == 1
+    finally:
+        holder.release()
+    assert [lock.lock_path.exists() for lock in locks] == [True, True, False]
+    # A removed lock file is made again when needed.
+    assert locks[2].try_acquire()
+    locks[2].release()
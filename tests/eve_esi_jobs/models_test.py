@@ -4,9 +4,11 @@ from datetime import datetime
 from pathlib import Path
 from uuid import UUID
 
+import pytest
 from rich import inspect
 
 from eve_esi_jobs import models
+from eve_esi_jobs.aiohttp_queue import ResponseMeta, join_json_arrays
 
 
 def test_foo(logger: logging.Logger):
@@ -15,3 +17,68 @@ def test_foo(logger: logging.Logger):
 
 def test_get_iso_time():
     print(datetime.now().isoformat().replace(":", "-"))
+
+
+def test_esi_job_result_raw():
+    response = ResponseMeta(
+        version="1.1",
+        status=200,
+        reason="OK",
+        cookies="",
+        response_headers=[],
+        method="GET",
+        url="https://esi.evetech.net/latest/markets/prices/",
+        real_url="https://esi.evetech.net/latest/markets/prices/",
+        request_headers=[],
+    )
+    job = models.EsiJob(op_id="get_markets_prices")
+    raw = b'[{"type_id":34,"average_price":5.0}]'
+    result = models.EsiJobResult.from_raw(job.op_id, job.param_sig(), response, raw)
+    assert not result.is_parsed
+    serialized = result.serialize_raw()
+    assert serialized.endswith(',"data":[{"type_id":34,"average_price":5.0}]}')
+    assert not result.is_parsed
+    deserialized = models.EsiJobResult.deserialize_raw(serialized)
+    assert not deserialized.is_parsed
+    assert deserialized.raw_json() == raw.decode()
+    assert deserialized.data[0]["type_id"] == 34
+    assert deserialized.is_parsed
+    assert deserialized == result
+    # Results saved before raw JSON was kept are still read.
+    indented = models.EsiJobResult.deserialize_raw(result.serialize_json(indent=2))
+    assert indented.data == result.data
+    job.result = result
+    from_job = models.EsiJob.deserialize_json(job.serialize_json())
+    assert from_job.result is not None
+    assert from_job.result.data == result.data
+    result.data = []
+    assert result.raw_json() == "[]"
+    assert join_json_arrays([b"[1,2]", b" [] ", b"[3]\n"]) == b"[1,2,3]"
+
+
+def test_job_transform():
+    rows = [
+        {"type_id": 34, "price": 5.0, "range": "region"},
+        {"type_id": 35, "price": 6.0, "range": "station"},
+        {"type_id": 36, "range": "region"},
+        {"type_id": 37, "price": None},
+    ]
+    transform = models.JobTransform(
+        filters=[
+            {"field": "type_id", "op": "in", "value": [34, 35, 36, 37]},
+            {"field": "price", "op": "ge", "value": 5.5},
+        ],
+        rename={"type_id": "id"},
+    )
+    assert transform.apply(rows) == [{"id": 35, "price": 6.0, "range": "station"}]
+    transform = models.JobTransform(fields=["price", "type_id", "missing"])
+    assert transform.apply(rows)[0] == {"price": 5.0, "type_id": 34}
+    assert transform.apply({"price": 1.0, "name": "x"}) == {"price": 1.0}
+    assert transform.apply([34, 35]) == [34, 35]
+    assert rows[0] == {"type_id": 34, "price": 5.0, "range": "region"}
+    with pytest.raises(ValueError):
+        models.RowFilter(field="price", op="between")
+    job = models.EsiJob.deserialize_json(
+        models.EsiJob(op_id="get_markets_prices", transform=transform).serialize_json()
+    )
+    assert job.transform == transform
@@ -0,0 +1,201 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from pathlib import Path
+
+import pytest
+
+from eve_esi_jobs.aiohttp_queue import ResponseMeta
+from eve_esi_jobs.callback_manifest import new_manifest
+from eve_esi_jobs.callbacks import CallbackRunner
+from eve_esi_jobs.models import EsiJob, EsiJobResult, JobCallback
+from eve_esi_jobs.snapshots import SnapshotStore
+
+
+def make_orders(prices):
+    return [
+        {"order_id": order_id, "type_id": 34, "price": price}
+        for order_id, price in prices.items()
+    ]
+
+
+def test_snapshot_store(tmp_path: Path):
+    store = SnapshotStore(tmp_path, key_field="order_id", checkpoint_every=2)
+    start = datetime(2021, 6, 1, tzinfo=timezone.utc)
+    polls = [
+        {1: 5.0, 2: 6.0},
+        {1: 5.0, 2: 6.5, 3: 7.0},
+        {2: 6.5, 3: 7.0},
+        {2: 6.0, 4: 8.0},
+    ]
+    for minutes, prices in enumerate(polls):
+        store.add(make_orders(prices), start + timedelta(minutes=minutes * 5))
+    delta = store.add(make_orders(polls[-1]), start + timedelta(minutes=20))
+    assert delta is not None and delta.is_empty()
+    # A new segment was started after two deltas.
+    assert len(store.segments()) == 2
+    assert len(store.timestamps()) == 5
+    for minutes, prices in enumerate(polls):
+        snapshot = store.snapshot_at(start + timedelta(minutes=minutes * 5 + 1))
+        assert snapshot == make_orders(prices)
+    assert store.snapshot_at() == make_orders(polls[-1])
+    with pytest.raises(ValueError):
+        store.snapshot_at(start - timedelta(minutes=1))
+    with pytest.raises(ValueError):
+        store.add(make_orders(polls[0]), start)
+
+
+def test_snapshot_store_compact(tmp_path: Path):
+    store = SnapshotStore(tmp_path, key_field="order_id", compression="gzip")
+    start = datetime(2021, 6, 1, tzinfo=timezone.utc)
+    for minutes in range(12):
+        prices = {1: 5.0 + minutes, 2: 6.0, minutes + 10: 1.0}
+        store.add(make_orders(prices), start + timedelta(minutes=minutes * 5))
+    removed = store.compact(
+        older_than=start + timedelta(minutes=30), resolution=timedelta(minutes=15)
+    )
+    # Polls at 5..25 minutes keep one per 15 minutes, the base is always kept.
+    assert removed == 3
+    assert len(store.timestamps()) == 12 - removed
+    latest = store.snapshot_at()
+    assert {order["order_id"] for order in latest} == {1, 2, 21}
+    assert store.snapshot_at(start + timedelta(minutes=26))[0]["price"] == 10.0
+
+
+@pytest.mark.asyncio
+async def test_snapshot_callback(tmp_path: Path):
+    job = EsiJob(
+        op_id="get_markets_region_id_orders", parameters={"region_id": 10000002}
+    )
+    date = datetime(2021, 6, 1, tzinfo=timezone.utc)
+    response = ResponseMeta(
+        version="1.1",
+        status=200,
+        reason="OK",
+        cookies="",
+        response_headers=[{"Date": format_datetime(date, usegmt=True)}],
+        method="GET",
+        url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        real_url="https://esi.evetech.net/latest/markets/10000002/orders/",
+        request_headers=[],
+    )
+    job.result = EsiJobResult(
+        op_id=job.op_id,
+        param_sig=job.param_sig(),
+        response=response,
+        data=make_orders({1: 5.0}),
+    )
+    job_callback = JobCallback(
+        callback_id="save_list_of_dict_result_to_snapshot_store",
+        kwargs={
+            "file_path_template": str(tmp_path / Path("${region_id}")),
+            "key_field": "order_id",
+        },
+    )
+    callback = new_manifest().init_callback(job_callback, job)
+    await callback.do_callback()
+    store = SnapshotStore(tmp_path / Path("10000002"), key_field="order_id")
+    assert store.timestamps() == [date]
+    assert store.snapshot_at() == make_orders({1: 5.0})
+
+
+@pytest.mark.asyncio
+async def test_snapshot_callback_cached_result(tmp_path: Path):
+    """A cached result handed out again keeps its `Date`, and is saved once."""
+    start = datetime(2021, 6, 1, tzinfo=timezone.utc)
+    job_callback = JobCallback(
+        callback_id="save_list_of_dict_result_to_snapshot_store",
+        kwargs={
+            "file_path_template": str(tmp_path / Path("${region_id}")),
+            "key_field": "order_id",
+        },
+    )
+    manifest = new_manifest()
+    for minutes in (0, 5):
+        job = EsiJob(
+            op_id="get_markets_region_id_orders", parameters={"region_id": 10000002}
+        )
+        date = start + timedelta(minutes=minutes)
+        job.result = EsiJobResult(
+            op_id=job.op_id,
+            param_sig=job.param_sig(),
+            response=ResponseMeta(
+                version="1.1",
+                status=200,
+                reason="OK",
+                cookies="",
+                response_headers=[{"Date": format_datetime(date, usegmt=True)}],
+                method="GET",
+                url="https://esi.evetech.net/latest/markets/10000002/orders/",
+                real_url="https://esi.evetech.net/latest/markets/10000002/orders/",
+                request_headers=[],
+            ),
+            data=make_orders({1: 5.0 + minutes}),
+        )
+        # The base snapshot, then a delta, each run twice.
+        for _ in range(2):
+            await manifest.init_callback(job_callback, job).do_callback()
+    store = SnapshotStore(tmp_path / Path("10000002"), key_field="order_id")
+    assert store.timestamps() == [start, start + timedelta(minutes=5)]
+    assert store.snapshot_at() == make_orders({1: 10.0})
+    with pytest.raises(ValueError):
+        store.add(make_orders({1: 6.0}), start + timedelta(minutes=5))
+
+
+@pytest.mark.asyncio
+async def test_snapshot_callbacks_share_store(tmp_path: Path):
+    start = datetime(2021, 6, 1, tzinfo=timezone.utc)
+    runner = CallbackRunner(max_threads=4)
+    job_callback = JobCallback(
+        callback_id="save_list_of_dict_result_to_snapshot_store",
+        kwargs={
+            "file_path_template": str(tmp_path / Path("${region_id}")),
+            "key_field": "order_id",
+        },
+    )
+    manifest = new_manifest()
+    callbacks = []
+    for minutes in range(6):
+        job = EsiJob(
+            op_id="get_markets_region_id_orders", parameters={"region_id": 10000002}
+        )
+        date = start + timedelta(minutes=minutes * 5)
+        job.result = EsiJobResult(
+            op_id=job.op_id,
+            param_sig=job.param_sig(),
+            response=ResponseMeta(
+                version="1.1",
+                status=200,
+                reason="OK",
+                cookies="",
+                response_headers=[{"Date": format_datetime(date, usegmt=True)}],
+                method="GET",
+                url="https://esi.evetech.net/latest/markets/10000002/orders/",
+                real_url="https://esi.evetech.net/latest/markets/10000002/orders/",
+                request_headers=[],
+            ),
+            data=make_orders({1: 5.0 + minutes}),
+        )
+        callback = manifest.init_callback(job_callback, job)
+        callback.runner = runner
+        callbacks.append(callback)
+    try:
+        await callbacks[0].do_callback()
+        assert len(runner.sinks) == 1
+        # The polls take turns with the store, a poll that lands after a later
+        # one is refused, the rest are saved against the right state.
+        outcomes = await asyncio.gather(
+            *(callback.do_callback() for callback in callbacks[1:]),
+            return_exceptions=True,
+        )
+    finally:
+        await runner.aclose()
+    errors = [outcome for outcome in outcomes if outcome is not None]
+    assert all(isinstance(error, ValueError) for error in errors)
+    store = SnapshotStore(tmp_path / Path("10000002"), key_field="order_id")
+    assert len(store.segments()) == 1
+    timestamps = store.timestamps()
+    assert len(timestamps) == 6 - len(errors)
+    for timestamp in timestamps:
+        minutes = (timestamp - start) // timedelta(minutes=5)
+        assert store.snapshot_at(timestamp) == make_orders({1: 5.0 + minutes})
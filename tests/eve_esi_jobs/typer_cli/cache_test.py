@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from pathlib import Path
+
+from tests.eve_esi_jobs.conftest import FileResource, StaticRemoteSource, make_result
+from typer.testing import CliRunner
+
+from eve_esi_jobs.eve_esi_jobs import EveEsiJobs
+from eve_esi_jobs.models import EsiJob
+from eve_esi_jobs.sources import EsiLocalSource
+from eve_esi_jobs.typer_cli import eve_esi_cli
+from eve_esi_jobs.typer_cli.eve_esi_cli import app
+
+DATA = [{"type_id": 34, "average_price": 5.0}]
+
+
+def test_cache_gc(test_app_dir: Path, esi_schema: FileResource):
+    cache_dir = test_app_dir / Path("test_cache_gc")
+    local_source = EsiLocalSource(cache_dir)
+    job = EsiJob(op_id="get_markets_prices")
+    expires = datetime.now(timezone.utc) - timedelta(hours=2)
+    asyncio.run(local_source.store_result(make_result(job, expires)))
+    runner = CliRunner()
+    result = runner.invoke(
+        app,
+        [
+            "-s",
+            str(esi_schema.file_path),
+            "cache",
+            "gc",
+            "--cache-dir",
+            str(cache_dir),
+            "--expired-hours",
+            "1",
+        ],
+        catch_exceptions=False,
+    )
+    print(result.output)
+    assert result.exit_code == 0
+    assert "removed 1 expired" in result.output
+    assert asyncio.run(local_source.do_job(job)) is None
+
+
+def test_cache_stats(test_app_dir: Path, esi_schema: FileResource):
+    cache_dir = test_app_dir / Path("test_cache_stats")
+    local_source = EsiLocalSource(cache_dir)
+    job = EsiJob(op_id="get_markets_prices")
+    expires = datetime.now(timezone.utc) - timedelta(hours=2)
+    asyncio.run(local_source.store_result(make_result(job, expires)))
+    runner = CliRunner()
+    schema_args = ["-s", str(esi_schema.file_path), "cache"]
+    result = runner.invoke(
+        app,
+        [*schema_args, "stats", "--cache-dir", str(cache_dir)],
+        catch_exceptions=False,
+    )
+    print(result.output)
+    assert result.exit_code == 0
+    assert "1 entries" in result.output
+    assert "get_markets_prices: 1 entries" in result.output
+    assert "No runs recorded" in result.output
+    result = runner.invoke(
+        app,
+        [*schema_args, "list", "--cache-dir", str(cache_dir), "--expired"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert f"get_markets_prices {job.param_sig()}" in result.output
+    result = runner.invoke(
+        app,
+        [
+            *schema_args,
+            "show",
+            "get_markets_prices",
+            str(job.param_sig()),
+            "--cache-dir",
+            str(cache_dir),
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "fresh: False" in result.output
+    assert "ETag" in result.output
+
+
+def test_jobs_use_cli_cache(test_app_dir: Path, esi_schema: FileResource, monkeypatch):
+    cache_dir = test_app_dir / Path("test_jobs_use_cli_cache")
+    monkeypatch.setenv("PFMSOFT_eve_esi_jobs_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(
+        eve_esi_cli,
+        "EveEsiJobs",
+        partial(EveEsiJobs, remote_source=StaticRemoteSource(DATA)),
+    )
+    job = EsiJob(op_id="get_markets_prices")
+    job_path = test_app_dir / Path("test_jobs_use_cli_cache.json")
+    job_path.write_text(job.serialize_json())
+    runner = CliRunner()
+    schema_args = ["-s", str(esi_schema.file_path)]
+    do_args = ["do", "job", str(job_path), str(test_app_dir / "output")]
+    # Without --use-cache, jobs leave the cache alone.
+    result = runner.invoke(app, [*schema_args, *do_args], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert not cache_dir.exists()
+    for _ in range(2):
+        result = runner.invoke(
+            app, [*schema_args, "--use-cache", *do_args], catch_exceptions=False
+        )
+        print(result.output)
+        assert result.exit_code == 0
+    # The cache commands default to the cache the job stored its result in.
+    result = runner.invoke(app, [*schema_args, "cache", "list"], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert f"get_markets_prices {job.param_sig()}" in result.output
+    # Both runs were recorded, the second was served from the cache.
+    result = runner.invoke(
+        app, [*schema_args, "cache", "stats"], catch_exceptions=False
+    )
+    print(result.output)
+    assert result.exit_code == 0
+    assert "Recent runs:" in result.output
+    assert "1 jobs, hit ratio 100% (1 hits: 1 fresh" in result.output
+    assert "1 jobs, hit ratio 0% (0 hits" in result.output